@@ -1,10 +1,13 @@
-from flask import Flask, g
+from flask import Flask
 
 app = Flask('api')
 
 from api import routes
-from api.secrets import TOKENS
+from api import secrets
 
-with app.app_context():
-    # Bind secret tokens to the application context
-    g.tokens = TOKENS
+# Bind secret tokens to the application
+app.config['TOKENS'] = secrets.TOKENS
+app.config['REPO_TOKENS'] = getattr(secrets, 'REPO_TOKENS', {})
+
+# GitHub caps webhook payloads at 25 MB
+app.config['MAX_CONTENT_LENGTH'] = 25 * 1024 * 1024
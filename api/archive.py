@@ -0,0 +1,164 @@
+# archive.py -- deploy repos from `git archive`, without a working copy
+import os
+import stat
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+
+from api.exceptions import WorkerException
+
+
+class Archive(object):
+    '''
+    Deploy a commit by streaming `git archive` out of a local mirror and
+    extracting it straight into a fresh release directory (see `Releases`).
+    There's no working copy to update and nothing to rsync, at the cost of a
+    release holding only what's committed: no `.git` directory, and none of
+    the files that scripts made last time.
+    '''
+    def __init__(self, run_command):
+        '''
+        Initialize the archive.
+
+        Args:
+            - run_command (callable): Function for running commands, so that
+                                      failures are reported by the Worker.
+        '''
+        self.run_command = run_command
+
+    def extract(self, mirror_path, sha, release_path, previous=None):
+        '''
+        Extract the tree of a commit in a mirror into an empty directory.
+
+        Args:
+            - mirror_path (string): Path to the mirror.
+            - sha (string): Commit to extract.
+            - release_path (string): Directory to extract into.
+            - previous (Release): Optional earlier extract, with its `path`,
+                                  `sha` and `created` time. Files that haven't
+                                  changed since it get copied from it instead
+                                  of being extracted again.
+        '''
+        if os.path.lexists(release_path):
+            # Left behind by a deploy that was interrupted
+            shutil.rmtree(release_path)
+
+        os.makedirs(release_path)
+
+        members = None
+        if previous:
+            members = self.copy_unchanged(mirror_path, sha, release_path, previous)
+
+        logging.info('Extracting {sha} into {release_path}...'.format(sha=sha[:8],
+                                                                     release_path=release_path))
+
+        if members is None:
+            self.run_command(['bash', '-c',
+                              'set -o pipefail; git -C "$0" archive --format=tar "$1" | '
+                              'tar -x -C "$2"',
+                              mirror_path, sha, release_path])
+            return
+
+        if not members:
+            return
+
+        # Only the files that weren't copied come out of the archive
+        with self.path_list(members) as member_list:
+            self.run_command(['bash', '-c',
+                              'set -o pipefail; git -C "$0" archive --format=tar "$1" | '
+                              'tar -x -C "$2" --null -T "$3"',
+                              mirror_path, sha, release_path, member_list])
+
+    @contextmanager
+    def path_list(self, paths):
+        '''
+        Write paths to a temporary file, separated by NULs, for commands that
+        read their arguments from a file. Yields the file's path.
+        '''
+        with tempfile.NamedTemporaryFile(prefix='bunny-hook-members-') as path_list:
+            path_list.write(b'\0'.join(path.encode('utf-8') for path in paths))
+            path_list.flush()
+
+            yield path_list.name
+
+    def copy_unchanged(self, mirror_path, sha, release_path, previous):
+        '''
+        Copy the files of a commit that are the same in an earlier extract
+        into a release directory. Returns the paths that still need to be
+        extracted, or None if everything does.
+
+        A file is only copied if git says it hasn't changed between the two
+        commits, and it hasn't been touched since the earlier extract was made
+        (e.g. by a build script), so that it really holds what's committed.
+        Files are copied with `cp --reflink=auto`, which shares their blocks
+        on filesystems that support it (e.g. Btrfs and XFS) until either copy
+        is written to. They're never hardlinked: a build script writing to a
+        hardlinked file would change the live release too.
+        '''
+        try:
+            changed = self.git(mirror_path, 'diff', '--name-only', '--no-renames', '-z',
+                               previous.sha, sha)
+            tree = self.git(mirror_path, 'ls-tree', '-r', '-l', '-z', '--full-tree', sha)
+        except WorkerException:
+            # The earlier commit may be gone from the mirror (e.g. after a
+            # force push), so there's nothing to compare against
+            return None
+
+        changed = set(changed.split('\0'))
+        entries = [entry.split('\t', 1) for entry in tree.split('\0') if entry]
+
+        # `.gitattributes` can leave files out of archives or rewrite them
+        if any(os.path.basename(path) == '.gitattributes' for _, path in entries):
+            return None
+
+        members = []
+        unchanged = []
+
+        for info, path in entries:
+            mode, kind, _, size = info.split()
+
+            # Submodules aren't part of archives
+            if kind != 'blob':
+                continue
+
+            src = os.path.join(previous.path, path)
+
+            if (mode in ('100644', '100755') and path not in changed and
+                    self.is_pristine(src, int(size), mode == '100755', previous.created)):
+                unchanged.append(path)
+            else:
+                members.append(path)
+
+        if unchanged:
+            # Keep the modification times, so that the copies still count as
+            # pristine when the next release is made from this one
+            with self.path_list(unchanged) as paths:
+                self.run_command(['bash', '-c',
+                                  'cd "$0" && xargs -0 cp --parents --reflink=auto '
+                                  '--preserve=mode,timestamps -t "$1" < "$2"',
+                                  previous.path, release_path, paths])
+
+        logging.info('Copied %d unchanged files from %s' % (len(unchanged), previous.path))
+
+        return members
+
+    def is_pristine(self, path, size, executable, created):
+        '''
+        Check whether a file in an earlier extract still looks the way it was
+        extracted: the right size and mode, and not modified since `created`.
+        '''
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+
+        return (stat.S_ISREG(st.st_mode) and st.st_size == size and
+                bool(st.st_mode & stat.S_IXUSR) == executable and st.st_mtime < created)
+
+    def git(self, mirror_path, *args):
+        '''
+        Run a git command in a mirror and return its output.
+        '''
+        result = self.run_command(['git', '-C', mirror_path] + list(args), capture=True)
+        return result.stdout or ''
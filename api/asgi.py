@@ -0,0 +1,229 @@
+# asgi.py -- asynchronous ingestion of webhooks
+import re
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from api.queue import open_queue
+from api.ingest import check_payload, select_tokens, enqueue
+from api.signatures import get_signature, verify
+from api.logs import logger
+from api.metrics import get_registry, metrics_dir
+from api.exceptions import QueueUnavailable
+
+HOOK_PATH = re.compile(r'^/hooks/github/(?P<branch_name>[^/]+)$')
+
+
+class PayloadTooLarge(Exception):
+    '''
+    The request body went over the size limit.
+    '''
+    pass
+
+
+class IngestApp(object):
+    '''
+    ASGI application for receiving webhooks from GitHub.
+
+    Request bodies are read as a stream and cut off once they pass the size
+    limit. Bodies are parsed, authenticated and written to the queue in a
+    small thread pool, so that neither large payloads nor a locked datastore
+    block the event loop, and once `max_pending` requests are in flight, new
+    ones get turned away with a 503 instead of piling up. A 202 is only sent
+    once the job has been committed to the queue.
+
+    Any other request is passed along to the `fallback` ASGI app, if one is
+    given (e.g. the Flask app, wrapped for ASGI).
+    '''
+    # Default maximum number of requests being checked and queued at once
+    max_pending = 64
+
+    def __init__(self, config, fallback=None, max_pending=None):
+        '''
+        Initialize the app.
+
+        Args:
+            - config (dict): App config, for tokens and queue settings. The
+                             body size limit comes from MAX_CONTENT_LENGTH.
+            - fallback (callable): Optional ASGI app for other routes.
+            - max_pending (int): Optional maximum number of requests being
+                                 checked and queued at once.
+        '''
+        self.config = config
+        self.fallback = fallback
+
+        if max_pending:
+            self.max_pending = max_pending
+
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.metrics = get_registry(config.get('METRICS_DIR') or metrics_dir())
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        match = HOOK_PATH.match(scope.get('path', '')) if scope['type'] == 'http' else None
+
+        if not match:
+            if self.fallback:
+                return await self.fallback(scope, receive, send)
+
+            return await self.respond(send, 404, {'status': 'Not found'})
+
+        if scope['method'] != 'POST':
+            return await self.respond(send, 405, {'status': 'Method not allowed'})
+
+        start = time.perf_counter()
+
+        try:
+            status_code, resp = await self.receive_post(scope, receive,
+                                                        match.group('branch_name'))
+        except ConnectionError:
+            # The client went away; there's nobody to respond to
+            return
+
+        self.metrics.observe('bunny_hook_webhook_seconds', time.perf_counter() - start)
+        self.metrics.inc('bunny_hook_webhook_requests_total', status=status_code)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            fields = {'method': scope['method'], 'path': scope['path'],
+                      'status_code': status_code, 'response': resp}
+            logger.debug('Request to %s', scope['path'], extra={'fields': fields})
+
+        headers = [(b'retry-after', b'1')] if status_code == 503 else []
+        await self.respond(send, status_code, resp, headers)
+
+    async def lifespan(self, receive, send):
+        '''
+        Set up the queue schema at startup, so requests only pay for the INSERT.
+        '''
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                open_queue(self.config.get('QUEUE_DB')).close()
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, scope, receive):
+        '''
+        Read the request body, raising PayloadTooLarge as soon as it passes
+        the size limit.
+        '''
+        limit = self.config.get('MAX_CONTENT_LENGTH')
+
+        headers = dict(scope['headers'])
+        length = headers.get(b'content-length')
+
+        if limit and length and length.isdigit() and int(length) > limit:
+            raise PayloadTooLarge()
+
+        chunks = []
+        size = 0
+        more_body = True
+
+        while more_body:
+            message = await receive()
+
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('Client disconnected')
+
+            chunk = message.get('body', b'')
+            size += len(chunk)
+
+            if limit and size > limit:
+                raise PayloadTooLarge()
+
+            chunks.append(chunk)
+            more_body = message.get('more_body', False)
+
+        return b''.join(chunks)
+
+    async def receive_post(self, scope, receive, branch_name):
+        '''
+        Authenticate a webhook and queue it up. Returns the HTTP status code
+        and response body.
+        '''
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1')
+                   for key, value in scope['headers']}
+
+        algorithm, post_sig = get_signature({
+            'X-Hub-Signature-256': headers.get('x-hub-signature-256'),
+            'X-Hub-Signature': headers.get('x-hub-signature'),
+        })
+
+        if not post_sig:
+            return 400, {'status': 'Authentication signature not found'}
+
+        try:
+            body = await self.read_body(scope, receive)
+        except PayloadTooLarge:
+            return 413, {'status': 'Request payload is too large'}
+
+        # Shed load instead of queuing up work behind a slow datastore
+        if self.pending >= self.max_pending:
+            return 503, {'status': 'Too many requests in flight; try again shortly'}
+
+        self.pending += 1
+        try:
+            # Parsing and checking the signature of a large body takes a
+            # while, so it runs in the pool along with the write
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.accept, body, algorithm,
+                                              post_sig, branch_name,
+                                              headers.get('x-github-delivery'))
+        finally:
+            self.pending -= 1
+
+    def accept(self, body, algorithm, post_sig, branch_name, delivery):
+        '''
+        Parse and authenticate a webhook's body, and queue it up if it checks
+        out. Runs in the thread pool. Returns the HTTP status code and
+        response body.
+        '''
+        try:
+            payload_json = json.loads(body.decode('utf-8'))
+        except ValueError:
+            payload_json = None
+
+        tokens = select_tokens(payload_json,
+                               self.config.get('TOKENS', []),
+                               self.config.get('REPO_TOKENS', {}))
+
+        if not verify(body, algorithm, post_sig, tokens):
+            return 401, {'status': 'Request signature failed to authenticate'}
+
+        status_code, status = check_payload(payload_json, branch_name)
+
+        if status_code != 202:
+            return status_code, {'status': status}
+
+        try:
+            work_id = enqueue(self.config, payload_json, delivery)
+        except QueueUnavailable as e:
+            return 503, {'status': 'Could not queue build: %s' % e}
+
+        return status_code, {'status': status, 'id': work_id}
+
+    async def respond(self, send, status_code, resp, headers=None):
+        '''
+        Send a JSON response.
+        '''
+        body = json.dumps(resp).encode('utf-8')
+
+        await send({
+            'type': 'http.response.start',
+            'status': status_code,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode('latin-1')),
+            ] + (headers or []),
+        })
+        await send({'type': 'http.response.body', 'body': body})
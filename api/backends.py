@@ -0,0 +1,340 @@
+# backends.py -- the interface that every kind of queue implements
+import time
+import random
+from concurrent.futures.process import BrokenProcessPool
+
+from api.worker import Worker
+from api.payload import Payload
+from api.parse_configs import MAX_PRIORITY
+from api.exceptions import QueueException, CancelledException, ConfigException, \
+    WorkerException
+
+
+def is_transient(exc):
+    '''
+    Check whether a job that failed with an exception might succeed if it's
+    tried again (e.g. because a fetch from GitHub timed out, or the process
+    running it died). Broken configs and bugs won't fix themselves.
+    '''
+    if isinstance(exc, ConfigException):
+        return False
+
+    return isinstance(exc, (WorkerException, BrokenProcessPool))
+
+
+class Job(object):
+    '''
+    A unit of work that has been claimed from the queue.
+    '''
+    def __init__(self, work_id, payload, date_added=None):
+        self.id = work_id
+        self.payload = payload
+        self.repo = payload.name
+        self.date_added = date_added
+
+
+class QueueBackend(object):
+    '''
+    A queue of deployment jobs, kept in some kind of datastore. The Pool, the
+    app server and the workers only talk to queues through these methods,
+    so backends can be swapped without changing them.
+
+    Jobs are 'queued' until a worker claims them, at which point they're
+    'leased' until the worker acknowledges them (or stops renewing its
+    lease, and they go back on the queue). Queued jobs are claimed in order
+    of priority, taking turns between repos that tie, and oldest first
+    within a repo. Leased jobs can be 'cancelled' by a newer push, which
+    their workers check for between steps.
+
+    Jobs that fail can be tried up to `max_attempts` times. In between, they
+    wait in the 'delayed' state, for a backoff that doubles with every
+    attempt. Jobs that fail for good are kept as dead letters, which can be
+    put back on the queue with `revive`.
+
+    Every backend has a `notifier`, for waking up consumers when new work
+    arrives.
+    '''
+    # Name that the backend goes by in connection strings
+    backend = None
+
+    # Default number of seconds that a claimed job stays invisible to others
+    lease_timeout = 900
+
+    # Whether new pushes supersede older ones for the same repo and branch
+    coalesce = False
+    cancel_running = False
+
+    # Whether to keep the full payload with each job. Builds only need the
+    # attributes in the job record.
+    store_payload = False
+
+    # Optional GroupCommit that batches writes from concurrent threads
+    committer = None
+
+    # States that a job can finish in
+    finished_states = ('succeeded', 'failed', 'cancelled')
+
+    # Number of times to try a job before giving up on it. Retries are off
+    # by default, since not every deploy script is safe to run twice.
+    max_attempts = 1
+
+    # Number of seconds to wait before the first retry, and the most to wait
+    # before any retry
+    retry_delay = 30
+    max_retry_delay = 3600
+
+    # Fields that describe a job to clients
+    job_fields = ['id', 'repo', 'owner', 'branch', 'sha', 'state', 'attempts',
+                  'date_added', 'date_started', 'date_finished', 'error']
+
+    # Fields that describe a dead letter to clients
+    dead_letter_fields = ['id', 'repo', 'owner', 'branch', 'sha', 'attempts',
+                          'date_added', 'date_failed', 'error']
+
+    def add(self, payload, coalesce=None, cancel_running=None, store_payload=None, priority=0):
+        '''
+        Package up a work payload and drop it into the queue. Returns the ID
+        of the queued work.
+        '''
+        raise NotImplementedError
+
+    def claim(self, lease_timeout=None, exclude=None):
+        '''
+        Lease the next job on the queue and return it as a `Job`, or return
+        None if there's no work. Repos named in `exclude` are skipped over.
+        '''
+        raise NotImplementedError
+
+    def ack(self, work_id, state='succeeded', error=None):
+        '''
+        Mark a claimed job as finished ('succeeded', 'failed' or 'cancelled')
+        and remove it from the queue.
+        '''
+        raise NotImplementedError
+
+    def nack(self, work_id):
+        '''
+        Give up the lease on a claimed job and return it to the queue.
+        '''
+        raise NotImplementedError
+
+    def renew(self, work_ids, lease_timeout=None):
+        '''
+        Extend the leases on jobs that are still being worked on.
+        '''
+        raise NotImplementedError
+
+    def is_cancelled(self, work_id):
+        '''
+        Check whether a claimed job has been superseded by a newer push.
+        '''
+        raise NotImplementedError
+
+    def cancel_check(self, work_id):
+        '''
+        Return a function that checks whether a claimed job has been
+        cancelled. Workers call it from the threads that run their scripts,
+        so it has to be safe to call from any thread.
+        '''
+        return lambda: self.is_cancelled(work_id)
+
+    def attempts(self, work_id):
+        '''
+        Return the number of times that a job on the queue has been claimed,
+        or None if there's no such job.
+        '''
+        raise NotImplementedError
+
+    def retry(self, work_id, not_before, error=None):
+        '''
+        Return a claimed job to the queue, to be claimed again no sooner than
+        the `not_before` timestamp.
+        '''
+        raise NotImplementedError
+
+    def bury(self, work_id, error=None):
+        '''
+        Mark a claimed job as failed, and keep it as a dead letter.
+        '''
+        raise NotImplementedError
+
+    def dead_letters(self, limit=20):
+        '''
+        Return the jobs that failed for good, most recent failure first.
+        '''
+        raise NotImplementedError
+
+    def revive(self, work_id):
+        '''
+        Put a dead letter back on the queue for another round of attempts.
+        Returns False if there's no such dead letter.
+        '''
+        raise NotImplementedError
+
+    def backoff(self, attempts):
+        '''
+        Return the number of seconds to wait before retrying a job that has
+        failed `attempts` times.
+        '''
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1))
+
+        # Spread out the retries of jobs that failed together (e.g. while
+        # GitHub was down), but never retry sooner than half the backoff
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def fail(self, work_id, error=None, retry=True):
+        '''
+        Handle a claimed job that failed. If it's worth retrying and it has
+        attempts left, it goes back on the queue after a backoff; otherwise,
+        it becomes a dead letter. Returns the number of seconds until the job
+        gets retried, or None if it won't be.
+
+        Args:
+            - work_id (string): ID of the job.
+            - error (string): Optional description of what went wrong.
+            - retry (bool): Whether the failure might go away on its own.
+        '''
+        attempts = self.attempts(work_id)
+
+        if retry and attempts is not None and attempts < self.max_attempts:
+            delay = self.backoff(attempts)
+            self.retry(work_id, time.time() + delay, error)
+            return delay
+
+        self.bury(work_id, error)
+        return None
+
+    def depth(self):
+        '''
+        Count the jobs on the queue in each state, as a dict.
+        '''
+        raise NotImplementedError
+
+    def status(self, work_id):
+        '''
+        Return the history of a job as a dict, or None if there's no such job.
+        '''
+        raise NotImplementedError
+
+    def history(self, repo=None, before=None, limit=20):
+        '''
+        Return a page of job history, newest first, and the cursor for the
+        next page. Not every backend keeps one.
+        '''
+        raise QueueException("The %s queue doesn't keep a history of jobs" % self.backend)
+
+    def check_state(self, state):
+        '''
+        Raise an error if a job can't finish in a state.
+        '''
+        if state not in self.finished_states:
+            raise QueueException('Unknown job state "%s"' % state)
+
+    def check_priority(self, priority):
+        '''
+        Raise an error if a job's priority is out of range.
+        '''
+        if abs(priority) > MAX_PRIORITY:
+            raise QueueException('Priority %d is out of range' % priority)
+
+    def make_record(self, work_id, payload, store_payload, priority):
+        '''
+        Describe a job as a dict of plain values, for backends that store
+        jobs as documents.
+        '''
+        if not isinstance(payload, Payload):
+            payload = Payload(payload)
+
+        return {
+            'id': work_id,
+            'ref': payload.ref,
+            'repo': payload.name or '',
+            'owner': payload.owner,
+            'branch': payload.get_branch() if payload.ref else '',
+            'sha': payload.sha,
+            'clone_url': payload.origin,
+            'delivery_id': payload.delivery,
+            'payload': payload.raw if store_payload else None,
+            'priority': priority,
+            'state': 'queued',
+            'attempts': 0,
+            'not_before': None,
+            'date_added': time.time(),
+            'date_started': None,
+            'date_finished': None,
+            'error': None,
+        }
+
+    def load_record(self, record):
+        '''
+        Rebuild a claimed Job from a record made by `make_record`.
+        '''
+        payload = Payload.from_record(record['ref'], record['repo'], record['owner'],
+                                      record['sha'], record['clone_url'],
+                                      record['delivery_id'])
+        payload.raw = record['payload']
+
+        return Job(record['id'], payload, date_added=record['date_added'])
+
+    def describe(self, record):
+        '''
+        Describe a job to clients, from a record made by `make_record`.
+        '''
+        return {field: record.get(field) for field in self.job_fields}
+
+    def pop(self):
+        '''
+        Return the most recent payload and remove it from the queue.
+        '''
+        job = self.claim()
+
+        if not job:
+            # No work was found in the queue
+            return None
+
+        self.ack(job.id)
+
+        return job.payload
+
+    def wait(self, timeout):
+        '''
+        Block until new work is added to the queue, or until `timeout` seconds
+        have passed. Returns True if new work may be available.
+
+        Args:
+            - timeout (float): Maximum time to block, so that callers can fall
+                               back to polling if a notification is lost.
+        '''
+        return self.notifier.wait(timeout)
+
+    def close(self):
+        '''
+        Release the queue's resources.
+        '''
+        self.notifier.close()
+
+    def run(self):
+        '''
+        Check for work on the queue, and if it exists, deploy it.
+        '''
+        job = self.claim()
+
+        if job:
+            try:
+                worker = Worker(job.payload,
+                                cancelled=self.cancel_check(job.id),
+                                job_id=job.id)
+
+                if job.date_added:
+                    worker.metrics.observe('bunny_hook_queue_wait_seconds',
+                                           time.time() - job.date_added)
+
+                worker.deploy()
+            except CancelledException as e:
+                self.ack(job.id, 'cancelled', str(e))
+                raise
+            except Exception as e:
+                self.fail(job.id, str(e), retry=is_transient(e))
+                raise
+
+            self.ack(job.id)
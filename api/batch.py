@@ -0,0 +1,179 @@
+# batch.py -- share transactions between concurrent writes to the datastore
+import sqlite3
+import threading
+import time
+from collections import deque
+
+
+class Request(object):
+    '''
+    A write that is waiting to be committed.
+    '''
+    def __init__(self, write):
+        self.write = write
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommit(object):
+    '''
+    Commit writes from many threads in shared transactions.
+
+    Every commit to SQLite costs an fsync and a trip through the write lock,
+    so a burst of webhooks committing one at a time spends most of its time
+    waiting on the disk. Instead, writers hand their work to a single
+    committer thread, which runs everything that arrives within `window`
+    seconds (up to `batch_size` writes) in one transaction. Each write gets
+    its own savepoint, so one failing write doesn't roll back the others.
+    Writers block until their transaction is durable.
+    '''
+    # Seconds to wait for more writes after the first one in a batch arrives
+    window = 0.005
+
+    # Maximum number of writes that share a transaction
+    batch_size = 64
+
+    def __init__(self, db_conn, window=None, batch_size=None):
+        '''
+        Open a connection for the committer thread and start it up.
+
+        Args:
+            - db_conn (string): SQLite connection string.
+            - window (float): Optional number of seconds to collect writes for.
+            - batch_size (int): Optional maximum number of writes per batch.
+        '''
+        if window is not None:
+            self.window = window
+
+        if batch_size:
+            self.batch_size = batch_size
+
+        self.db_conn = db_conn
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        # Number of transactions committed, for monitoring
+        self.batches = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, write):
+        '''
+        Run a write in the next shared transaction and return its result once
+        the transaction commits. Exceptions raised by the write (or by the
+        commit) are raised here.
+
+        Args:
+            - write (callable): Function that takes a cursor and performs
+                                the write.
+        '''
+        request = Request(write)
+
+        with self.condition:
+            self.pending.append(request)
+            self.condition.notify()
+
+        request.done.wait()
+
+        if request.error:
+            raise request.error
+
+        return request.result
+
+    def collect(self):
+        '''
+        Wait for writes, and return the next batch of them.
+        '''
+        with self.condition:
+            while not self.pending and not self.stopped:
+                self.condition.wait()
+
+            deadline = time.time() + self.window
+
+            while len(self.pending) < self.batch_size and not self.stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = []
+            while self.pending and len(batch) < self.batch_size:
+                batch.append(self.pending.popleft())
+
+        return batch
+
+    def commit(self, cursor, batch):
+        '''
+        Run a batch of writes in one transaction.
+        '''
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+
+            for request in batch:
+                cursor.execute('SAVEPOINT write')
+                try:
+                    request.result = request.write(cursor)
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write')
+                    request.error = e
+                cursor.execute('RELEASE write')
+
+            cursor.execute('COMMIT')
+            self.batches += 1
+        except Exception as e:
+            if cursor.connection.in_transaction:
+                cursor.execute('ROLLBACK')
+
+            for request in batch:
+                request.error = request.error or e
+        finally:
+            for request in batch:
+                request.done.set()
+
+    def run(self):
+        '''
+        Commit batches of writes until the committer is closed.
+        '''
+        conn = sqlite3.connect(self.db_conn, isolation_level=None)
+        cursor = conn.cursor()
+
+        while True:
+            batch = self.collect()
+
+            if batch:
+                self.commit(cursor, batch)
+            elif self.stopped:
+                break
+
+        conn.close()
+
+    def close(self):
+        '''
+        Commit any outstanding writes and stop the committer thread.
+        '''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        self.thread.join()
+
+
+# Committers are shared by every thread in the process that writes to the
+# same datastore, since that's what lets their writes share transactions
+_committers = {}
+_committers_lock = threading.Lock()
+
+
+def get_committer(db_conn):
+    '''
+    Return the process-wide GroupCommit for a datastore, starting it up if
+    it isn't running yet.
+    '''
+    with _committers_lock:
+        if db_conn not in _committers:
+            _committers[db_conn] = GroupCommit(db_conn)
+
+        return _committers[db_conn]
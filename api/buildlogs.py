@@ -0,0 +1,185 @@
+# buildlogs.py -- per-job logs of build output
+import os
+import re
+import gzip
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from api.watchdog import Watchdog
+
+# Job IDs are uuids; anything else could be a path
+JOB_ID = re.compile(r'^[0-9a-fA-F-]+$')
+
+
+def log_dir(tmp=None):
+    '''
+    Return the directory that build logs are kept in, under the server's
+    `tmp` directory.
+    '''
+    return os.path.join(tmp or tempfile.gettempdir(), 'bunny-hook', 'logs')
+
+
+def log_paths(directory, job_id):
+    '''
+    Return the paths that a job's log can be found at: while the job is
+    running, once it's finished, and once it's been compressed.
+    '''
+    base = os.path.join(directory, job_id)
+    return base + '.running.log', base + '.log', base + '.log.gz'
+
+
+class BuildLog(object):
+    '''
+    Collect the output of every command a job runs into one log file.
+
+    Output is read from each command's pipe in fixed-size chunks and written
+    straight to disk, so memory use doesn't grow with the size of the build.
+    The log is kept at `<id>.running.log` while the job runs, and moves to
+    `<id>.log` (or `<id>.log.gz`, if compressed) once it finishes, so that
+    readers can tell when there's nothing more to come.
+    '''
+    # Size of the chunks that output is read in
+    chunk_size = 64 * 1024
+
+    def __init__(self, directory, job_id):
+        '''
+        Open the log for a job.
+
+        Args:
+            - directory (string): Directory to keep logs in.
+            - job_id (string): ID of the job on the queue.
+        '''
+        os.makedirs(directory, exist_ok=True)
+
+        self.running_path, self.path, self.gz_path = log_paths(directory, job_id)
+        self.log_file = open(self.running_path, 'ab')
+
+        # Steps can run commands in parallel
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        '''
+        Append bytes to the log, flushing them so that followers see them.
+        '''
+        with self.lock:
+            self.log_file.write(data)
+            self.log_file.flush()
+
+    def run(self, cmd, capture=False, timeout=None):
+        '''
+        Run a command, streaming its output into the log. If `capture` is set,
+        stdout is returned in the result instead (for short outputs, like
+        shas), and only stderr goes to the log. If the command runs for more
+        than `timeout` seconds, it gets killed along with everything it
+        started.
+
+        Raises CalledProcessError if the command fails and TimeoutExpired if
+        it times out, like `subprocess.run`.
+        '''
+        self.write(('$ %s\n' % ' '.join(cmd)).encode('utf-8'))
+
+        stdout = None
+
+        if capture:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    start_new_session=True)
+
+            with Watchdog(proc, timeout) as watchdog:
+                out, err = proc.communicate()
+
+            self.write(err)
+            stdout = out.decode('utf-8', 'replace')
+
+        else:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+
+            with Watchdog(proc, timeout) as watchdog, proc.stdout:
+                for chunk in iter(lambda: proc.stdout.read1(self.chunk_size), b''):
+                    self.write(chunk)
+
+                proc.wait()
+
+        if watchdog.expired:
+            self.write(('Timed out after %.0f seconds\n' % timeout).encode('utf-8'))
+            raise subprocess.TimeoutExpired(cmd, timeout)
+
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+        return subprocess.CompletedProcess(cmd, proc.returncode, stdout=stdout)
+
+    def close(self, compress=False):
+        '''
+        Mark the log as finished, optionally compressing it.
+        '''
+        with self.lock:
+            self.log_file.close()
+
+        if compress:
+            with open(self.running_path, 'rb') as src, gzip.open(self.gz_path + '.tmp', 'wb') as dest:
+                shutil.copyfileobj(src, dest, self.chunk_size)
+
+            os.replace(self.gz_path + '.tmp', self.gz_path)
+            os.remove(self.running_path)
+
+        else:
+            os.replace(self.running_path, self.path)
+
+
+def read_log(directory, job_id, follow=False, poll=0.5, timeout=3600, chunk_size=64 * 1024):
+    '''
+    Yield the contents of a job's log in chunks, without reading the whole
+    file into memory. With `follow`, keep yielding new output until the job
+    finishes (or nothing new has shown up for `timeout` seconds).
+
+    Returns None if there's no log for the job.
+    '''
+    if not JOB_ID.match(job_id):
+        return None
+
+    for path in log_paths(directory, job_id):
+        try:
+            log_file = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+        except FileNotFoundError:
+            continue
+
+        running_path = log_paths(directory, job_id)[0]
+        return tail(log_file, running_path if follow else None, poll, timeout, chunk_size)
+
+    return None
+
+
+def tail(log_file, running_path, poll, timeout, chunk_size):
+    '''
+    Yield chunks from an open log file. If `running_path` is given, wait for
+    more output for as long as the job is still running.
+    '''
+    with log_file:
+        idle = 0
+
+        while True:
+            chunk = log_file.read(chunk_size)
+
+            if chunk:
+                idle = 0
+                yield chunk
+                continue
+
+            if not running_path:
+                return
+
+            # The log moves once the job finishes; the open file still has
+            # everything that was written, so read it to the end first
+            if not os.path.exists(running_path):
+                running_path = None
+                continue
+
+            if idle >= timeout:
+                return
+
+            time.sleep(poll)
+            idle += poll
@@ -0,0 +1,314 @@
+# cache.py -- a content-addressed cache of build outputs
+import os
+import glob
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from api.exceptions import ConfigException
+
+
+class BuildCache(object):
+    '''
+    Skip build steps whose inputs haven't changed, by restoring the outputs
+    they produced last time.
+
+    A step's key is a hash of its script and the contents of every file its
+    `inputs` globs match. Output files are stored once per distinct content
+    under `objects/`, and each key gets a manifest under `entries/` listing
+    the files to restore. When the objects outgrow `budget` bytes, the least
+    recently used entries are dropped, along with any objects that no entry
+    needs any more.
+    '''
+    # Default directory to keep the cache in
+    root = os.path.join(tempfile.gettempdir(), 'bunny-hook', 'cache')
+
+    # Default size of the cache, in bytes
+    budget = 5 * 1024 ** 3
+
+    # Size of the chunks that files get hashed in
+    chunk_size = 1024 * 1024
+
+    def __init__(self, root=None, budget=None):
+        '''
+        Initialize the cache.
+
+        Args:
+            - root (string): Optional directory to keep the cache in.
+            - budget (int): Optional maximum size of the cache, in bytes.
+        '''
+        if root:
+            self.root = root
+
+        if budget:
+            self.budget = budget
+
+        self.objects = os.path.join(self.root, 'objects')
+        self.entries = os.path.join(self.root, 'entries')
+
+    def hash_file(self, path):
+        '''
+        Return the sha256 of a file's contents.
+        '''
+        digest = hashlib.sha256()
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def resolve(self, clone_path, path):
+        '''
+        Return the absolute path of a file in a home directory, refusing paths
+        that point outside of it.
+        '''
+        home = os.path.abspath(clone_path)
+        full_path = os.path.abspath(os.path.join(home, path))
+
+        if os.path.commonpath([home, full_path]) != home:
+            raise ConfigException('Build cache path %s is outside of %s' % (path, clone_path))
+
+        return full_path
+
+    def key(self, clone_path, step, home=None):
+        '''
+        Return the cache key for a step: a hash of the step's script, the home
+        directory it runs in, and the paths and contents of its inputs.
+
+        Args:
+            - clone_path (string): Directory that the step runs in.
+            - step (Step): The step.
+            - home (string): Optional directory to key the step by, if it runs
+                             somewhere that changes with every deploy (like a
+                             release directory). Defaults to `clone_path`.
+        '''
+        root = os.path.abspath(clone_path)
+        home = os.path.abspath(home or clone_path)
+        digest = hashlib.sha256()
+
+        script_path = self.resolve(root, step.script)
+        digest.update(('script\0%s\0%s\0%s\0' % (home, step.script,
+                                                 self.hash_file(script_path))).encode('utf-8'))
+
+        files = set()
+        for pattern in step.inputs:
+            for path in glob.glob(self.resolve(root, pattern), recursive=True):
+                if os.path.isfile(path):
+                    files.add(os.path.relpath(path, root))
+
+        for path in sorted(files):
+            file_hash = self.hash_file(os.path.join(root, path))
+            digest.update(('input\0%s\0%s\0' % (path, file_hash)).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def object_path(self, file_hash):
+        return os.path.join(self.objects, file_hash[:2], file_hash)
+
+    def entry_path(self, key):
+        return os.path.join(self.entries, key + '.json')
+
+    def restore(self, key, clone_path, outputs):
+        '''
+        Put the outputs stored for a key back into a home directory. Returns
+        False on a cache miss.
+        '''
+        try:
+            with open(self.entry_path(key)) as entry:
+                manifest = json.load(entry)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        # Check that every object is still there before touching the outputs
+        if not all(os.path.exists(self.object_path(file_hash))
+                   for _, file_hash, _ in manifest['files']):
+            return False
+
+        for output in outputs:
+            self.remove(self.resolve(clone_path, output))
+
+        for path, file_hash, mode in manifest['files']:
+            dest = self.resolve(clone_path, path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+            try:
+                shutil.copyfile(self.object_path(file_hash), dest)
+            except FileNotFoundError:
+                # Evicted out from under us; let the step rebuild its outputs
+                return False
+
+            os.chmod(dest, mode)
+
+        for path in manifest.get('dirs', []):
+            os.makedirs(self.resolve(clone_path, path), exist_ok=True)
+
+        # Record when the entry was last used, for eviction
+        os.utime(self.entry_path(key))
+
+        return True
+
+    def save(self, key, clone_path, outputs):
+        '''
+        Store the outputs of a step under its key.
+        '''
+        home = os.path.abspath(clone_path)
+        files = []
+        dirs = []
+
+        for output in outputs:
+            path = self.resolve(home, output)
+
+            if os.path.isfile(path):
+                files.append(path)
+            elif os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirs += [os.path.join(dirpath, name) for name in dirnames]
+                    files += [os.path.join(dirpath, name) for name in filenames]
+                dirs.append(path)
+            else:
+                logging.warning('Not caching step outputs: %s was not created' % output)
+                return
+
+        manifest = {'files': [], 'dirs': sorted(os.path.relpath(d, home) for d in dirs)}
+
+        for path in files + dirs:
+            if os.path.islink(path):
+                logging.warning('Not caching step outputs: %s is a symlink' % path)
+                return
+
+        for path in files:
+            file_hash = self.hash_file(path)
+            self.store(path, file_hash)
+
+            mode = os.stat(path).st_mode & 0o7777
+            manifest['files'].append([os.path.relpath(path, home), file_hash, mode])
+
+        self.write(self.entry_path(key), json.dumps(manifest).encode('utf-8'))
+        self.evict(keep=key)
+
+    def store(self, path, file_hash):
+        '''
+        Copy a file into the object store, unless an object with the same
+        contents is already there.
+        '''
+        object_path = self.object_path(file_hash)
+
+        if not os.path.exists(object_path):
+            with open(path, 'rb') as f:
+                self.write(object_path, f)
+
+    def write(self, dest, data):
+        '''
+        Write bytes (or the contents of a file object) to a path atomically,
+        so that readers never see a half-written file.
+        '''
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.tmp-')
+
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                if isinstance(data, bytes):
+                    tmp_file.write(data)
+                else:
+                    shutil.copyfileobj(data, tmp_file)
+
+            os.replace(tmp_path, dest)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def remove(self, path):
+        '''
+        Remove a file or directory, if it exists.
+        '''
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    def evict(self, keep=None):
+        '''
+        Drop the least recently used entries until the objects that are left
+        fit in the budget, then remove the objects no entry refers to.
+
+        Args:
+            - keep (string): Optional key that should never be dropped (e.g.
+                             the one that was just saved).
+        '''
+        os.makedirs(self.root, exist_ok=True)
+
+        with open(os.path.join(self.root, 'evict.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Someone else is already evicting
+                return
+
+            entries = []
+
+            for name in os.listdir(self.entries):
+                if not name.endswith('.json'):
+                    continue
+
+                path = os.path.join(self.entries, name)
+
+                try:
+                    used = os.path.getmtime(path)
+                    with open(path) as entry:
+                        hashes = {file_hash for _, file_hash, _ in json.load(entry)['files']}
+                except (FileNotFoundError, ValueError):
+                    continue
+
+                entries.append((used, name[:-len('.json')], hashes))
+
+            sizes = {}
+            for dirpath, _, filenames in os.walk(self.objects):
+                for filename in filenames:
+                    # Skip objects that are still being written
+                    if filename.startswith('.'):
+                        continue
+
+                    try:
+                        sizes[filename] = os.path.getsize(os.path.join(dirpath, filename))
+                    except FileNotFoundError:
+                        pass
+
+            if sum(sizes.values()) <= self.budget:
+                return
+
+            entries.sort(key=lambda entry: entry[0])
+            referenced = {}
+            for _, _, hashes in entries:
+                for file_hash in hashes:
+                    referenced[file_hash] = referenced.get(file_hash, 0) + 1
+
+            total = sum(sizes.get(file_hash, 0) for file_hash in referenced)
+
+            for used, key, hashes in entries:
+                if total <= self.budget:
+                    break
+
+                if key == keep:
+                    continue
+
+                logging.info('Evicting build cache entry %s...' % key)
+                os.remove(self.entry_path(key))
+
+                for file_hash in hashes:
+                    referenced[file_hash] -= 1
+
+                    if not referenced[file_hash]:
+                        del referenced[file_hash]
+                        total -= sizes.get(file_hash, 0)
+
+            # Sweep up objects that nothing refers to any more
+            for file_hash in sizes:
+                if file_hash not in referenced:
+                    try:
+                        os.remove(self.object_path(file_hash))
+                    except FileNotFoundError:
+                        pass
@@ -15,8 +15,37 @@ class WorkerException(Exception):
     pass
 
 
+class CancelledException(WorkerException):
+    '''
+    The job was cancelled while the worker was running it.
+    '''
+    pass
+
+
+class TimeoutException(WorkerException):
+    '''
+    A command or a whole deployment ran past its time limit.
+    '''
+    pass
+
+
+class ConfigException(WorkerException):
+    '''
+    A config file is missing or invalid.
+    '''
+    pass
+
+
 class QueueException(Exception):
     '''
     Something went wrong in the queue process.
     '''
     pass
+
+
+class QueueUnavailable(QueueException):
+    '''
+    The queue's datastore couldn't be written to (e.g. it was locked, or the
+    disk was full).
+    '''
+    pass
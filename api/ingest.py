@@ -0,0 +1,109 @@
+# ingest.py -- accept payloads from GitHub and queue them up
+from fnmatch import fnmatchcase
+
+from api.queue import get_queue
+from api.payload import Payload
+
+
+def check_payload(payload_json, branch_name):
+    '''
+    Decide whether a payload should be queued. Returns a tuple of the HTTP
+    status code and status message to respond with: 202 if the payload should
+    be queued, and 400 if not.
+
+    Arguments:
+        - payload_json (dict)  -> POST request information received from GitHub
+        - branch_name (string) -> Name of the branch that was POSTed to
+    '''
+    if not isinstance(payload_json, dict):
+        return 400, 'Malformed request payload: {payload}'.format(payload=payload_json)
+
+    payload = Payload(payload_json)
+
+    if payload.validate(branch_name):
+        # This branch is approved for builds
+        status = 'Build started for ref %s of repo %s' % (payload.ref, payload.name)
+        return 202, status
+
+    # Branch not approved; nothing to do
+    if payload.ref:
+        status = 'Skipping build for unregistered branch "{ref}"'.format(ref=payload.ref)
+    else:
+        status = 'Malformed request payload: {payload}'.format(payload=payload.as_dict)
+
+    return 400, status
+
+
+def select_tokens(payload_json, tokens, repo_tokens):
+    '''
+    Return the secret tokens that a payload could have been signed with. If
+    the payload's repo is registered with its own token, that's the only
+    candidate; otherwise, every token is.
+
+    Arguments:
+        - payload_json (dict) -> POST request information received from GitHub
+        - tokens (list)       -> Every registered secret token
+        - repo_tokens (dict)  -> Map of repo names to their own tokens
+    '''
+    repository = payload_json.get('repository') if isinstance(payload_json, dict) else None
+
+    if repo_tokens and isinstance(repository, dict):
+        for name in (repository.get('full_name'), repository.get('name')):
+            if name in repo_tokens:
+                return [repo_tokens[name]]
+
+    return tokens
+
+
+def get_priority(payload, rules):
+    '''
+    Return the priority for a payload's job: the `priority` of the first
+    rule that matches it, or 0 if none do. Rules can match a `repo` (by name
+    or "owner/name") and a `branch` (which can be a glob, like "hotfix/*").
+
+    Arguments:
+        - payload (Payload) -> The payload to be queued
+        - rules (list)      -> Priority rules, from the server config
+    '''
+    # Match against the whole branch name, slashes and all
+    ref = payload.ref or ''
+    if ref.startswith('refs/heads/'):
+        branch = ref[len('refs/heads/'):]
+    else:
+        branch = payload.get_branch() if ref else ''
+
+    repos = (payload.name, '%s/%s' % (payload.owner, payload.name))
+
+    for rule in rules or []:
+        if 'repo' in rule and rule['repo'] not in repos:
+            continue
+
+        if 'branch' in rule and not fnmatchcase(branch, rule['branch']):
+            continue
+
+        return rule['priority']
+
+    return 0
+
+
+def enqueue(config, payload_json, delivery=None):
+    '''
+    Add a payload to the queue, using the queue settings from the app config.
+    Returns the ID of the queued work.
+
+    Arguments:
+        - config (dict)       -> App config
+        - payload_json (dict) -> Payload that passed `check_payload`
+        - delivery (str)      -> ID of the delivery, from the X-GitHub-Delivery
+                                 header
+    '''
+    queue = get_queue(config.get('QUEUE_DB'),
+                      group_commit=config.get('GROUP_COMMIT'))
+
+    payload = Payload(payload_json, delivery)
+
+    return queue.add(payload,
+                     coalesce=config.get('COALESCE'),
+                     cancel_running=config.get('COALESCE_CANCEL_RUNNING'),
+                     store_payload=config.get('STORE_PAYLOAD'),
+                     priority=get_priority(payload, config.get('PRIORITIES')))
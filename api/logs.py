@@ -0,0 +1,83 @@
+# logs.py -- structured logging for requests to the app
+import sys
+import json
+import logging
+import logging.handlers
+from queue import Queue
+
+# Logger for request/response cycles. It doesn't propagate to the root logger,
+# so nothing gets formatted unless request logging is turned on.
+logger = logging.getLogger('api.requests')
+logger.propagate = False
+
+
+class JSONFormatter(logging.Formatter):
+    '''
+    Format log records as JSON lines. Structured data goes in the `fields`
+    attribute of the record (pass it with `extra={'fields': {...}}`).
+    '''
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+
+        return json.dumps(entry, default=str)
+
+
+def describe_request(request, resp, status_code, payload='truncate', max_bytes=1024):
+    '''
+    Collect the fields that get logged for a request/response cycle.
+
+    Arguments:
+        - request (Request) -> Flask Request object
+        - resp (dict)       -> JSON that was returned
+        - status_code (int) -> HTTP status code
+        - payload (str)     -> How much of the request body to log: 'full',
+                               'truncate' (to `max_bytes`), or 'off'
+        - max_bytes (int)   -> Maximum length of truncated payloads
+    '''
+    fields = {
+        'method': request.method,
+        'path': request.path,
+        'status_code': status_code,
+        'response': resp,
+        'headers': dict(request.headers),
+    }
+
+    if payload != 'off':
+        body = request.get_data(cache=True)
+
+        if payload == 'truncate' and len(body) > max_bytes:
+            fields['payload_truncated'] = True
+            body = body[:max_bytes]
+
+        fields['payload'] = body.decode('utf-8', 'replace')
+
+    return fields
+
+
+def log_requests(stream=None, level=logging.DEBUG):
+    '''
+    Turn on request logging. Records are handed off to a background thread
+    through a queue, so requests never wait on formatting or on the stream.
+    Returns the QueueListener, which should be stopped at exit to flush any
+    records that are still waiting.
+
+    Arguments:
+        - stream (file) -> Where to write JSON lines (defaults to stdout)
+        - level (int)   -> Minimum level to log
+    '''
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JSONFormatter())
+
+    records = Queue(-1)
+    listener = logging.handlers.QueueListener(records, handler)
+
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level)
+
+    listener.start()
+    return listener
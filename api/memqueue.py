@@ -0,0 +1,512 @@
+# memqueue.py -- a queue that lives in memory, for tests and benchmarks
+import time
+import heapq
+import itertools
+import threading
+from uuid import uuid4
+from collections import Counter, OrderedDict
+
+from api.backends import QueueBackend
+from api.notify import Notifier
+
+# Queues with the same name share their jobs, the way that queues with the
+# same SQLite connection string share a database
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class Store(object):
+    '''
+    The jobs of a memory queue, and the lock that guards them.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Jobs on the queue, by ID, with their states and leases
+        self.queue = OrderedDict()
+
+        # Queued jobs for each repo, as a heap in the order they'll be
+        # claimed in. Entries for jobs that have left the queued state are
+        # skipped over when they reach the top.
+        self.heaps = {}
+
+        # IDs of jobs with leases (leased or cancelled)
+        self.leased = set()
+
+        # IDs of jobs waiting to be retried
+        self.delayed = set()
+
+        # Jobs that failed for good, by ID, in the order they failed
+        self.dead = OrderedDict()
+
+        # History of every job, by ID, in the order they were added
+        self.jobs = OrderedDict()
+
+        # Repos that have had jobs queued, mapped to when they last had a job
+        # claimed and the order they first showed up in
+        self.repos = {}
+        self.arrivals = itertools.count()
+
+        self.seq = 0
+
+
+def get_store(name):
+    '''
+    Return the Store for a memory queue, creating it if it doesn't exist.
+    '''
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = Store()
+
+        return _stores[name]
+
+
+def drop_store(name):
+    '''
+    Throw away every job in a memory queue.
+    '''
+    with _stores_lock:
+        _stores.pop(name, None)
+
+
+class MemoryQueue(QueueBackend):
+    '''
+    A queue of deployment jobs kept in memory. It behaves like the SQLite
+    queue (priorities, taking turns between repos, coalescing, leases,
+    retries and job history), but its jobs are only visible within a single
+    process, and are gone once it exits. Use it for tests and benchmarks, or
+    for running the app server and the build queue in the same process.
+
+    Connection strings look like `memory:<name>`.
+    '''
+    backend = 'memory'
+
+    # Default connection string
+    db_conn = 'memory:'
+
+    # Number of days to keep the history of finished jobs
+    history_days = 30
+
+    # Minimum number of seconds between prunes of the job history
+    prune_interval = 3600
+
+    def __init__(self, db_conn=None, lease_timeout=None, create=True):
+        '''
+        Attach to a queue in memory, creating it if it doesn't exist.
+
+        Args:
+            - db_conn (string): Optional connection string, `memory:<name>`.
+            - lease_timeout (int): Optional number of seconds before a claimed
+                                   job gets returned to the queue.
+            - create (bool): Unused, since there's no schema to set up.
+        '''
+        if db_conn:
+            self.db_conn = db_conn
+
+        if lease_timeout:
+            self.lease_timeout = lease_timeout
+
+        self.store = get_store(self.db_conn.partition(':')[2])
+        self.last_pruned = 0
+
+        # Channel for waking up consumers when new work arrives
+        self.notifier = Notifier(self.db_conn)
+
+    def add(self, payload, coalesce=None, cancel_running=None, store_payload=None, priority=0):
+        '''
+        Package up a work payload and drop it into the queue. Returns the ID
+        of the queued work.
+
+        Args:
+            - payload (Payload): An event from the GitHub API, either parsed
+                                 or as a dict.
+            - coalesce (bool): Optionally override whether this job replaces
+                               queued jobs for the same repo and branch.
+            - cancel_running (bool): Optionally override whether this job
+                                     cancels running jobs for the same repo
+                                     and branch, when coalescing.
+            - store_payload (bool): Optionally override whether to keep the
+                                    full payload.
+            - priority (int): Jobs with higher priorities get claimed first.
+        '''
+        if coalesce is None:
+            coalesce = self.coalesce
+
+        if cancel_running is None:
+            cancel_running = self.cancel_running
+
+        if store_payload is None:
+            store_payload = self.store_payload
+
+        self.check_priority(priority)
+        record = self.make_record(str(uuid4()), payload, store_payload, priority)
+        record['lease_expires'] = None
+
+        with self.store.lock:
+            if coalesce:
+                self.supersede(record, cancel_running)
+
+            self.store.seq += 1
+            job = self.describe(record)
+            job['seq'] = self.store.seq
+
+            self.store.queue[record['id']] = record
+            self.store.jobs[record['id']] = job
+            self.store.repos.setdefault(record['repo'], [0, next(self.store.arrivals)])
+            self.push(record)
+
+        self.notifier.notify()
+
+        return record['id']
+
+    def push(self, record):
+        '''
+        Put a job in line for its repo. Callers must hold the store's lock.
+        '''
+        entry = (-record['priority'], record['date_added'], record['id'])
+        heapq.heappush(self.store.heaps.setdefault(record['repo'], []), entry)
+
+    def waiting(self, work_id):
+        '''
+        Check whether a job is still queued. Callers must hold the store's lock.
+        '''
+        record = self.store.queue.get(work_id)
+
+        return bool(record) and record['state'] == 'queued'
+
+    def supersede(self, record, cancel_running=False):
+        '''
+        Drop queued jobs for the same repo and branch as a new job, and
+        optionally cancel running ones. Callers must hold the store's lock.
+        '''
+        now = time.time()
+        key = (record['repo'], record['branch'], record['owner'])
+
+        def matches(work_id):
+            other = self.store.queue.get(work_id)
+            return other and (other['repo'], other['branch'], other['owner']) == key
+
+        for _, _, work_id in self.store.heaps.get(record['repo'], []):
+            if self.waiting(work_id) and matches(work_id):
+                del self.store.queue[work_id]
+                self.store.jobs[work_id].update(state='cancelled', date_finished=now)
+
+        for work_id in list(self.store.delayed):
+            if matches(work_id):
+                self.store.delayed.discard(work_id)
+                del self.store.queue[work_id]
+                self.store.jobs[work_id].update(state='cancelled', date_finished=now)
+
+        if cancel_running:
+            for work_id in self.store.leased:
+                if matches(work_id):
+                    # Running jobs are recorded as cancelled once their
+                    # workers stop
+                    self.store.queue[work_id]['state'] = 'cancelled'
+
+    def expire(self, now):
+        '''
+        Queue up jobs that are due to be retried, return jobs whose workers
+        stopped renewing their leases, and clean up cancelled jobs whose
+        workers have gone away. Callers must hold the store's lock.
+        '''
+        for work_id in list(self.store.delayed):
+            record = self.store.queue[work_id]
+
+            if record['not_before'] <= now:
+                self.store.delayed.discard(work_id)
+                record.update(state='queued', not_before=None)
+                self.push(record)
+
+        for work_id in list(self.store.leased):
+            record = self.store.queue[work_id]
+
+            if record['lease_expires'] >= now:
+                continue
+
+            self.store.leased.discard(work_id)
+
+            if record['state'] == 'leased':
+                record.update(state='queued', lease_expires=None)
+                self.store.jobs[work_id].update(state='queued', date_started=None)
+                self.push(record)
+
+            elif record['state'] == 'cancelled':
+                del self.store.queue[work_id]
+                self.store.jobs[work_id].update(state='cancelled', date_finished=now)
+
+    def claim(self, lease_timeout=None, exclude=None):
+        '''
+        Lease the next job on the queue and return it as a `Job`, or return
+        None if there's no work. Jobs are picked in the same order as the
+        SQLite queue picks them.
+
+        Args:
+            - lease_timeout (int): Optional number of seconds to lease the job
+                                   for, if it should differ from the default.
+            - exclude (list): Optional names of repos to skip over.
+        '''
+        now = time.time()
+        expires = now + (lease_timeout or self.lease_timeout)
+        exclude = set(exclude or [])
+
+        with self.store.lock:
+            self.expire(now)
+
+            # Pick the repo with the most urgent job, or if there's a tie,
+            # the one that has waited longest for a turn
+            turn = None
+            for repo, heap in self.store.heaps.items():
+                if repo in exclude:
+                    continue
+
+                while heap and not self.waiting(heap[0][2]):
+                    heapq.heappop(heap)
+
+                if heap:
+                    rank = (heap[0][0],) + tuple(self.store.repos[repo])
+
+                    if turn is None or rank < turn[0]:
+                        turn = (rank, repo)
+
+            if turn is None:
+                return None
+
+            repo = turn[1]
+            record = self.store.queue[heapq.heappop(self.store.heaps[repo])[2]]
+
+            # Send the repo to the back of the line
+            self.store.repos[repo][0] = now
+
+            record.update(state='leased', lease_expires=expires,
+                          attempts=record['attempts'] + 1)
+            self.store.leased.add(record['id'])
+            self.store.jobs[record['id']].update(state='running', date_started=now,
+                                                attempts=record['attempts'])
+
+            return self.load_record(record)
+
+    def is_cancelled(self, work_id):
+        '''
+        Check whether a claimed job has been superseded by a newer push.
+        '''
+        record = self.store.queue.get(work_id)
+
+        return bool(record) and record['state'] == 'cancelled'
+
+    def attempts(self, work_id):
+        '''
+        Return the number of times that a job on the queue has been claimed,
+        or None if there's no such job.
+        '''
+        record = self.store.queue.get(work_id)
+
+        return record['attempts'] if record else None
+
+    def renew(self, work_ids, lease_timeout=None):
+        '''
+        Extend the leases on jobs that are still being worked on, including
+        ones that were cancelled while running.
+        '''
+        expires = time.time() + (lease_timeout or self.lease_timeout)
+
+        with self.store.lock:
+            for work_id in work_ids:
+                record = self.store.queue.get(work_id)
+
+                if record and work_id in self.store.leased:
+                    record['lease_expires'] = expires
+
+    def ack(self, work_id, state='succeeded', error=None):
+        '''
+        Mark a claimed job as finished and remove it from the queue.
+
+        Args:
+            - work_id (string): ID of the job.
+            - state (string): How the job finished: 'succeeded', 'failed'
+                              or 'cancelled'.
+            - error (string): Optional description of what went wrong.
+        '''
+        self.check_state(state)
+
+        with self.store.lock:
+            self.store.queue.pop(work_id, None)
+            self.store.leased.discard(work_id)
+            self.store.delayed.discard(work_id)
+
+            if work_id in self.store.jobs:
+                self.store.jobs[work_id].update(state=state, date_finished=time.time(),
+                                                error=error)
+
+        self.prune()
+
+    def nack(self, work_id):
+        '''
+        Give up the lease on a claimed job and return it to the queue.
+        '''
+        with self.store.lock:
+            record = self.store.queue.get(work_id)
+
+            if record and work_id in self.store.leased:
+                self.store.leased.discard(work_id)
+                record.update(state='queued', lease_expires=None)
+                self.store.jobs[work_id].update(state='queued', date_started=None)
+                self.push(record)
+
+        self.notifier.notify()
+
+    def retry(self, work_id, not_before, error=None):
+        '''
+        Return a claimed job to the queue, to be claimed again no sooner than
+        the `not_before` timestamp.
+
+        Args:
+            - work_id (string): ID of the job.
+            - not_before (float): Timestamp to wait until.
+            - error (string): Optional description of what went wrong on the
+                              last attempt.
+        '''
+        with self.store.lock:
+            record = self.store.queue.get(work_id)
+
+            if record:
+                self.store.leased.discard(work_id)
+                self.store.delayed.add(work_id)
+                record.update(state='delayed', lease_expires=None, not_before=not_before)
+                self.store.jobs[work_id].update(state='queued', date_started=None, error=error)
+
+    def bury(self, work_id, error=None):
+        '''
+        Mark a claimed job as failed and move it from the queue to the dead
+        letters.
+
+        Args:
+            - work_id (string): ID of the job.
+            - error (string): Optional description of what went wrong.
+        '''
+        now = time.time()
+
+        with self.store.lock:
+            record = self.store.queue.pop(work_id, None)
+            self.store.leased.discard(work_id)
+
+            if record:
+                record.update(date_failed=now, error=error)
+                self.store.dead[work_id] = record
+
+            if work_id in self.store.jobs:
+                self.store.jobs[work_id].update(state='failed', date_finished=now, error=error)
+
+        self.prune()
+
+    def dead_letters(self, limit=20):
+        '''
+        Return the jobs that failed for good (as dicts), most recent failure
+        first.
+        '''
+        with self.store.lock:
+            dead = list(reversed(self.store.dead.values()))[:limit]
+
+        return [{field: record[field] for field in self.dead_letter_fields}
+                for record in dead]
+
+    def revive(self, work_id):
+        '''
+        Put a dead letter back on the queue, under its old ID, for another
+        round of attempts. Returns False if there's no such dead letter.
+        '''
+        now = time.time()
+
+        with self.store.lock:
+            record = self.store.dead.pop(work_id, None)
+
+            if not record:
+                return False
+
+            record = dict(record, state='queued', attempts=0, date_added=now,
+                          lease_expires=None, not_before=None, error=None)
+            del record['date_failed']
+
+            self.store.queue[work_id] = record
+            self.store.repos.setdefault(record['repo'], [0, next(self.store.arrivals)])
+            self.push(record)
+
+            job = self.store.jobs.get(work_id)
+            if not job:
+                self.store.seq += 1
+                job = self.store.jobs[work_id] = dict(self.describe(record), seq=self.store.seq)
+
+            job.update(state='queued', attempts=0, date_added=now, date_started=None,
+                       date_finished=None, error=None)
+
+        self.notifier.notify()
+
+        return True
+
+    def prune(self, force=False):
+        '''
+        Remove the history of jobs that finished more than `history_days` ago,
+        and dead letters that are as old. This runs at most once every
+        `prune_interval` seconds, unless forced.
+        '''
+        now = time.time()
+
+        if not force and now - self.last_pruned < self.prune_interval:
+            return
+
+        self.last_pruned = now
+        cutoff = now - self.history_days * 24 * 60 * 60
+
+        with self.store.lock:
+            for work_id, job in list(self.store.jobs.items()):
+                if job['date_added'] < cutoff and job['state'] in self.finished_states:
+                    del self.store.jobs[work_id]
+
+            for work_id, record in list(self.store.dead.items()):
+                if record['date_failed'] < cutoff:
+                    del self.store.dead[work_id]
+
+            # Forget repos with nothing on the queue, like the SQLite queue
+            # does, along with what's left of their heaps
+            active = set(record['repo'] for record in self.store.queue.values())
+
+            for repo in list(self.store.repos):
+                if repo not in active:
+                    del self.store.repos[repo]
+                    self.store.heaps.pop(repo, None)
+
+    def depth(self):
+        '''
+        Count the jobs on the queue in each state, as a dict.
+        '''
+        with self.store.lock:
+            return dict(Counter(record['state'] for record in self.store.queue.values()))
+
+    def status(self, work_id):
+        '''
+        Return the history of a job as a dict, or None if there's no such job.
+        '''
+        job = self.store.jobs.get(work_id)
+
+        return self.describe(job) if job else None
+
+    def history(self, repo=None, before=None, limit=20):
+        '''
+        Return a page of job history, newest first. Returns a tuple of the
+        jobs (as dicts) and the cursor for the next page, which is None on the
+        last page.
+
+        Args:
+            - repo (string): Optional name of a repo to limit the history to.
+            - before (int): Optional cursor from the previous page.
+            - limit (int): Maximum number of jobs to return.
+        '''
+        with self.store.lock:
+            jobs = [job for job in reversed(self.store.jobs.values())
+                    if (repo is None or job['repo'] == repo) and
+                       (before is None or job['seq'] < before)]
+
+        page = [self.describe(job) for job in jobs[:limit]]
+        cursor = jobs[limit - 1]['seq'] if len(jobs) > limit else None
+
+        return page, cursor
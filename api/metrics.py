@@ -0,0 +1,348 @@
+# metrics.py -- counters and timing histograms, shared across processes
+import os
+import json
+import time
+import fcntl
+import atexit
+import tempfile
+import threading
+from uuid import uuid4
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of histogram buckets, in seconds. Deploy phases run from
+# milliseconds (config parsing) to many minutes (builds).
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def metrics_dir(tmp=None):
+    '''
+    Return the directory that processes share metrics through, under the
+    server's `tmp` directory.
+    '''
+    return os.path.join(tmp or tempfile.gettempdir(), 'bunny-hook', 'metrics')
+
+
+class Registry(object):
+    '''
+    Collect metrics for one process.
+
+    Recording a metric only touches a dict in memory. Every `flush_interval`
+    seconds (and when the process exits), the totals are written to a file of
+    their own in the shared metrics directory, where `collect` adds them up
+    with the totals from every other process. Once the process has exited,
+    `collect` folds its file into `retired.json`.
+    '''
+    # Minimum number of seconds between writes to disk
+    flush_interval = 1.0
+
+    def __init__(self, directory):
+        '''
+        Initialize the registry.
+
+        Args:
+            - directory (string): Directory that processes share metrics in.
+        '''
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Start over with empty metrics, under a new file.
+        '''
+        self.pid = os.getpid()
+        self.path = os.path.join(self.directory, '%d-%s.json' % (self.pid, uuid4().hex[:8]))
+        self.counters = {}
+        self.histograms = {}
+        self.last_flush = time.time()
+
+        # Whether anything has been recorded since the last flush
+        self.dirty = False
+
+    def check_fork(self):
+        '''
+        Forked workers inherit their parent's totals, which the parent is
+        already reporting. Drop them, so nothing gets counted twice.
+        '''
+        if os.getpid() != self.pid:
+            self.reset()
+
+    def inc(self, name, amount=1, **labels):
+        '''
+        Add to a counter.
+        '''
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.check_fork()
+            self.counters[key] = self.counters.get(key, 0) + amount
+            self.dirty = True
+
+        self.maybe_flush()
+
+    def observe(self, name, value, **labels):
+        '''
+        Record a value (usually a duration, in seconds) in a histogram.
+        '''
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.check_fork()
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                # Per-bucket counts (plus one for +Inf), sum and count
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+
+            histogram[0][bisect_left(BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+            self.dirty = True
+
+        self.maybe_flush()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''
+        Time a block of code into a histogram, whether or not it succeeds.
+        '''
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write this process's totals to its file, if they've changed.
+        '''
+        with self.lock:
+            self.check_fork()
+            self.last_flush = time.time()
+
+            if not self.dirty:
+                return
+
+            self.dirty = False
+
+            data = {
+                'counters': [[name, labels, value]
+                             for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels] + histogram
+                               for (name, labels), histogram in self.histograms.items()],
+            }
+
+            os.makedirs(self.directory, exist_ok=True)
+
+            # Write atomically, so readers never see a half-written file
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+
+# One registry per metrics directory, for the life of the process
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(directory=None):
+    '''
+    Return the process's Registry for a metrics directory.
+    '''
+    directory = directory or metrics_dir()
+    registry = _registries.get(directory)
+
+    if not registry:
+        with _registries_lock:
+            registry = _registries.get(directory)
+
+            if not registry:
+                registry = _registries[directory] = Registry(directory)
+                atexit.register(registry.flush)
+
+    return registry
+
+
+def is_running(pid):
+    '''
+    Check whether a process is still running.
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, under some other user
+        return True
+
+    return True
+
+
+def read_metrics(path):
+    '''
+    Return the metrics in a file, or None if it's gone or half-written.
+    '''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def add_metrics(data, counters, histograms):
+    '''
+    Add the metrics read from a file to running totals.
+    '''
+    for metric, labels, value in data.get('counters', []):
+        key = (metric, tuple(tuple(label) for label in labels))
+        counters[key] = counters.get(key, 0) + value
+
+    for metric, labels, buckets, total, count in data.get('histograms', []):
+        key = (metric, tuple(tuple(label) for label in labels))
+        histogram = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+
+        histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+        histogram[1] += total
+        histogram[2] += count
+
+
+def retire(directory, names):
+    '''
+    Fold the files of processes that have exited into `retired.json`, and
+    remove them, so that files don't pile up as workers come and go, but
+    counters never go backwards.
+    '''
+    with open(os.path.join(directory, '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            retired_path = os.path.join(directory, 'retired.json')
+            counters = {}
+            histograms = {}
+            paths = []
+
+            for name in names:
+                path = os.path.join(directory, name)
+                data = read_metrics(path)
+
+                # Another collector may have retired it already
+                if data is not None:
+                    add_metrics(data, counters, histograms)
+                    paths.append(path)
+
+            if not paths:
+                return
+
+            add_metrics(read_metrics(retired_path) or {}, counters, histograms)
+
+            data = {
+                'counters': [[name, labels, value]
+                             for (name, labels), value in counters.items()],
+                'histograms': [[name, labels] + histogram
+                               for (name, labels), histogram in histograms.items()],
+            }
+
+            tmp_path = retired_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, retired_path)
+
+            for path in paths:
+                os.remove(path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def collect(directory):
+    '''
+    Add up the metrics that every process has written to a directory.
+    Returns a tuple of dicts of counters and histograms, keyed by name and
+    labels.
+    '''
+    counters = {}
+    histograms = {}
+
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        names = []
+
+    # Process files are named `<pid>-<id>.json`
+    dead = [name for name in names if name.endswith('.json') and
+            name.split('-')[0].isdigit() and not is_running(int(name.split('-')[0]))]
+
+    if dead:
+        retire(directory, dead)
+        names = os.listdir(directory)
+
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+
+        data = read_metrics(os.path.join(directory, name))
+
+        if data is not None:
+            add_metrics(data, counters, histograms)
+
+    return counters, histograms
+
+
+def format_labels(labels, extra=None):
+    '''
+    Format labels the way Prometheus expects, e.g. `{repo="app",le="0.5"}`.
+    '''
+    labels = list(labels) + (extra or [])
+
+    if not labels:
+        return ''
+
+    escaped = ['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                           .replace('\n', '\\n'))
+               for key, value in labels]
+
+    return '{%s}' % ','.join(escaped)
+
+
+def render(counters, histograms, gauges=None):
+    '''
+    Render metrics in the Prometheus text exposition format.
+
+    Args:
+        - counters (dict): Counter values, keyed by name and labels.
+        - histograms (dict): Histograms, keyed by name and labels.
+        - gauges (dict): Optional gauge values, keyed by name and labels.
+    '''
+    lines = []
+
+    for kind, metrics in (('counter', counters), ('gauge', gauges or {})):
+        for name in sorted({name for name, _ in metrics}):
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            for (metric, labels), value in sorted(metrics.items()):
+                if metric == name:
+                    lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append('# TYPE %s histogram' % name)
+
+        for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+            if metric != name:
+                continue
+
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS + ('+Inf',), buckets):
+                cumulative += bucket
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, [('le', bound)]),
+                                                 cumulative))
+
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,163 @@
+# mirrors.py -- a local cache of bare mirrors of the repos we deploy
+import os
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+
+class MirrorCache(object):
+    '''
+    Keep bare mirrors of remote repos on local disk, so that builds only have
+    to fetch new objects from the remote, and checkouts can be cloned from
+    local disk (where git hardlinks objects instead of copying them).
+
+    Mirrors are keyed by origin URL, so repos with the same name but different
+    owners never collide. When the cache grows past `budget` bytes, the least
+    recently used mirrors are removed.
+    '''
+    # Default directory to keep mirrors in
+    root = os.path.join(tempfile.gettempdir(), 'bunny-hook', 'mirrors')
+
+    # Default size of the cache, in bytes
+    budget = 10 * 1024 ** 3
+
+    def __init__(self, root=None, budget=None):
+        '''
+        Initialize the cache.
+
+        Args:
+            - root (string): Optional directory to keep mirrors in.
+            - budget (int): Optional maximum size of the cache, in bytes.
+        '''
+        if root:
+            self.root = root
+
+        if budget:
+            self.budget = budget
+
+    def path(self, origin):
+        '''
+        Return the path to the mirror of a remote repo.
+        '''
+        digest = hashlib.sha1(origin.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, '%s.git' % digest[:16])
+
+    @contextmanager
+    def lock(self, mirror_path, shared=False, blocking=True):
+        '''
+        Lock a mirror: exclusively while it's being updated or removed, or
+        shared while something is being checked out from it. Yields False if
+        `blocking` is off and the lock is taken.
+        '''
+        with open(mirror_path + '.lock', 'w') as lock_file:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def update(self, origin, branch, run_command):
+        '''
+        Create or refresh the mirror of a remote repo, and return its path.
+
+        Args:
+            - origin (string): URL of the remote repo.
+            - branch (string): Branch that's being deployed. Only this branch
+                               gets fetched when the mirror already exists.
+            - run_command (callable): Function for running git commands, so
+                                      that failures are reported by the Worker.
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        mirror_path = self.path(origin)
+
+        with self.lock(mirror_path):
+            if os.path.exists(mirror_path):
+                logging.info('Fetching {branch} into mirror {mirror_path}...'.format(
+                    branch=branch, mirror_path=mirror_path))
+                refspec = '+refs/heads/{branch}:refs/heads/{branch}'.format(branch=branch)
+                run_command(['git', '-C', mirror_path, 'fetch', '--prune', origin, refspec])
+            else:
+                logging.info('Mirroring {origin} into {mirror_path}...'.format(
+                    origin=origin, mirror_path=mirror_path))
+                run_command(['git', 'clone', '--mirror', origin, mirror_path])
+
+            # Record when the mirror was last used, for eviction
+            with open(mirror_path + '.used', 'w'):
+                pass
+
+        self.evict(keep=mirror_path)
+
+        return mirror_path
+
+    def size(self, path):
+        '''
+        Return the total size of the files in a directory, in bytes.
+        '''
+        total = 0
+
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, filename)).st_size
+                except FileNotFoundError:
+                    pass
+
+        return total
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used mirrors until the cache fits in its
+        budget. Mirrors that are being updated are left alone.
+
+        Args:
+            - keep (string): Optional path of a mirror that should never be
+                             removed (e.g. the one that's about to be used).
+        '''
+        mirrors = []
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+
+            if name.endswith('.git') and os.path.isdir(path):
+                try:
+                    used = os.path.getmtime(path + '.used')
+                except FileNotFoundError:
+                    used = 0
+
+                mirrors.append((used, path, self.size(path)))
+
+        total = sum(size for _, _, size in mirrors)
+
+        for used, path, size in sorted(mirrors):
+            if total <= self.budget:
+                break
+
+            if path == keep:
+                continue
+
+            with self.lock(path, blocking=False) as locked:
+                if not locked:
+                    continue
+
+                logging.info('Evicting mirror %s from the cache...' % path)
+                shutil.rmtree(path, ignore_errors=True)
+
+                try:
+                    os.remove(path + '.used')
+                except FileNotFoundError:
+                    pass
+
+            total -= size
@@ -0,0 +1,130 @@
+# notify.py -- wake up queue consumers when new work arrives
+import os
+import errno
+import select
+import socket
+import hashlib
+import tempfile
+from uuid import uuid4
+
+
+class Notifier(object):
+    '''
+    Signal consumers that are blocked waiting for work on a queue.
+
+    Every consumer binds a Unix datagram socket in a directory that is shared
+    by everyone using the same datastore. Producers send a single byte to each
+    socket in that directory, which wakes up any consumer blocked in `wait`.
+    Notifications are only a hint: consumers should still poll slowly in case
+    one gets lost.
+    '''
+    def __init__(self, name):
+        '''
+        Initialize the notification channel for a datastore.
+
+        Args:
+            - name (string): Name of the datastore (e.g. the SQLite connection
+                             string). Processes that use the same name share a
+                             channel.
+        '''
+        digest = hashlib.sha1(os.path.abspath(name).encode('utf-8')).hexdigest()
+
+        # Keep socket paths short, since Unix sockets have a ~100 byte limit
+        self.directory = os.path.join(tempfile.gettempdir(),
+                                      'bunny-hook-%s' % digest[:12])
+        self.path = None
+        self.sock = None
+
+    def listen(self):
+        '''
+        Start listening for notifications.
+        '''
+        if self.sock:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.path = os.path.join(self.directory, '%s.sock' % uuid4().hex[:12])
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(self.path)
+
+    def send(self, path):
+        '''
+        Send a wakeup to a single consumer socket. Returns False if the socket
+        is stale (its consumer has gone away).
+        '''
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            try:
+                sock.sendto(b'1', path)
+            except BlockingIOError:
+                # The consumer already has wakeups waiting that it hasn't read
+                pass
+            except OSError as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    return False
+                raise
+
+        return True
+
+    def notify(self):
+        '''
+        Wake up every consumer listening on this channel.
+        '''
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            # Nobody has ever listened on this channel
+            return
+
+        for name in names:
+            path = os.path.join(self.directory, name)
+
+            if not self.send(path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def wake(self):
+        '''
+        Wake up this consumer only (e.g. when a worker frees up).
+        '''
+        if self.path:
+            self.send(self.path)
+
+    def wait(self, timeout):
+        '''
+        Block until a notification arrives or the timeout expires. Returns
+        True if a notification was received.
+        '''
+        if not self.sock:
+            self.listen()
+
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+
+        if not readable:
+            return False
+
+        # Drain the socket so that a burst of notifications only wakes us once
+        while True:
+            try:
+                self.sock.recv(64)
+            except BlockingIOError:
+                break
+
+        return True
+
+    def close(self):
+        '''
+        Stop listening and clean up the socket file.
+        '''
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
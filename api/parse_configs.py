@@ -1,12 +1,297 @@
+# parse_configs.py -- load the server config and repo deploy configs
+import os
+import copy
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import yaml
+
+from api.exceptions import ConfigException
+from api.steps import plan
+
+# Use the C-accelerated loader when PyYAML was built against libyaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Directives allowed in the server config (`config.yml`), with their types
+SERVER_SCHEMA = {
+    'tmp': str,
+    'git_path': str,
+    'mirror_budget': int,
+    'cache_budget': int,
+    'compress_logs': bool,
+    'script_timeout': int,
+    'job_timeout': int,
+    'limits': dict,
+    'priorities': list,
+    'queue': str,
+    'max_attempts': int,
+    'retry_delay': int,
+    'max_retry_delay': int,
+    'checkout': str,
+}
+
+# Directives allowed in a repo's deploy config (`deploy.yml`), with their types
+DEPLOY_SCHEMA = {
+    'home': str,
+    'prebuild': list,
+    'build': list,
+    'deploy': list,
+    'concurrency': int,
+    'script_timeout': int,
+    'job_timeout': int,
+    'limits': dict,
+    'checkout': str,
+    'releases': int,
+}
+
+# Numeric directives that have to be at least 1
+POSITIVE = ['concurrency', 'script_timeout', 'job_timeout', 'max_attempts', 'retry_delay',
+            'max_retry_delay', 'releases']
+
+# Resources that scripts can be limited in, under `limits`
+LIMITS = ['cpu', 'memory', 'open_files']
+
+# Keys of the rules under `priorities`
+PRIORITY_KEYS = {'repo', 'branch', 'priority'}
+
+# Priorities have to fit in a 64-bit integer, the largest that SQLite stores
+MAX_PRIORITY = 2 ** 63 - 1
+
+# Ways that a repo can be checked out for a deploy, under `checkout`
+CHECKOUT_MODES = ['clone', 'archive']
+
+# Directives that every deploy config has to include
+REQUIRED = ['home']
+
+# Names that a deploy config can go by, in the root of a repo
+CONFIG_NAMES = ['deploy.yml', 'deploy.yaml']
+
+
+def load(config_file, data=None):
+    '''
+    Parse a YAML file safely. Pass in `data` if the file has already been read.
+    '''
+    if data is None:
+        with open(config_file, 'rb') as cf:
+            data = cf.read()
+
+    try:
+        return yaml.load(data, Loader=SafeLoader)
+    except yaml.YAMLError as e:
+        raise ConfigException('Could not parse %s: %s' % (config_file, e))
+
+
+def blob_sha(data):
+    '''
+    Return the sha that git would give a file with these contents.
+    '''
+    header = ('blob %d\0' % len(data)).encode('utf-8')
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def validate(config, schema, config_file):
+    '''
+    Check the types of the directives in a config. Unknown directives are
+    logged and dropped. Returns the validated config.
+    '''
+    if not isinstance(config, dict):
+        raise ConfigException('Config file %s should be a mapping of directives' % config_file)
+
+    validated = {}
+
+    for key, value in config.items():
+        if key not in schema:
+            logging.warning('Ignoring unknown directive `%s` in %s' % (key, config_file))
+            continue
+
+        expected = schema[key]
+
+        if value is None:
+            continue
+
+        # Booleans are ints to Python, but never what a numeric directive means
+        if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+            raise ConfigException('Directive `%s` in %s should be a %s' %
+                                  (key, config_file, expected.__name__))
+
+        if key == 'priorities':
+            for rule in value:
+                if (not isinstance(rule, dict) or not set(rule) <= PRIORITY_KEYS
+                        or not isinstance(rule.get('priority'), int)
+                        or isinstance(rule['priority'], bool)
+                        or abs(rule['priority']) > MAX_PRIORITY
+                        or not all(isinstance(rule.get(name, ''), str)
+                                   for name in ('repo', 'branch'))):
+                    raise ConfigException('Every rule in `priorities` in %s should have a '
+                                          'numeric `priority` that fits in 64 bits, and '
+                                          'optionally a `repo` and `branch`' % config_file)
+
+        # Script lists hold paths, or mappings that describe steps
+        elif expected is list and not all(isinstance(item, (str, dict)) for item in value):
+            raise ConfigException('Directive `%s` in %s should be a list of scripts' %
+                                  (key, config_file))
+
+        if key in POSITIVE and value < 1:
+            raise ConfigException('Directive `%s` in %s should be at least 1' %
+                                  (key, config_file))
+
+        if key == 'checkout' and value not in CHECKOUT_MODES:
+            raise ConfigException('Directive `checkout` in %s should be one of %s' %
+                                  (config_file, ', '.join(CHECKOUT_MODES)))
+
+        if key == 'limits':
+            for name, limit in value.items():
+                if name not in LIMITS:
+                    raise ConfigException('Unknown limit `%s` in %s; use one of %s' %
+                                          (name, config_file, ', '.join(LIMITS)))
+
+                if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+                    raise ConfigException('Limit `%s` in %s should be a positive number' %
+                                          (name, config_file))
+
+        validated[key] = value
+
+    return validated
+
+
 class Parse(object):
+    '''
+    Load configs for deployments: the server config, which is read once, and
+    each repo's deploy config, which gets merged on top of it.
+
+    Parsed deploy configs are cached by the git blob sha of the file, so an
+    unchanged `deploy.yml` is only parsed and validated once per process no
+    matter how many times it gets deployed.
+    '''
+    # Maximum number of parsed deploy configs to keep
+    cache_size = 128
+
+    def __init__(self, server_config=None):
+        '''
+        Load the server config.
+
+        Args:
+            - server_config (string): Optional path to the server config file.
+                                      Without it, built-in defaults are used.
+        '''
+        self.server_config = server_config
+        self.server = {}
+
+        if server_config:
+            self.server = validate(load(server_config) or {}, SERVER_SCHEMA, server_config)
+
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def find(self, repo_path):
+        '''
+        Return the path to the deploy config in the root of a repo.
+        '''
+        found = [name for name in CONFIG_NAMES
+                 if os.path.isfile(os.path.join(repo_path, name))]
+
+        return os.path.join(repo_path, self.choose(found))
+
+    def choose(self, found):
+        '''
+        Pick the deploy config out of the config names found in a repo.
+        '''
+        if not found:
+            raise ConfigException('Could not locate a `deploy.yml` file in your repo.')
+
+        if len(found) > 1:
+            raise ConfigException('Found two config files in this repo! Delete one and try again.')
+
+        return found[0]
+
+    def parse(self, repo_path):
+        '''
+        Return the deploy config for a repo, merged with the server config.
+        The result is a fresh dict, so callers are free to change it.
+        '''
+        config_file = self.find(repo_path)
+
+        logging.info('Loading config file from %s...' % config_file)
+        with open(config_file, 'rb') as cf:
+            data = cf.read()
+
+        return self.parse_blob(config_file, blob_sha(data), lambda: data)
+
+    def parse_blob(self, config_file, key, read):
+        '''
+        Return a deploy config, merged with the server config, given the git
+        blob sha of the file. The file is only read (by calling `read`, which
+        returns its contents) if it isn't in the cache already, so configs
+        can be loaded straight out of a mirror without checking it out.
+        '''
+        with self.lock:
+            config = self.cache.get(key)
+
+            if config is not None:
+                self.cache.move_to_end(key)
+
+        if config is None:
+            config = self.parse_deploy(config_file, read())
+
+            with self.lock:
+                self.cache[key] = config
+
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        merged = copy.deepcopy(self.server)
+        merged.update(copy.deepcopy(config))
+
+        # Repos can override some of the server's default limits, and keep
+        # the rest
+        if self.server.get('limits') and config.get('limits'):
+            merged['limits'] = dict(self.server['limits'], **config['limits'])
+
+        return merged
+
+    def parse_deploy(self, config_file, data):
+        '''
+        Parse and validate the contents of a deploy config.
+        '''
+        config = load(config_file, data)
+
+        if not config:
+            raise ConfigException('Deployment file %s appears to be empty' % config_file)
+
+        config = validate(config, DEPLOY_SCHEMA, config_file)
+
+        for key in REQUIRED:
+            if not config.get(key):
+                raise ConfigException('Deployment file %s is missing `%s` directive' %
+                                      (config_file, key))
+
+        # Check that the scripts make a graph that can actually run
+        plan(config, config_file)
+
+        return config
+
+
+# Parsers are shared by every worker in the process, so they share a cache
+_parsers = {}
+_parsers_lock = threading.Lock()
+
+
+def get_parser(server_config=None):
+    '''
+    Return the shared Parse for a server config file.
+    '''
+    parser = _parsers.get(server_config)
 
-    def __init__(self):
-        # Parse first file
-        #
-        # Parse second file
-        #
-        # Merge
+    if not parser:
+        with _parsers_lock:
+            parser = _parsers.get(server_config)
 
-    def parse():
-        pass
+            if not parser:
+                parser = _parsers[server_config] = Parse(server_config)
 
+    return parser
@@ -4,9 +4,64 @@ class Payload(object):
 
     Assume JSON structure from the GitHub PushEvent payload. For docs, see:
     https://developer.github.com/v3/activity/events/types/#pushevent
+
+    Only the handful of attributes that a build needs are pulled out of the
+    payload, so that jobs can be stored and passed around without the rest of
+    it (commit lists can run to hundreds of KB). The full payload is kept in
+    `raw` when it's available.
     '''
-    def __init__(self, payload):
-        self.dict = payload
+    __slots__ = ('ref', 'name', 'owner', 'sha', 'origin', 'delivery', 'raw')
+
+    def __init__(self, payload, delivery=None):
+        '''
+        Pull the attributes for a build out of a payload.
+
+        Args:
+            - payload (dict): An event from the GitHub API.
+            - delivery (string): Optional ID of the delivery, from the
+                                 X-GitHub-Delivery header.
+        '''
+        self.raw = payload
+        self.delivery = delivery
+
+        repository = payload.get('repository')
+        if not isinstance(repository, dict):
+            repository = {}
+
+        self.ref = payload.get('ref')
+        self.name = repository.get('name')
+
+        owner = repository.get('owner')
+        if isinstance(owner, dict):
+            owner = owner.get('login') or owner.get('name')
+
+        if not owner and repository.get('full_name'):
+            owner = repository['full_name'].split('/')[0]
+
+        self.owner = owner
+
+        head_commit = payload.get('head_commit') or {}
+        self.sha = payload.get('after') or head_commit.get('id')
+
+        self.origin = payload.get('clone_url') or repository.get('clone_url')
+
+    @classmethod
+    def from_record(cls, ref, name, owner=None, sha=None, origin=None, delivery=None):
+        '''
+        Rebuild a payload from the attributes stored for a job, without the
+        full payload.
+        '''
+        payload = cls.__new__(cls)
+
+        payload.raw = None
+        payload.ref = ref
+        payload.name = name
+        payload.owner = owner
+        payload.sha = sha
+        payload.origin = origin
+        payload.delivery = delivery
+
+        return payload
 
     def validate(self, registered_branch):
         '''
@@ -14,43 +69,42 @@ class Payload(object):
         branch.
         '''
         # Check that the push event has the required attributes for new builds
-        ref = self.get('ref')
-
-        if ref and self.get('repository') and self.get_branch() == registered_branch:
+        if self.ref and self.name and self.get_branch() == registered_branch:
             return True
 
         return False
 
     def get(self, attr):
         '''
-        Return a miscellaneous attribute from the payload, or None if no such
-        attribute exists.
+        Return a miscellaneous attribute from the full payload, or None if no
+        such attribute exists (or the full payload wasn't kept).
         '''
-        return self.dict.get(attr)
+        if not self.raw:
+            return None
+
+        return self.raw.get(attr)
 
     def get_branch(self):
         '''
         Return the name of the branch recorded in the payload.
         '''
-        ref = self.get('ref')
-        return ref.split('/')[-1]
+        return self.ref.split('/')[-1]
 
     def get_origin(self):
         '''
         Return the URL that the repo can be cloned from.
         '''
-        return self.get('clone_url')
+        return self.origin
 
     def get_name(self):
         '''
         Return the name of the repo recorded in the payload.
         '''
-        repository = self.get('repository')
-        return repository.get('name')
+        return self.name
 
     @property
     def as_dict(self):
         '''
-        Return the payload as a dictionary.
+        Return the full payload as a dictionary.
         '''
-        return self.dict
+        return self.raw
@@ -0,0 +1,192 @@
+# pool.py -- run deployments from the queue in parallel
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from api.queue import open_queue, get_queue
+from api.backends import is_transient
+from api.worker import Worker
+from api.parse_configs import get_parser
+from api.metrics import get_registry, metrics_dir
+from api.exceptions import QueueException, CancelledException
+
+
+def deploy(work_id, payload, db_conn, server_config=None):
+    '''
+    Run a deployment for a payload. This function lives at the module level
+    so that it can be pickled and sent to worker processes.
+
+    Args:
+        - work_id (string): ID of the job on the queue.
+        - payload (dict): An event from the GitHub API.
+        - db_conn (string): Connection string for the queue, so that the
+                            worker can check whether the job has been
+                            cancelled.
+        - server_config (string): Optional path to the server config file.
+    '''
+    queue = get_queue(db_conn)
+    worker = Worker(payload, cancelled=queue.cancel_check(work_id),
+                    parser=get_parser(server_config), job_id=work_id)
+    return worker.deploy()
+
+
+class Pool(object):
+    '''
+    Run deployment jobs from the queue concurrently. Jobs for different repos
+    run in parallel, but jobs for the same repo are serialized so that they
+    never share a working copy. (Jobs that deploy to the same `home` are
+    serialized separately, by the Worker.)
+    '''
+    executors = {
+        'thread': ThreadPoolExecutor,
+        'process': ProcessPoolExecutor,
+    }
+
+    # Server config directives for how the queue retries failed jobs
+    retry_settings = ['max_attempts', 'retry_delay', 'max_retry_delay']
+
+    def __init__(self, size=1, mode='thread', queue=None, server_config=None):
+        '''
+        Initialize the pool of workers.
+
+        Args:
+            - size (int): Maximum number of deployments to run at once.
+            - mode (string): Run deployments in 'thread's or 'process'es.
+            - queue (QueueBackend): Optional queue to pull work from, instead
+                                    of the one named by `queue` in the
+                                    server config.
+            - server_config (string): Optional path to the server config file
+                                      for workers to load.
+        '''
+        if mode not in self.executors:
+            raise QueueException('Unknown pool mode "%s"' % mode)
+
+        if size < 1:
+            raise QueueException('Pool size must be at least 1')
+
+        server = get_parser(server_config).server
+
+        self.size = size
+        self.mode = mode
+        self.server_config = server_config
+        self.queue = queue if queue else open_queue(server.get('queue'))
+
+        for name in self.retry_settings:
+            if server.get(name):
+                setattr(self.queue, name, server[name])
+
+        if mode == 'process' and self.queue.backend == 'memory':
+            raise QueueException("Worker processes can't see jobs on a memory queue")
+
+        self.executor = self.executors[mode](max_workers=size)
+        self.metrics = get_registry(metrics_dir(server.get('tmp')))
+
+        # Start listening before the first check for work, so that nothing
+        # added in between gets missed
+        self.queue.notifier.listen()
+
+        # Map repo names to the deployment currently running for that repo
+        self.running = {}
+
+        # Keep the leases on claimed jobs alive while they run
+        self.renew_interval = self.queue.lease_timeout / 3
+        self.last_renewed = time.time()
+
+    def start(self, key, job):
+        '''
+        Hand off a job to the executor.
+        '''
+        logging.info('Starting deployment of %s' % key)
+
+        if job.date_added:
+            self.metrics.observe('bunny_hook_queue_wait_seconds', time.time() - job.date_added)
+
+        future = self.executor.submit(deploy, job.id, job.payload, self.queue.db_conn,
+                                      self.server_config)
+        future.job = job
+        future.executor = self.executor
+
+        # Wake up the pool when the worker frees up, so waiting jobs can start
+        future.add_done_callback(lambda future: self.queue.notifier.wake())
+
+        self.running[key] = future
+
+    def reap(self):
+        '''
+        Clear out deployments that have finished, logging any failures.
+        '''
+        for key, future in list(self.running.items()):
+            if future.done():
+                del self.running[key]
+
+                exc = future.exception()
+                if isinstance(exc, CancelledException):
+                    logging.info('Deployment of %s was superseded by a newer push' % key)
+                    self.queue.ack(future.job.id, 'cancelled', str(exc))
+                elif exc:
+                    self.fail(key, future, exc)
+                else:
+                    self.queue.ack(future.job.id)
+
+    def fail(self, key, future, exc):
+        '''
+        Retry a failed deployment later, or give up on it. If its worker
+        process died and took the executor down with it, start a new one, so
+        that one bad job can't stop the rest of the queue.
+        '''
+        if isinstance(exc, BrokenProcessPool) and future.executor is self.executor:
+            logging.error('A worker died while deploying %s; restarting the workers' % key)
+            self.executor.shutdown(wait=False)
+            self.executor = self.executors[self.mode](max_workers=self.size)
+
+        delay = self.queue.fail(future.job.id, str(exc), retry=is_transient(exc))
+
+        if delay is None:
+            logging.error('Deployment of %s failed: %s' % (key, exc))
+        else:
+            logging.warning('Deployment of %s failed, retrying in %.0f seconds: %s' %
+                            (key, delay, exc))
+
+    def renew(self):
+        '''
+        Renew the leases on every job that the pool is running, if they're
+        due for it.
+        '''
+        if time.time() - self.last_renewed < self.renew_interval:
+            return
+
+        self.queue.renew([future.job.id for future in self.running.values()])
+        self.last_renewed = time.time()
+
+    def run(self):
+        '''
+        Check for finished deployments and start new ones as workers free up.
+        '''
+        self.reap()
+        self.renew()
+
+        while len(self.running) < self.size:
+            # Leave jobs for busy repos on the queue until their repo frees up
+            job = self.queue.claim(exclude=self.running.keys())
+
+            if not job:
+                break
+
+            self.start(job.repo, job)
+
+    def wait(self, timeout):
+        '''
+        Block until new work arrives or a worker finishes, falling back to
+        polling every `timeout` seconds.
+        '''
+        # Wake up in time to renew leases
+        return self.queue.wait(min(timeout, self.renew_interval))
+
+    def shutdown(self):
+        '''
+        Wait for running deployments to finish and release the workers.
+        '''
+        self.executor.shutdown(wait=True)
+        self.reap()
+        self.queue.notifier.close()
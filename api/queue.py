@@ -1,96 +1,1031 @@
 # queue.py -- run tasks from a queue
 import sqlite3
+import threading
 import time
 import json
+import zlib
 from uuid import uuid4
 
-from api.worker import Worker
+from api.payload import Payload
+from api.notify import Notifier
+from api.batch import get_committer
+from api.backends import QueueBackend, Job
+from api.exceptions import QueueUnavailable
+from api.memqueue import MemoryQueue
+from api.spool import SpoolQueue
 
 
-class Queue(object):
+# Connections are opened once per thread, since SQLite connections can't be
+# shared between threads
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+
+def split_conn(db_conn):
+    '''
+    Split a connection string into the name of its backend and the location
+    of its datastore (e.g. `spool:/mnt/queue` is a spool in `/mnt/queue`).
+    Connection strings without a known backend prefix are paths to SQLite
+    databases.
+    '''
+    backend, sep, location = db_conn.partition(':')
+
+    if sep and backend in BACKENDS:
+        return backend, location
+
+    return 'sqlite', db_conn
+
+
+def open_queue(db_conn=None, lease_timeout=None, create=True):
+    '''
+    Open a queue with whichever backend its connection string names.
+
+    Args:
+        - db_conn (string): Optional connection string: a path to a SQLite
+                            database, `memory:<name>` or `spool:<directory>`.
+        - lease_timeout (int): Optional number of seconds before a claimed job
+                               gets returned to the queue.
+        - create (bool): Whether to set up the datastore's schema.
+    '''
+    db_conn = db_conn or Queue.db_conn
+
+    return BACKENDS[split_conn(db_conn)[0]](db_conn, lease_timeout=lease_timeout,
+                                            create=create)
+
+
+def get_queue(db_conn=None, group_commit=False):
+    '''
+    Return a persistent Queue for the current thread, so that long-running
+    processes (like the app server) don't reconnect and rebuild the schema for
+    every job they add. The schema is set up once per process.
+
+    Args:
+        - db_conn (string): Optional connection string, if the queue should
+                            use a different datastore (see `open_queue`).
+        - group_commit (bool): Whether jobs added from different threads
+                               should share transactions. Only SQLite queues
+                               have transactions to share.
     '''
-    Create and manage a queue of deployment jobs. This class bridges the API
-    and the Worker, so that deployment doesn't have to be attached to the
-    request/response cycle.
+    db_conn = db_conn or Queue.db_conn
+
+    queues = getattr(_local, 'queues', None)
+    if queues is None:
+        queues = _local.queues = {}
+
+    if db_conn not in queues:
+        with _schema_lock:
+            create = db_conn not in _schema_ready
+            queues[db_conn] = open_queue(db_conn, create=create)
+            _schema_ready.add(db_conn)
+
+    queue = queues[db_conn]
+
+    if group_commit and not queue.committer and isinstance(queue, Queue):
+        queue.committer = get_committer(queue.path)
+
+    return queue
+
+
+def close_queue(db_conn=None):
+    '''
+    Close the current thread's persistent Queue, if it has one.
+    '''
+    queues = getattr(_local, 'queues', {})
+    queue = queues.pop(db_conn or Queue.db_conn, None)
+
+    if queue:
+        queue.close()
+
+
+class Queue(QueueBackend):
+    '''
+    Create and manage a queue of deployment jobs in SQLite. This class bridges
+    the API and the Worker, so that deployment doesn't have to be attached to
+    the request/response cycle. It's the default backend: connection strings
+    are paths to the database, optionally prefixed with `sqlite:`.
+
+    Jobs move through two states: 'queued' jobs are waiting for a worker, and
+    'leased' jobs have been claimed by one. A lease expires after
+    `lease_timeout` seconds unless it gets renewed, at which point the job is
+    returned to the queue so that work from crashed workers isn't lost.
+
+    Jobs are claimed in order of priority. Among the repos with jobs at the
+    top priority, the one that was served least recently goes first, so a
+    repo that pushes constantly can't starve the others; within a repo, jobs
+    go oldest first.
+
+    When `coalesce` is on, a new job replaces any queued jobs for the same
+    repo and branch, since only the latest push matters. When `cancel_running`
+    is also on, leased jobs for that repo and branch are moved to the
+    'cancelled' state, which their workers check for between steps.
+
+    Jobs leave the queue once they're acknowledged, but their history is kept
+    in the `jobs` table: each job moves from 'queued' to 'running' and then
+    to 'succeeded', 'failed' or 'cancelled', with timestamps for each step.
+    Jobs that failed for good are also kept in the `dead_letters` table.
+    History and dead letters older than `history_days` are pruned as jobs
+    finish.
     '''
+    backend = 'sqlite'
+
     # Default SQLite connection string
     db_conn = 'hook.db'
 
-    def __init__(self, db_conn=None):
+    # Columns of the queue table, for upgrading older datastores. (`payload`
+    # holds uncompressed JSON for jobs queued by older versions.)
+    columns = [
+        ('id', 'TEXT PRIMARY KEY'),
+        ('payload', 'TEXT'),
+        ('date_added', 'NUMERIC'),
+        ('state', "TEXT NOT NULL DEFAULT 'queued'"),
+        ('lease_expires', 'NUMERIC'),
+        ('repo', 'TEXT'),
+        ('branch', 'TEXT'),
+        ('owner', 'TEXT'),
+        ('ref', 'TEXT'),
+        ('sha', 'TEXT'),
+        ('clone_url', 'TEXT'),
+        ('delivery_id', 'TEXT'),
+        ('payload_blob', 'BLOB'),
+        ('priority', 'INTEGER NOT NULL DEFAULT 0'),
+        ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ('not_before', 'NUMERIC'),
+    ]
+
+    # Columns that a Payload is rebuilt from, in `Payload.from_record` order
+    record = ['ref', 'repo', 'owner', 'sha', 'clone_url', 'delivery_id']
+
+    # Columns of the jobs table. `seq` orders jobs by when they were added,
+    # and serves as the cursor for paging through history.
+    job_columns = [
+        ('seq', 'INTEGER PRIMARY KEY'),
+        ('id', 'TEXT NOT NULL UNIQUE'),
+        ('repo', 'TEXT'),
+        ('owner', 'TEXT'),
+        ('branch', 'TEXT'),
+        ('sha', 'TEXT'),
+        ('state', "TEXT NOT NULL DEFAULT 'queued'"),
+        ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ('date_added', 'NUMERIC'),
+        ('date_started', 'NUMERIC'),
+        ('date_finished', 'NUMERIC'),
+        ('error', 'TEXT'),
+    ]
+
+    # Columns of the dead letters table: everything needed to put a job back
+    # on the queue, and how it failed
+    dead_letter_columns = [
+        ('id', 'TEXT PRIMARY KEY'),
+        ('repo', 'TEXT'),
+        ('branch', 'TEXT'),
+        ('owner', 'TEXT'),
+        ('ref', 'TEXT'),
+        ('sha', 'TEXT'),
+        ('clone_url', 'TEXT'),
+        ('delivery_id', 'TEXT'),
+        ('payload', 'TEXT'),
+        ('payload_blob', 'BLOB'),
+        ('priority', 'INTEGER NOT NULL DEFAULT 0'),
+        ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ('date_added', 'NUMERIC'),
+        ('date_failed', 'NUMERIC'),
+        ('error', 'TEXT'),
+    ]
+
+    # Number of days to keep the history of finished jobs
+    history_days = 30
+
+    # Minimum number of seconds between prunes of the job history
+    prune_interval = 3600
+
+    def __init__(self, db_conn=None, lease_timeout=None, create=True):
         '''
         Initialize a connection to the datastore.
 
         Args:
             - db_conn (string): Optional SQLite connection string, if the class
                                 should use a different datastore.
+            - lease_timeout (int): Optional number of seconds before a claimed
+                                   job gets returned to the queue.
+            - create (bool): Whether to set up the schema. Skip this if the
+                             schema is known to exist already.
         '''
         if db_conn:
             self.db_conn = db_conn
 
-        self.conn = sqlite3.connect(self.db_conn)
-        self.cursor = self.conn.cursor()
+        if lease_timeout:
+            self.lease_timeout = lease_timeout
+
+        # Manage transactions explicitly, so that claims can take the write
+        # lock up front
+        self.path = split_conn(self.db_conn)[1]
+        self.last_pruned = 0
+
+        try:
+            self.conn = sqlite3.connect(self.path, isolation_level=None)
+            self.cursor = self.conn.cursor()
+
+            if create:
+                self.create_schema()
+        except sqlite3.OperationalError as e:
+            raise QueueUnavailable('Could not open %s: %s' % (self.path, e))
+
+        # Channel for waking up consumers when new work arrives
+        self.notifier = Notifier(self.db_conn)
+
+    def create_schema(self):
+        '''
+        Create the queue table and its indexes, upgrading the table in place
+        if it was created by an older version.
+        '''
+        # Let readers and the writer work concurrently. WAL mode is stored in
+        # the database file, so it only needs to be set once.
+        self.cursor.execute('PRAGMA journal_mode=WAL')
 
         # Create a table for the queue if it doesn't exist
         create_table = '''
             CREATE TABLE IF NOT EXISTS queue
-                (id TEXT, payload TEXT, date_added NUMERIC)
-        '''
+                ({columns})
+        '''.format(columns=', '.join(' '.join(col) for col in self.columns))
         self.cursor.execute(create_table)
 
-    def add(self, payload):
+        existing = [row[1] for row in self.cursor.execute('PRAGMA table_info(queue)')]
+
+        for name, definition in self.columns:
+            if name not in existing:
+                # SQLite can't add primary keys after the fact
+                definition = definition.replace('PRIMARY KEY', '')
+                self.cursor.execute('ALTER TABLE queue ADD COLUMN %s %s' % (name, definition))
+
+        if 'clone_url' not in existing:
+            self.backfill()
+
+        # Every job needs a repo to be scheduled under
+        if 'priority' not in existing:
+            self.cursor.execute("UPDATE queue SET repo = '' WHERE repo IS NULL")
+
+        # Claims look up the oldest job in a given state
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS queue_state_date_added
+                ON queue (state, date_added)
+        ''')
+
+        # Coalescing looks up jobs for a given repo and branch
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS queue_repo_branch
+                ON queue (repo, branch, state)
+        ''')
+
+        # Claims look up the top priority of each repo's queued jobs, and its
+        # oldest job at that priority
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS queue_repo_priority
+                ON queue (repo, state, priority, date_added)
+        ''')
+
+        self.create_repos()
+        self.create_jobs()
+        self.create_dead_letters()
+
+    def create_repos(self):
+        '''
+        Create the table that records the top priority of each repo's queued
+        jobs and when it last had a job claimed, for picking the repo to
+        claim from. Repos with jobs on the queue from before the table (or
+        its `top_priority` column) existed get entered into it.
+        '''
+        tables = [row[0] for row in self.cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS repos
+                (repo TEXT NOT NULL PRIMARY KEY, last_claimed NUMERIC NOT NULL DEFAULT 0,
+                 top_priority INTEGER)
+        ''')
+
+        existing = [row[1] for row in self.cursor.execute('PRAGMA table_info(repos)')]
+
+        if 'top_priority' not in existing:
+            self.cursor.execute('ALTER TABLE repos ADD COLUMN top_priority INTEGER')
+
+        if 'repos' not in tables or 'top_priority' not in existing:
+            self.cursor.execute('''
+                INSERT OR IGNORE INTO repos (repo)
+                     SELECT DISTINCT repo FROM queue
+            ''')
+            self.update_turns(self.cursor)
+
+        # Claims pick the repo with the most urgent job, then the one that
+        # has waited longest
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS repos_turn
+                ON repos (top_priority DESC, last_claimed)
+        ''')
+
+    def create_jobs(self):
+        '''
+        Create the table of job history and its indexes. Jobs that were queued
+        before the table existed get entered into it.
+        '''
+        tables = [row[0] for row in self.cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")]
+
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs
+                ({columns})
+        '''.format(columns=', '.join(' '.join(col) for col in self.job_columns)))
+
+        existing = [row[1] for row in self.cursor.execute('PRAGMA table_info(jobs)')]
+
+        for name, definition in self.job_columns:
+            if name not in existing:
+                self.cursor.execute('ALTER TABLE jobs ADD COLUMN %s %s' % (name, definition))
+
+        if 'jobs' not in tables:
+            self.cursor.execute('''
+                INSERT OR IGNORE INTO jobs (id, repo, owner, branch, sha, state, date_added)
+                     SELECT id, repo, owner, branch, sha,
+                            CASE state WHEN 'leased' THEN 'running'
+                                       WHEN 'cancelled' THEN 'cancelled'
+                                       ELSE 'queued' END,
+                            date_added
+                       FROM queue
+                   ORDER BY date_added
+            ''')
+
+        # Paging through the history of a repo
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS jobs_repo_seq
+                ON jobs (repo, seq)
+        ''')
+
+        # Pruning old history
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS jobs_date_added
+                ON jobs (date_added)
+        ''')
+
+    def create_dead_letters(self):
+        '''
+        Create the table of jobs that failed for good.
+        '''
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dead_letters
+                ({columns})
+        '''.format(columns=', '.join(' '.join(col) for col in self.dead_letter_columns)))
+
+        # Listing the most recent failures, and pruning old ones
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS dead_letters_date_failed
+                ON dead_letters (date_failed)
+        ''')
+
+    def backfill(self):
+        '''
+        Fill in the job record columns for jobs that were queued before those
+        columns existed.
+        '''
+        rows = self.cursor.execute('''
+            SELECT id, payload FROM queue WHERE payload IS NOT NULL
+        ''').fetchall()
+
+        updates = []
+        for work_id, payload in rows:
+            payload = Payload(json.loads(payload))
+
+            # Malformed payloads can't be coalesced, but can still be claimed
+            branch = payload.get_branch() if payload.ref else ''
+
+            updates.append((payload.name or '', branch, payload.owner, payload.ref,
+                            payload.sha, payload.origin, work_id))
+
+        self.cursor.executemany('''
+            UPDATE queue
+               SET repo = ?, branch = ?, owner = ?, ref = ?, sha = ?, clone_url = ?
+             WHERE id = ?
+        ''', updates)
+
+    def add(self, payload, coalesce=None, cancel_running=None, store_payload=None, priority=0):
         '''
         Package up a work payload and drop it into the queue. Returns the ID
         of the queued work.
 
         Args:
-            - payload (dict): An event from the GitHub API.
+            - payload (Payload): An event from the GitHub API, either parsed
+                                 or as a dict.
+            - coalesce (bool): Optionally override whether this job replaces
+                               queued jobs for the same repo and branch.
+            - cancel_running (bool): Optionally override whether this job
+                                     cancels running jobs for the same repo
+                                     and branch, when coalescing.
+            - store_payload (bool): Optionally override whether to keep a
+                                    compressed copy of the full payload.
+            - priority (int): Jobs with higher priorities get claimed first.
         '''
+        if coalesce is None:
+            coalesce = self.coalesce
+
+        if cancel_running is None:
+            cancel_running = self.cancel_running
+
+        if store_payload is None:
+            store_payload = self.store_payload
+
+        self.check_priority(priority)
+
+        if not isinstance(payload, Payload):
+            payload = Payload(payload)
+
         work_id = str(uuid4())
+        repo, owner = payload.name or '', payload.owner
+        branch = payload.get_branch() if payload.ref else ''
+
+        blob = None
+        if store_payload and payload.raw:
+            blob = zlib.compress(json.dumps(payload.raw).encode('utf-8'))
 
         insert = '''
             INSERT INTO queue
-                     (id, payload, date_added)
-              VALUES (?, ?, ?)
+                     (id, date_added, repo, branch, owner, ref, sha, clone_url,
+                      delivery_id, payload_blob, priority)
+              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         '''
-        self.cursor.execute(insert, (work_id, json.dumps(payload), time.time()))
+        now = time.time()
+        values = (work_id, now, repo, branch, owner, payload.ref, payload.sha,
+                  payload.origin, payload.delivery, blob, priority)
 
-        self.conn.commit()
+        insert_job = '''
+            INSERT INTO jobs (id, repo, owner, branch, sha, state, date_added)
+                 VALUES (?, ?, ?, ?, ?, 'queued', ?)
+        '''
+        job_values = (work_id, repo, owner, branch, payload.sha, now)
+
+        def write(cursor):
+            if coalesce:
+                self.supersede(cursor, repo, owner, branch, cancel_running)
+
+            cursor.execute(insert, values)
+            cursor.execute(insert_job, job_values)
+            cursor.execute('INSERT OR IGNORE INTO repos (repo) VALUES (?)', (repo,))
+            self.update_turns(cursor, [repo])
+
+        try:
+            self.transaction(write)
+        except sqlite3.OperationalError as e:
+            raise QueueUnavailable('Could not add job to %s: %s' % (self.path, e))
+
+        self.notifier.notify()
 
         return work_id
 
-    def pop(self):
+    def transaction(self, write):
         '''
-        Return the most recent payload and remove it from the queue.
+        Run a write in its own transaction, or hand it off to be committed
+        alongside other writes if group commit is turned on.
+
+        Args:
+            - write (callable): Function that takes a cursor and performs
+                                the write.
         '''
-        # Start a transaction for the duration of the write
-        self.cursor.execute('BEGIN TRANSACTION')
+        if self.committer:
+            return self.committer.submit(write)
 
-        self.cursor.execute('SELECT * FROM queue ORDER BY date_added LIMIT 1')
-        work = self.cursor.fetchone()
+        self.cursor.execute('BEGIN IMMEDIATE')
 
-        if work:
-            work_id = work[0]
-            payload = json.loads(work[1])
+        try:
+            result = write(self.cursor)
+            self.cursor.execute('COMMIT')
+        except Exception:
+            self.cursor.execute('ROLLBACK')
+            raise
 
-            # Delete the job from the queue
-            self.cursor.execute('DELETE FROM queue WHERE id = ?', (work_id,))
+        return result
+
+    def update_turns(self, cursor, repos=None):
+        '''
+        Record the top priority of the queued jobs of some repos (or of every
+        repo), for `claim` to pick the next repo by. Each one is a seek on the
+        `queue_repo_priority` index. Repos with nothing queued get NULL. Meant
+        to be run inside the transaction that changed their jobs.
+        '''
+        update = '''
+            UPDATE repos
+               SET top_priority = (SELECT MAX(priority) FROM queue
+                                    WHERE queue.repo = repos.repo AND state = 'queued')
+        '''
+
+        if repos is None:
+            cursor.execute(update)
         else:
-            # No work was found in the queue
-            payload = None
+            cursor.executemany(update + ' WHERE repo = ?', [(repo,) for repo in set(repos)])
+
+    def job_repos(self, cursor, work_id):
+        '''
+        Return the repo of a job on the queue as a list, or an empty list if
+        there's no such job.
+        '''
+        cursor.execute('SELECT repo FROM queue WHERE id = ?', (work_id,))
+
+        return [row[0] for row in cursor.fetchall()]
+
+    def supersede(self, cursor, repo, owner, branch, cancel_running=False):
+        '''
+        Drop queued jobs (including ones waiting to be retried) for a repo and
+        branch, and optionally cancel running ones. Meant to be run inside the
+        transaction that adds the new job.
+        '''
+        # Record the dropped jobs as cancelled before they leave the queue
+        cursor.execute('''
+            UPDATE jobs
+               SET state = 'cancelled', date_finished = ?
+             WHERE id IN (SELECT id FROM queue
+                           WHERE repo = ? AND branch = ? AND owner IS ?
+                             AND state IN ('queued', 'delayed'))
+        ''', (time.time(), repo, branch, owner))
+
+        cursor.execute('''
+            DELETE FROM queue
+             WHERE repo = ? AND branch = ? AND state IN ('queued', 'delayed') AND owner IS ?
+        ''', (repo, branch, owner))
+
+        if cancel_running:
+            # Running jobs are recorded as cancelled once their workers stop
+            cursor.execute('''
+                UPDATE queue
+                   SET state = 'cancelled'
+                 WHERE repo = ? AND branch = ? AND state = 'leased' AND owner IS ?
+            ''', (repo, branch, owner))
+
+    def claim(self, lease_timeout=None, exclude=None):
+        '''
+        Atomically lease the next job on the queue and return it as a `Job`,
+        or return None if there's no work. The job stays on the queue until
+        it gets acknowledged with `ack`.
+
+        The next job belongs to whichever repo has the highest-priority job
+        waiting, taking turns between repos that tie. Repos are picked with a
+        seek on the `repos_turn` index, and their jobs with a seek on the
+        `queue_repo_priority` index, so the cost doesn't grow with the number
+        of repos or jobs.
+
+        Args:
+            - lease_timeout (int): Optional number of seconds to lease the job
+                                   for, if it should differ from the default.
+            - exclude (list): Optional names of repos to skip over (e.g.
+                              because they already have a job running).
+        '''
+        now = time.time()
+        expires = now + (lease_timeout or self.lease_timeout)
+        exclude = list(exclude or [])
+
+        # Pick the repo with the most urgent job, or if there's a tie, the
+        # one that has waited longest for a turn. Repos with nothing queued
+        # have no top priority.
+        select_repo = '''
+            SELECT repo, top_priority
+              FROM repos
+             WHERE top_priority IS NOT NULL AND repo NOT IN ({placeholders})
+             ORDER BY top_priority DESC, last_claimed, rowid
+             LIMIT 1
+        '''.format(placeholders=', '.join('?' for _ in exclude))
+
+        select = '''
+            SELECT id, date_added, {record}, payload, payload_blob
+              FROM queue
+             WHERE repo = ? AND state = 'queued' AND priority = ?
+             ORDER BY date_added
+             LIMIT 1
+        '''.format(record=', '.join(self.record))
 
-        self.conn.commit()
+        # Take the write lock before reading, so that no other consumer can
+        # claim the same job in between
+        self.cursor.execute('BEGIN IMMEDIATE')
+
+        try:
+            # Repos that jobs are about to be queued up again for
+            self.cursor.execute('''
+                SELECT repo FROM queue WHERE state = 'delayed' AND not_before <= ?
+                 UNION
+                SELECT repo FROM queue WHERE state = 'leased' AND lease_expires < ?
+            ''', (now, now))
+            requeued = [row[0] for row in self.cursor.fetchall()]
+
+            # Queue up jobs that are due to be retried
+            self.cursor.execute('''
+                UPDATE queue
+                   SET state = 'queued', not_before = NULL
+                 WHERE state = 'delayed' AND not_before <= ?
+            ''', (now,))
+
+            # Return jobs whose workers stopped renewing their leases
+            self.cursor.execute('''
+                UPDATE jobs
+                   SET state = 'queued', date_started = NULL
+                 WHERE id IN (SELECT id FROM queue
+                               WHERE state = 'leased' AND lease_expires < ?)
+            ''', (now,))
+
+            self.cursor.execute('''
+                UPDATE queue
+                   SET state = 'queued', lease_expires = NULL
+                 WHERE state = 'leased' AND lease_expires < ?
+            ''', (now,))
+
+            # Clean up cancelled jobs whose workers have gone away
+            self.cursor.execute('''
+                UPDATE jobs
+                   SET state = 'cancelled', date_finished = ?
+                 WHERE id IN (SELECT id FROM queue
+                               WHERE state = 'cancelled' AND lease_expires < ?)
+            ''', (now, now))
+
+            self.cursor.execute('''
+                DELETE FROM queue
+                 WHERE state = 'cancelled' AND lease_expires < ?
+            ''', (now,))
+
+            if requeued:
+                self.update_turns(self.cursor, requeued)
+
+            work = None
+            self.cursor.execute(select_repo, exclude)
+            turn = self.cursor.fetchone()
+
+            if turn:
+                self.cursor.execute(select, turn)
+                work = self.cursor.fetchone()
+
+                # Send the repo to the back of the line
+                self.cursor.execute('''
+                    UPDATE repos SET last_claimed = ? WHERE repo = ?
+                ''', (now, turn[0]))
+
+            if work:
+                self.cursor.execute('''
+                    UPDATE queue
+                       SET state = 'leased', lease_expires = ?, attempts = attempts + 1
+                     WHERE id = ?
+                ''', (expires, work[0]))
+
+                self.cursor.execute('''
+                    UPDATE jobs
+                       SET state = 'running', date_started = ?, attempts = attempts + 1
+                     WHERE id = ?
+                ''', (now, work[0]))
+
+                self.update_turns(self.cursor, [turn[0]])
+
+            self.cursor.execute('COMMIT')
+        except Exception:
+            self.cursor.execute('ROLLBACK')
+            raise
+
+        if not work:
+            return None
+
+        return Job(work[0], self.load(work[2:]), date_added=work[1])
+
+    def load(self, row):
+        '''
+        Rebuild the Payload for a job from its record columns, attaching the
+        full payload if one was stored.
+        '''
+        record, legacy, blob = row[:-2], row[-2], row[-1]
+
+        payload = Payload.from_record(*record)
+
+        if blob:
+            payload.raw = json.loads(zlib.decompress(blob).decode('utf-8'))
+        elif legacy:
+            payload.raw = json.loads(legacy)
 
         return payload
 
-    def run(self):
+    def cancel_check(self, work_id):
+        '''
+        Return a function that checks whether a claimed job has been
+        cancelled. SQLite connections can only be used by the thread that
+        opened them, so calls from other threads (like the ones that run
+        parallel scripts) go through a queue of their own.
+        '''
+        owner = threading.get_ident()
+
+        def cancelled():
+            queue = self if threading.get_ident() == owner else get_queue(self.db_conn)
+            return queue.is_cancelled(work_id)
+
+        return cancelled
+
+    def is_cancelled(self, work_id):
+        '''
+        Check whether a claimed job has been superseded by a newer push.
+        '''
+        self.cursor.execute('SELECT state FROM queue WHERE id = ?', (work_id,))
+        work = self.cursor.fetchone()
+
+        return bool(work) and work[0] == 'cancelled'
+
+    def attempts(self, work_id):
         '''
-        Check for work on the queue, and if it exists, deploy it.
+        Return the number of times that a job on the queue has been claimed,
+        or None if there's no such job.
         '''
-        # Look for any work on the queue
-        self.cursor.execute('SELECT * FROM queue')
+        self.cursor.execute('SELECT attempts FROM queue WHERE id = ?', (work_id,))
         work = self.cursor.fetchone()
 
-        if work:
-            payload = self.pop()
-            worker = Worker(payload)
-            worker.deploy()
+        return work[0] if work else None
+
+    def renew(self, work_ids, lease_timeout=None):
+        '''
+        Extend the leases on jobs that are still being worked on. Jobs that
+        were cancelled while running keep their leases too, so that they stay
+        cancelled until their workers notice.
+        '''
+        expires = time.time() + (lease_timeout or self.lease_timeout)
+
+        self.cursor.executemany('''
+            UPDATE queue
+               SET lease_expires = ?
+             WHERE id = ? AND state IN ('leased', 'cancelled')
+        ''', [(expires, work_id) for work_id in work_ids])
+
+    def ack(self, work_id, state='succeeded', error=None):
+        '''
+        Mark a claimed job as finished and remove it from the queue.
+
+        Args:
+            - work_id (string): ID of the job.
+            - state (string): How the job finished: 'succeeded', 'failed'
+                              or 'cancelled'.
+            - error (string): Optional description of what went wrong.
+        '''
+        self.check_state(state)
+
+        def write(cursor):
+            cursor.execute('''
+                UPDATE jobs
+                   SET state = ?, date_finished = ?, error = ?
+                 WHERE id = ?
+            ''', (state, time.time(), error, work_id))
+
+            repos = self.job_repos(cursor, work_id)
+            cursor.execute('DELETE FROM queue WHERE id = ?', (work_id,))
+            self.update_turns(cursor, repos)
+
+        self.transaction(write)
+        self.prune()
+
+    def nack(self, work_id):
+        '''
+        Give up the lease on a claimed job and return it to the queue.
+        '''
+        def write(cursor):
+            cursor.execute('''
+                UPDATE queue
+                   SET state = 'queued', lease_expires = NULL
+                 WHERE id = ?
+            ''', (work_id,))
+
+            cursor.execute('''
+                UPDATE jobs
+                   SET state = 'queued', date_started = NULL
+                 WHERE id = ?
+            ''', (work_id,))
+
+            self.update_turns(cursor, self.job_repos(cursor, work_id))
+
+        self.transaction(write)
+
+        self.notifier.notify()
+
+    def retry(self, work_id, not_before, error=None):
+        '''
+        Return a claimed job to the queue, to be claimed again no sooner than
+        the `not_before` timestamp. Until then, it's 'delayed'.
+
+        Args:
+            - work_id (string): ID of the job.
+            - not_before (float): Timestamp to wait until.
+            - error (string): Optional description of what went wrong on the
+                              last attempt.
+        '''
+        def write(cursor):
+            cursor.execute('''
+                UPDATE queue
+                   SET state = 'delayed', lease_expires = NULL, not_before = ?
+                 WHERE id = ?
+            ''', (not_before, work_id))
+
+            cursor.execute('''
+                UPDATE jobs
+                   SET state = 'queued', date_started = NULL, error = ?
+                 WHERE id = ?
+            ''', (error, work_id))
+
+        self.transaction(write)
+
+    def bury(self, work_id, error=None):
+        '''
+        Mark a claimed job as failed and move it from the queue to the dead
+        letters.
+
+        Args:
+            - work_id (string): ID of the job.
+            - error (string): Optional description of what went wrong.
+        '''
+        columns = [name for name, _ in self.dead_letter_columns
+                   if name not in ('date_failed', 'error')]
+
+        def write(cursor):
+            now = time.time()
+
+            cursor.execute('''
+                INSERT OR REPLACE INTO dead_letters ({columns}, date_failed, error)
+                     SELECT {columns}, ?, ? FROM queue WHERE id = ?
+            '''.format(columns=', '.join(columns)), (now, error, work_id))
+
+            cursor.execute('''
+                UPDATE jobs
+                   SET state = 'failed', date_finished = ?, error = ?
+                 WHERE id = ?
+            ''', (now, error, work_id))
+
+            repos = self.job_repos(cursor, work_id)
+            cursor.execute('DELETE FROM queue WHERE id = ?', (work_id,))
+            self.update_turns(cursor, repos)
+
+        self.transaction(write)
+        self.prune()
+
+    def dead_letters(self, limit=20):
+        '''
+        Return the jobs that failed for good (as dicts), most recent failure
+        first.
+        '''
+        self.cursor.execute('''
+            SELECT {columns}
+              FROM dead_letters
+             ORDER BY date_failed DESC
+             LIMIT ?
+        '''.format(columns=', '.join(self.dead_letter_fields)), (limit,))
+
+        return [dict(zip(self.dead_letter_fields, row)) for row in self.cursor.fetchall()]
+
+    def revive(self, work_id):
+        '''
+        Put a dead letter back on the queue, under its old ID, for another
+        round of attempts. Returns False if there's no such dead letter.
+        '''
+        columns = ['id', 'repo', 'branch', 'owner', 'ref', 'sha', 'clone_url',
+                   'delivery_id', 'payload', 'payload_blob', 'priority']
+
+        def write(cursor):
+            now = time.time()
+
+            cursor.execute('''
+                INSERT INTO queue ({columns}, date_added)
+                     SELECT {columns}, ? FROM dead_letters WHERE id = ?
+            '''.format(columns=', '.join(columns)), (now, work_id))
+
+            if not cursor.rowcount:
+                return False
+
+            cursor.execute('''
+                INSERT OR IGNORE INTO repos (repo)
+                     SELECT repo FROM dead_letters WHERE id = ?
+            ''', (work_id,))
+            self.update_turns(cursor, self.job_repos(cursor, work_id))
+
+            # Jobs whose history was pruned get a new entry
+            cursor.execute('''
+                INSERT OR IGNORE INTO jobs (id, repo, owner, branch, sha)
+                     SELECT id, repo, owner, branch, sha FROM dead_letters WHERE id = ?
+            ''', (work_id,))
+
+            cursor.execute('''
+                UPDATE jobs
+                   SET state = 'queued', attempts = 0, date_added = ?, date_started = NULL,
+                       date_finished = NULL, error = NULL
+                 WHERE id = ?
+            ''', (now, work_id))
+
+            cursor.execute('DELETE FROM dead_letters WHERE id = ?', (work_id,))
+
+            return True
+
+        revived = self.transaction(write)
+
+        if revived:
+            self.notifier.notify()
+
+        return revived
+
+    def prune(self, force=False):
+        '''
+        Remove the history of jobs that finished more than `history_days` ago.
+        This runs at most once every `prune_interval` seconds, unless forced.
+        '''
+        now = time.time()
+
+        if not force and now - self.last_pruned < self.prune_interval:
+            return
+
+        self.last_pruned = now
+        cutoff = now - self.history_days * 24 * 60 * 60
+
+        self.cursor.execute('''
+            DELETE FROM jobs
+             WHERE date_added < ? AND state IN ({states})
+        '''.format(states=', '.join('?' for _ in self.finished_states)),
+            (cutoff,) + self.finished_states)
+
+        self.cursor.execute('DELETE FROM dead_letters WHERE date_failed < ?', (cutoff,))
+
+        # Forget repos with nothing on the queue. They'll be back at the front
+        # of the line when they next push, like they would have been anyway.
+        self.cursor.execute('''
+            DELETE FROM repos
+             WHERE NOT EXISTS (SELECT 1 FROM queue WHERE queue.repo = repos.repo)
+        ''')
+
+    def depth(self):
+        '''
+        Count the jobs on the queue in each state, as a dict.
+        '''
+        self.cursor.execute('SELECT state, COUNT(*) FROM queue GROUP BY state')
+
+        return dict(self.cursor.fetchall())
+
+    def status(self, work_id):
+        '''
+        Return the history of a job as a dict, or None if there's no such job.
+        '''
+        self.cursor.execute('''
+            SELECT {columns} FROM jobs WHERE id = ?
+        '''.format(columns=', '.join(self.job_fields)), (work_id,))
+
+        row = self.cursor.fetchone()
+
+        return dict(zip(self.job_fields, row)) if row else None
+
+    def history(self, repo=None, before=None, limit=20):
+        '''
+        Return a page of job history, newest first. Returns a tuple of the
+        jobs (as dicts) and the cursor for the next page, which is None on the
+        last page.
+
+        Args:
+            - repo (string): Optional name of a repo to limit the history to.
+            - before (int): Optional cursor from the previous page.
+            - limit (int): Maximum number of jobs to return.
+        '''
+        conditions = []
+        values = []
+
+        if repo is not None:
+            conditions.append('repo = ?')
+            values.append(repo)
+
+        if before is not None:
+            conditions.append('seq < ?')
+            values.append(before)
+
+        # Fetch one extra row, to find out if there's another page
+        self.cursor.execute('''
+            SELECT seq, {columns}
+              FROM jobs
+             {where}
+             ORDER BY seq DESC
+             LIMIT ?
+        '''.format(columns=', '.join(self.job_fields),
+                   where='WHERE ' + ' AND '.join(conditions) if conditions else ''),
+            values + [limit + 1])
+
+        rows = self.cursor.fetchall()
+        jobs = [dict(zip(self.job_fields, row[1:])) for row in rows[:limit]]
+        cursor = rows[limit - 1][0] if len(rows) > limit else None
+
+        return jobs, cursor
+
+    @property
+    def job_fields(self):
+        '''
+        Columns of the jobs table that describe a job to clients.
+        '''
+        return [name for name, _ in self.job_columns if name != 'seq']
+
+    def close(self):
+        '''
+        Close the connection to the datastore.
+        '''
+        self.notifier.close()
+        self.conn.close()
+
+
+# Queue backends, by the prefix that names them in connection strings
+BACKENDS = {
+    Queue.backend: Queue,
+    MemoryQueue.backend: MemoryQueue,
+    SpoolQueue.backend: SpoolQueue,
+}
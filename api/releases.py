@@ -0,0 +1,214 @@
+# releases.py -- keep each deploy in a release directory of its own
+import os
+import time
+import shutil
+import logging
+
+from api.exceptions import WorkerException
+
+
+class Release(object):
+    '''
+    A directory that a commit gets deployed into.
+    '''
+    def __init__(self, root, name, sha, created=None):
+        '''
+        Initialize the release.
+
+        Args:
+            - root (string): Directory that releases are kept in.
+            - name (string): Name of the release directory.
+            - sha (string): Commit that the release holds.
+            - created (float): When the release was made, as a timestamp.
+                               Defaults to now.
+        '''
+        self.name = name
+        self.sha = sha
+        self.created = created if created is not None else time.time()
+        self.path = os.path.join(root, name)
+
+
+class Releases(object):
+    '''
+    Deploy every commit of a repo into a fresh directory of its own, in
+    `<home>/releases/<sha>`, and serve the live one through the symlink
+    `<home>/current`. The symlink is swapped in one step, by renaming a new
+    link over it, so the app never sees a half-deployed tree, and rolling
+    back is only a matter of pointing it at an earlier release.
+
+    Releases are recorded oldest first in `<home>/.releases`, one per line,
+    with the commit they hold and when they were made.
+    '''
+    # Default number of releases to keep, counting the live one
+    keep = 5
+
+    def __init__(self, clone_path, keep=None):
+        '''
+        Initialize the releases.
+
+        Args:
+            - clone_path (string): The repo's `home` directory.
+            - keep (int): Optional number of releases to keep when pruning.
+        '''
+        self.home = os.path.abspath(clone_path)
+        self.root = os.path.join(self.home, 'releases')
+        self.current_path = os.path.join(self.home, 'current')
+        self.history_path = os.path.join(self.home, '.releases')
+
+        if keep:
+            self.keep = keep
+
+    def history(self):
+        '''
+        Return the recorded releases, oldest first.
+        '''
+        try:
+            with open(self.history_path) as history:
+                lines = history.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+        releases = []
+        for line in lines:
+            name, sha, created = line.split()
+            releases.append(Release(self.root, name, sha, float(created)))
+
+        return releases
+
+    def record(self, releases):
+        '''
+        Replace the recorded releases.
+        '''
+        # Write atomically, so a crash never leaves a half-written history
+        with open(self.history_path + '.tmp', 'w') as history:
+            for release in releases:
+                history.write('%s %s %.6f\n' % (release.name, release.sha, release.created))
+        os.replace(self.history_path + '.tmp', self.history_path)
+
+    def live(self):
+        '''
+        Return the release that `current` points at, or None if there isn't
+        one.
+        '''
+        try:
+            name = os.path.basename(os.readlink(self.current_path))
+        except OSError:
+            return None
+
+        for release in self.history():
+            if release.name == name:
+                return release
+
+        return None
+
+    def find(self, ref):
+        '''
+        Return the newest release that's named `ref`, or holds a commit whose
+        sha starts with it. Returns None if there isn't one.
+        '''
+        matches = [release for release in self.history()
+                   if release.name == ref or release.sha.startswith(ref)]
+
+        return matches[-1] if matches else None
+
+    def create(self, sha):
+        '''
+        Return a new release for a commit, to be extracted and built. It's
+        named after the commit, unless that commit is live already: the live
+        release can't be rebuilt in place, so it gets a numbered name instead.
+        '''
+        os.makedirs(self.root, exist_ok=True)
+
+        live = self.live()
+        name = sha
+        count = 1
+
+        while live and name == live.name:
+            count += 1
+            name = '%s.%d' % (sha, count)
+
+        return Release(self.root, name, sha)
+
+    def point(self, release):
+        '''
+        Swap `current` over to a release in one step.
+        '''
+        link_path = self.current_path + '.tmp'
+
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+
+        os.symlink(os.path.join('releases', release.name), link_path)
+
+        try:
+            os.replace(link_path, self.current_path)
+        except OSError as e:
+            os.remove(link_path)
+            raise WorkerException('Could not point %s at release %s: %s' %
+                                  (self.current_path, release.name, e))
+
+    def activate(self, release):
+        '''
+        Make a release the live one, and record it as the newest.
+        '''
+        releases = [old for old in self.history() if old.name != release.name]
+        self.record(releases + [release])
+
+        logging.info('Switching {current} to release {name}...'.format(
+            current=self.current_path, name=release.name))
+        self.point(release)
+
+    def discard(self, release):
+        '''
+        Remove a release that never went live (e.g. because its build failed).
+        '''
+        self.record([old for old in self.history() if old.name != release.name])
+        shutil.rmtree(release.path, ignore_errors=True)
+
+    def rollback(self, ref=None):
+        '''
+        Point `current` back at an earlier release: the one named by `ref`
+        (see `find`), or the one recorded before the live one. Returns the
+        release that's now live.
+        '''
+        releases = self.history()
+
+        if ref:
+            target = self.find(ref)
+        else:
+            live = self.live()
+            names = [release.name for release in releases]
+            earlier = releases[:names.index(live.name)] if live else releases
+            earlier = [release for release in earlier if os.path.isdir(release.path)]
+            target = earlier[-1] if earlier else None
+
+        if not target or not os.path.isdir(target.path):
+            raise WorkerException('No release to roll back to in %s' % self.home)
+
+        logging.info('Rolling {current} back to release {name}...'.format(
+            current=self.current_path, name=target.name))
+        self.point(target)
+
+        return target
+
+    def prune(self):
+        '''
+        Remove all but the `keep` newest releases, and the live one, along
+        with any release directories that were never recorded (e.g. from
+        deploys that were interrupted).
+        '''
+        releases = self.history()
+        live = self.live()
+
+        newest = set(release.name for release in releases[-self.keep:])
+        kept = [release for release in releases
+                if release.name in newest or (live and release.name == live.name)]
+
+        self.record(kept)
+
+        names = set(release.name for release in kept)
+
+        for name in os.listdir(self.root):
+            if name not in names:
+                logging.info('Removing old release %s' % os.path.join(self.root, name))
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
@@ -1,14 +1,18 @@
 # app.py -- routes for the app
 import json
+import time
 import logging
-from hmac import new as hmac_new
-from datetime import datetime
 
-from flask import request, make_response, g
+from flask import request, make_response, g, Response, stream_with_context
 
 from api import app
-from api.queue import Queue
-from api.payload import Payload
+from api.ingest import check_payload, select_tokens, enqueue
+from api.queue import get_queue
+from api.signatures import get_signer, get_signature, verify
+from api.logs import logger, describe_request
+from api.buildlogs import read_log, log_dir
+from api.metrics import get_registry, metrics_dir, collect, render
+from api.exceptions import QueueException, QueueUnavailable
 
 
 def prep_response(request, resp, status_code):
@@ -20,21 +24,13 @@ def prep_response(request, resp, status_code):
         - resp (dict)       -> JSON to return
         - status_code (int) -> HTTP status code
     '''
-    # Log data on this request/response cycle
-    curr = str(datetime.now())
-    metadata = '''
-        Time: {curr}
-        Response code: {status_code}
-        Response body: {resp}
-        Request headers: {headers}
-        Request payload: {payload}
-    '''.format(curr=curr,
-               headers=request.headers,
-               payload=request.get_json(),
-               status_code=status_code,
-               resp=resp)
-
-    logging.debug(metadata)
+    # Log data on this request/response cycle, but only collect it if
+    # someone is listening
+    if logger.isEnabledFor(logging.DEBUG):
+        fields = describe_request(request, resp, status_code,
+                                  payload=app.config.get('LOG_PAYLOAD', 'truncate'),
+                                  max_bytes=app.config.get('LOG_PAYLOAD_BYTES', 1024))
+        logger.debug('Request to %s', request.path, extra={'fields': fields})
 
     response = make_response(json.dumps(resp), status_code)
     response.headers['Content-Type'] = 'application/json'
@@ -49,41 +45,53 @@ def queue(payload_json, branch_name):
         - payload_json (dict):      -> POST request information received from GitHub
         - branch_name (string) -> Name of the branch that was POSTed to
     '''
-    payload = Payload(payload_json)
+    status_code, status = check_payload(payload_json, branch_name)
+    resp = {'status': status}
 
-    if payload.validate(branch_name):
+    if status_code == 202:
         # This branch is approved for builds, so queue up work
-        queue = Queue()
-        queue.add(payload_json)
+        try:
+            resp['id'] = enqueue(app.config, payload_json,
+                                 request.headers.get('X-GitHub-Delivery'))
+        except QueueUnavailable as e:
+            resp = {'status': 'Could not queue build: %s' % e}
+            return prep_response(request, resp, 503)
 
-        status_code = 202
-        status = 'Build started for ref %s of repo %s' % (payload.get('ref'),
-                                                          payload.get('repository')['name'])
+    # Return response
+    return prep_response(request, resp, status_code)
 
-    else:
-        # Branch not approved; nothing to do
-        status_code = 400
 
-        if payload.get('ref'):
-            status = 'Skipping build for unregistered branch "{ref}"'.format(ref=payload.get('ref'))
-        else:
-            status = 'Malformed request payload: {payload}'.format(payload=payload.as_dict)
+def get_hmac(token, body=b'', digestmod='sha1'):
+    '''
+    Compute the HMAC hexadigest signature of a request body (GitHub's way of
+    creating hashes for authentication).
 
-    # Return response
-    resp = {'status': status}
-    return prep_response(request, resp, status_code)
+    Arguments:
+        - token (str)     -> Secret key to use for the hash.
+        - body (bytes)    -> Raw request body to sign.
+        - digestmod (str) -> Hash algorithm, either 'sha1' or 'sha256'.
+    '''
+    return get_signer(token).sign(body, digestmod)
 
 
-def get_hmac(token):
+def get_tokens(payload_json):
     '''
-    Check the HMAC hexadigest signature of a token (GitHub's way of creating
-    hashes for authentication).
+    Return the secret tokens that a payload could have been signed with.
 
     Arguments:
-        - token (str) -> Secret key to use for the hash.
+        - payload_json (dict) -> POST request information received from GitHub
     '''
-    token_sig = hmac_new(token.encode('utf-8'), digestmod='sha1')
-    return 'sha1=' + token_sig.hexdigest()
+    tokens = g.get('tokens', app.config.get('TOKENS', []))
+    repo_tokens = g.get('repo_tokens', app.config.get('REPO_TOKENS', {}))
+
+    return select_tokens(payload_json, tokens, repo_tokens)
+
+
+def get_metrics():
+    '''
+    Return the app's metrics registry.
+    '''
+    return get_registry(app.config.get('METRICS_DIR') or metrics_dir())
 
 
 @app.route('/hooks/github/<branch_name>', methods=['POST'])
@@ -96,19 +104,35 @@ def receive_post(branch_name):
         - branch_name (str) -> the branch that is being POSTed to (extracted
                                as a URL param by Flask)
     '''
+    start = time.perf_counter()
+    response = handle_post(branch_name)
+
+    metrics = get_metrics()
+    metrics.observe('bunny_hook_webhook_seconds', time.perf_counter() - start)
+    metrics.inc('bunny_hook_webhook_requests_total', status=response.status_code)
+
+    return response
+
+
+def handle_post(branch_name):
+    '''
+    Authenticate a webhook and queue it up, returning the response.
+
+    Arguments:
+        - branch_name (str) -> the branch that is being POSTed to
+    '''
     # Validate the request
     # Docs: https://developer.github.com/webhooks/securing/#validating-payloads-from-github
-    post_sig = request.headers.get('X-Hub-Signature')
+    algorithm, post_sig = get_signature(request.headers)
 
     if post_sig:
-        # Retrieve secret tokens from the application context
-        tokens = g.get('tokens', [])
+        # The signature covers the raw body, so read it before parsing
+        body = request.get_data(cache=True)
+        payload_json = request.get_json(silent=True)
 
-        for token in tokens:
-            if get_hmac(token) == post_sig:
-                # Payload is good; queue up work
-                payload_json = request.get_json()
-                return queue(payload_json, branch_name)
+        if verify(body, algorithm, post_sig, get_tokens(payload_json)):
+            # Payload is good; queue up work
+            return queue(payload_json, branch_name)
 
         # None of the tokens matched
         status_code = 401
@@ -121,3 +145,91 @@ def receive_post(branch_name):
     # Return response
     resp = {'status': status}
     return prep_response(request, resp, status_code)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    '''
+    Report the state of a job, and when it moved between states.
+
+    Arguments:
+        - job_id (str) -> the ID that the job was queued under
+    '''
+    job = get_queue(app.config.get('QUEUE_DB')).status(job_id)
+
+    if not job:
+        resp = {'status': 'No job found with ID %s' % job_id}
+        return prep_response(request, resp, 404)
+
+    return prep_response(request, job, 200)
+
+
+@app.route('/jobs', methods=['GET'])
+def job_history():
+    '''
+    List jobs, newest first, optionally for a single repo (`?repo=<name>`).
+    Results come in pages of `?limit=` jobs (at most 100); pass the `next`
+    cursor from one page as `?before=` to get the next one.
+    '''
+    try:
+        limit = min(int(request.args.get('limit', 20)), 100)
+        before = request.args.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        resp = {'status': '`limit` and `before` should be integers'}
+        return prep_response(request, resp, 400)
+
+    if limit < 1:
+        resp = {'status': '`limit` should be at least 1'}
+        return prep_response(request, resp, 400)
+
+    try:
+        jobs, cursor = get_queue(app.config.get('QUEUE_DB')).history(
+            repo=request.args.get('repo'), before=before, limit=limit)
+    except QueueException as e:
+        # Not every queue backend keeps a history
+        resp = {'status': str(e)}
+        return prep_response(request, resp, 501)
+
+    resp = {'jobs': jobs, 'next': cursor}
+    return prep_response(request, resp, 200)
+
+
+@app.route('/jobs/<job_id>/log', methods=['GET'])
+def job_log(job_id):
+    '''
+    Stream the build log for a job. With `?follow=1`, keep the response open
+    and send new output as it arrives, until the job finishes.
+
+    Arguments:
+        - job_id (str) -> the ID that the job was queued under
+    '''
+    follow = request.args.get('follow', '') in ('1', 'true', 'yes')
+
+    chunks = read_log(app.config.get('LOG_DIR') or log_dir(), job_id, follow=follow,
+                      timeout=app.config.get('LOG_FOLLOW_TIMEOUT', 3600))
+
+    if chunks is None:
+        resp = {'status': 'No log found for job %s' % job_id}
+        return prep_response(request, resp, 404)
+
+    # Without a Content-Length, the log goes out chunked as it's read
+    return Response(stream_with_context(chunks), mimetype='text/plain')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    '''
+    Report metrics from the app server and every worker, in the Prometheus
+    text format, along with how many jobs are on the queue.
+    '''
+    # Report this process's latest numbers along with everyone else's
+    get_metrics().flush()
+    counters, histograms = collect(app.config.get('METRICS_DIR') or metrics_dir())
+
+    depth = get_queue(app.config.get('QUEUE_DB')).depth()
+    gauges = {('bunny_hook_queue_depth', (('state', state),)): depth.get(state, 0)
+              for state in ('queued', 'delayed', 'leased', 'cancelled')}
+
+    return Response(render(counters, histograms, gauges),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,2 +1,6 @@
 # Secret tokens for GitHub authentication go here
 TOKENS = []
+
+# Optionally, map repos (by "owner/name" or "name") to the token that their
+# hook was registered with, so that payloads are only checked against it
+REPO_TOKENS = {}
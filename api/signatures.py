@@ -0,0 +1,91 @@
+# signatures.py -- verify that payloads were signed by GitHub
+import hmac
+import threading
+
+# Signature headers that GitHub sends, in order of preference
+# Docs: https://developer.github.com/webhooks/securing/#validating-payloads-from-github
+HEADERS = [
+    ('X-Hub-Signature-256', 'sha256'),
+    ('X-Hub-Signature', 'sha1'),
+]
+
+
+class Signer(object):
+    '''
+    Sign request bodies with a secret token.
+
+    Keying an HMAC hashes the secret, so the keyed state is computed once per
+    token and copied for every request, leaving only the body to hash.
+    '''
+    def __init__(self, token):
+        key = token.encode('utf-8')
+
+        self.states = {
+            algorithm: hmac.new(key, digestmod=algorithm)
+            for _, algorithm in HEADERS
+        }
+
+    def sign(self, body, algorithm='sha256'):
+        '''
+        Return a GitHub-style signature (e.g. "sha256=<hexdigest>") of a
+        request body.
+
+        Arguments:
+            - body (bytes)      -> Raw request body.
+            - algorithm (str)   -> Either 'sha256' or 'sha1'.
+        '''
+        mac = self.states[algorithm].copy()
+        mac.update(body)
+        return algorithm + '=' + mac.hexdigest()
+
+
+# Keyed states are cached for the life of the process
+_signers = {}
+_signers_lock = threading.Lock()
+
+
+def get_signer(token):
+    '''
+    Return the cached Signer for a token.
+    '''
+    signer = _signers.get(token)
+
+    if not signer:
+        with _signers_lock:
+            signer = _signers.setdefault(token, Signer(token))
+
+    return signer
+
+
+def get_signature(headers):
+    '''
+    Return the strongest signature in a set of request headers, as an
+    (algorithm, signature) tuple, or (None, None) if there isn't one.
+    '''
+    for header, algorithm in HEADERS:
+        signature = headers.get(header)
+
+        if signature:
+            return algorithm, signature
+
+    return None, None
+
+
+def verify(body, algorithm, signature, tokens):
+    '''
+    Check a signature against every candidate token, in constant time for
+    each comparison. Returns True if any of the tokens produced the signature.
+
+    Arguments:
+        - body (bytes)      -> Raw request body.
+        - algorithm (str)   -> Hash algorithm that the signature uses.
+        - signature (str)   -> Signature sent with the request.
+        - tokens (list)     -> Secret tokens to try.
+    '''
+    for token in tokens:
+        expected = get_signer(token).sign(body, algorithm)
+
+        if hmac.compare_digest(expected, signature):
+            return True
+
+    return False
@@ -0,0 +1,643 @@
+# spool.py -- a queue kept as files in a spool directory
+import os
+import json
+import time
+from uuid import uuid4
+from collections import Counter
+
+from api.backends import QueueBackend
+from api.parse_configs import MAX_PRIORITY
+from api.exceptions import QueueUnavailable
+from api.notify import Notifier
+
+
+class SpoolQueue(QueueBackend):
+    '''
+    A queue of deployment jobs kept as JSON files in a spool directory. Every
+    change of state is a rename, which is atomic even on most network
+    filesystems, so build queues on several hosts can share a spool over a
+    network mount: whoever renames a job out of `queued/` first has claimed
+    it, and everyone else moves on to the next one.
+
+    The spool is laid out as:
+
+        queued/     Jobs waiting for a worker. File names sort in the order
+                    jobs should be claimed in within a repo, and name the
+                    repo, so that claims don't have to read every job.
+        leased/     Claimed jobs, named by ID. The modification time of each
+                    file is when its lease expires.
+        cancelled/  Empty markers for leased jobs that were superseded by a
+                    newer push.
+        delayed/    Jobs waiting to be retried, named by when they're due and
+                    their ID.
+        done/       Finished jobs, named by ID, until they get pruned.
+        dead/       Jobs that failed for good, named by ID, until they get
+                    pruned.
+        repos/      Empty markers for every repo, whose modification times
+                    are when each last had a job claimed.
+        tmp/        Files being written, before they get renamed into place.
+
+    Leases expire by the clock of whoever claims next, so hosts sharing a
+    spool should keep their clocks in sync. Wakeups only reach consumers on
+    the same host; consumers elsewhere pick up new work when they next poll.
+    The spool keeps the state of finished jobs for `status`, but not a
+    history that can be paged through.
+
+    Connection strings look like `spool:<directory>`.
+    '''
+    backend = 'spool'
+
+    # Default connection string
+    db_conn = 'spool:spool'
+
+    # Subdirectories of the spool
+    states = ['queued', 'leased', 'cancelled', 'delayed', 'done', 'dead', 'repos', 'tmp']
+
+    # Number of days to keep finished jobs
+    history_days = 30
+
+    # Minimum number of seconds between prunes of finished jobs
+    prune_interval = 3600
+
+    # Priorities get stored as their distance from the highest one, in a
+    # field wide enough for any priority, so that file names sort with the
+    # highest priority first
+    max_priority = MAX_PRIORITY
+
+    def __init__(self, db_conn=None, lease_timeout=None, create=True):
+        '''
+        Open a spool directory.
+
+        Args:
+            - db_conn (string): Optional connection string, `spool:<directory>`.
+            - lease_timeout (int): Optional number of seconds before a claimed
+                                   job gets returned to the queue.
+            - create (bool): Whether to create the spool's directories. Skip
+                             this if they're known to exist already.
+        '''
+        if db_conn:
+            self.db_conn = db_conn
+
+        if lease_timeout:
+            self.lease_timeout = lease_timeout
+
+        self.directory = os.path.abspath(self.db_conn.partition(':')[2])
+        self.last_pruned = 0
+
+        if create:
+            try:
+                for state in self.states:
+                    os.makedirs(os.path.join(self.directory, state), exist_ok=True)
+            except OSError as e:
+                raise QueueUnavailable('Could not open %s: %s' % (self.directory, e))
+
+        # Channel for waking up consumers on this host when new work arrives
+        self.notifier = Notifier(self.directory)
+
+    def path(self, state, name):
+        '''
+        Return the path to a file in one of the spool's subdirectories.
+        '''
+        return os.path.join(self.directory, state, name)
+
+    def repo_path(self, repo):
+        '''
+        Return the path to the marker for a repo.
+        '''
+        return self.path('repos', '%s.repo' % repo)
+
+    def filename(self, record):
+        '''
+        Return the name of a queued job's file: its priority, when it was
+        added, its ID and its repo.
+        '''
+        return '%020d_%017.6f_%s_%s.json' % (self.max_priority - record['priority'],
+                                            record['date_added'], record['id'],
+                                            record['repo'])
+
+    def parse_filename(self, name):
+        '''
+        Split the name of a queued job's file into its rank (which orders jobs
+        within a repo), ID and repo.
+        '''
+        rank, date_added, work_id, repo = name[:-len('.json')].split('_', 3)
+
+        return (rank, date_added), work_id, repo
+
+    def delayed_filename(self, record):
+        '''
+        Return the name of a delayed job's file: when it's due, and its ID.
+        '''
+        return '%017.6f_%s.json' % (record['not_before'], record['id'])
+
+    def touch_repo(self, repo):
+        '''
+        Create the marker for a repo, if it doesn't exist yet. New repos
+        start at the front of the line.
+        '''
+        try:
+            fd = os.open(self.repo_path(repo), os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return
+
+        os.close(fd)
+        os.utime(self.repo_path(repo), (0, 0))
+
+    def write(self, path, record, mtime=None):
+        '''
+        Write a record to a file atomically, by writing it in `tmp/` and
+        renaming it into place.
+
+        Args:
+            - path (string): Where the record should end up.
+            - record (dict): The record.
+            - mtime (float): Optional modification time to give the file
+                             before it's renamed into place.
+        '''
+        tmp = self.path('tmp', '%s.json' % uuid4())
+
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+
+        os.rename(tmp, path)
+
+    def read(self, path):
+        '''
+        Read a record, or return None if the file has moved on.
+        '''
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def take(self, path):
+        '''
+        Move a file out of the way so that nobody else can act on it, and
+        return its record, or None if someone else got there first.
+        '''
+        tmp = self.path('tmp', '%s.json' % uuid4())
+
+        try:
+            os.rename(path, tmp)
+        except FileNotFoundError:
+            return None
+
+        with open(tmp) as f:
+            record = json.load(f)
+
+        os.remove(tmp)
+
+        return record
+
+    def remove(self, path):
+        '''
+        Remove a file if it still exists.
+        '''
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def find(self, work_id):
+        '''
+        Return the name of a queued job's file, or None if it isn't queued.
+        '''
+        for name in os.listdir(os.path.join(self.directory, 'queued')):
+            if self.parse_filename(name)[1] == work_id:
+                return name
+
+        return None
+
+    def finish(self, record, state, error=None, now=None):
+        '''
+        Record that a job has finished.
+        '''
+        record.update(state=state, date_finished=now or time.time(), error=error)
+        self.write(self.path('done', '%s.json' % record['id']), record)
+
+    def add(self, payload, coalesce=None, cancel_running=None, store_payload=None, priority=0):
+        '''
+        Package up a work payload and drop it into the queue. Returns the ID
+        of the queued work.
+
+        Args:
+            - payload (Payload): An event from the GitHub API, either parsed
+                                 or as a dict.
+            - coalesce (bool): Optionally override whether this job replaces
+                               queued jobs for the same repo and branch.
+            - cancel_running (bool): Optionally override whether this job
+                                     cancels running jobs for the same repo
+                                     and branch, when coalescing.
+            - store_payload (bool): Optionally override whether to keep the
+                                    full payload.
+            - priority (int): Jobs with higher priorities get claimed first.
+        '''
+        if coalesce is None:
+            coalesce = self.coalesce
+
+        if cancel_running is None:
+            cancel_running = self.cancel_running
+
+        if store_payload is None:
+            store_payload = self.store_payload
+
+        self.check_priority(priority)
+        record = self.make_record(str(uuid4()), payload, store_payload, priority)
+
+        try:
+            if coalesce:
+                self.supersede(record, cancel_running)
+
+            self.touch_repo(record['repo'])
+            self.write(self.path('queued', self.filename(record)), record)
+        except OSError as e:
+            raise QueueUnavailable('Could not add job to %s: %s' % (self.directory, e))
+
+        self.notifier.notify()
+
+        return record['id']
+
+    def supersede(self, record, cancel_running=False):
+        '''
+        Drop queued jobs for the same repo and branch as a new job, and
+        optionally cancel running ones.
+        '''
+        for name in os.listdir(os.path.join(self.directory, 'queued')):
+            if self.parse_filename(name)[2] != record['repo']:
+                continue
+
+            other = self.read(self.path('queued', name))
+
+            if other and (other['branch'], other['owner']) == (record['branch'], record['owner']):
+                other = self.take(self.path('queued', name))
+
+                if other:
+                    self.finish(other, 'cancelled')
+
+        for name in os.listdir(os.path.join(self.directory, 'delayed')):
+            other = self.read(self.path('delayed', name))
+
+            if other and (other['repo'], other['branch'], other['owner']) == \
+                    (record['repo'], record['branch'], record['owner']):
+                other = self.take(self.path('delayed', name))
+
+                if other:
+                    self.finish(other, 'cancelled')
+
+        if not cancel_running:
+            return
+
+        for name in os.listdir(os.path.join(self.directory, 'leased')):
+            other = self.read(self.path('leased', name))
+
+            if other and (other['repo'], other['branch'], other['owner']) == \
+                    (record['repo'], record['branch'], record['owner']):
+                # Running jobs are recorded as cancelled once their workers stop
+                open(self.path('cancelled', other['id']), 'w').close()
+
+    def expire(self, now):
+        '''
+        Queue up jobs that are due to be retried, return jobs whose workers
+        stopped renewing their leases, and finish cancelled jobs whose workers
+        have gone away.
+        '''
+        for name in os.listdir(os.path.join(self.directory, 'delayed')):
+            if float(name.split('_', 1)[0]) > now:
+                continue
+
+            path = self.path('delayed', name)
+            record = self.read(path)
+
+            try:
+                if record:
+                    os.rename(path, self.path('queued', self.filename(record)))
+            except FileNotFoundError:
+                # Someone else queued it first
+                pass
+
+        for name in os.listdir(os.path.join(self.directory, 'leased')):
+            path = self.path('leased', name)
+
+            try:
+                if os.stat(path).st_mtime >= now:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            work_id = name[:-len('.json')]
+
+            if os.path.exists(self.path('cancelled', work_id)):
+                record = self.take(path)
+
+                if record:
+                    self.finish(record, 'cancelled', now=now)
+                    self.remove(self.path('cancelled', work_id))
+
+            else:
+                self.requeue(path)
+
+    def requeue(self, path):
+        '''
+        Return a leased job to the queue, in its old place in line.
+        '''
+        record = self.read(path)
+
+        if not record:
+            return
+
+        try:
+            os.rename(path, self.path('queued', self.filename(record)))
+        except FileNotFoundError:
+            # Someone else returned it first
+            pass
+
+    def claim(self, lease_timeout=None, exclude=None):
+        '''
+        Lease the next job on the queue and return it as a `Job`, or return
+        None if there's no work. Jobs are picked in the same order as the
+        SQLite queue picks them. If another host claims a job first, the next
+        one in line gets claimed instead.
+
+        Args:
+            - lease_timeout (int): Optional number of seconds to lease the job
+                                   for, if it should differ from the default.
+            - exclude (list): Optional names of repos to skip over.
+        '''
+        now = time.time()
+        expires = now + (lease_timeout or self.lease_timeout)
+        exclude = set(exclude or [])
+
+        self.expire(now)
+
+        # Find the next job in line for each repo
+        heads = {}
+        for name in os.listdir(os.path.join(self.directory, 'queued')):
+            rank, work_id, repo = self.parse_filename(name)
+
+            if repo not in exclude and (repo not in heads or rank < heads[repo][0]):
+                heads[repo] = (rank, name)
+
+        def turn(repo):
+            try:
+                last_claimed = os.stat(self.repo_path(repo)).st_mtime
+            except FileNotFoundError:
+                last_claimed = 0
+
+            priority, date_added = heads[repo][0]
+            return (priority, last_claimed, date_added, repo)
+
+        for repo in sorted(heads, key=turn):
+            name = heads[repo][1]
+            path = self.path('queued', name)
+            leased = self.path('leased', '%s.json' % self.parse_filename(name)[1])
+
+            try:
+                # Start the lease before the job lands in `leased/`, so that
+                # nobody mistakes it for an expired one
+                os.utime(path, (expires, expires))
+                os.rename(path, leased)
+            except FileNotFoundError:
+                # Someone else claimed it first
+                continue
+
+            # Send the repo to the back of the line
+            try:
+                os.utime(self.repo_path(repo), (now, now))
+            except FileNotFoundError:
+                pass
+
+            record = self.read(leased)
+            record.update(state='running', date_started=now, not_before=None,
+                          attempts=record['attempts'] + 1)
+            self.write(leased, record, mtime=expires)
+
+            return self.load_record(record)
+
+        return None
+
+    def is_cancelled(self, work_id):
+        '''
+        Check whether a claimed job has been superseded by a newer push.
+        '''
+        return os.path.exists(self.path('cancelled', work_id))
+
+    def attempts(self, work_id):
+        '''
+        Return the number of times that a job on the queue has been claimed,
+        or None if there's no such job.
+        '''
+        record = self.read(self.path('leased', '%s.json' % work_id))
+
+        if not record:
+            name = self.find(work_id)
+            record = self.read(self.path('queued', name)) if name else None
+
+        return record['attempts'] if record else None
+
+    def renew(self, work_ids, lease_timeout=None):
+        '''
+        Extend the leases on jobs that are still being worked on.
+        '''
+        expires = time.time() + (lease_timeout or self.lease_timeout)
+
+        for work_id in work_ids:
+            try:
+                os.utime(self.path('leased', '%s.json' % work_id), (expires, expires))
+            except FileNotFoundError:
+                pass
+
+    def ack(self, work_id, state='succeeded', error=None):
+        '''
+        Mark a claimed job as finished and remove it from the queue.
+
+        Args:
+            - work_id (string): ID of the job.
+            - state (string): How the job finished: 'succeeded', 'failed'
+                              or 'cancelled'.
+            - error (string): Optional description of what went wrong.
+        '''
+        self.check_state(state)
+
+        record = self.take(self.path('leased', '%s.json' % work_id))
+
+        if not record:
+            # The lease ran out, and the job went back on the queue
+            name = self.find(work_id)
+            record = self.take(self.path('queued', name)) if name else None
+
+        if record:
+            self.finish(record, state, error)
+
+        self.remove(self.path('cancelled', work_id))
+        self.prune()
+
+    def nack(self, work_id):
+        '''
+        Give up the lease on a claimed job and return it to the queue.
+        '''
+        self.requeue(self.path('leased', '%s.json' % work_id))
+
+        self.notifier.notify()
+
+    def retry(self, work_id, not_before, error=None):
+        '''
+        Return a claimed job to the queue, to be claimed again no sooner than
+        the `not_before` timestamp.
+
+        Args:
+            - work_id (string): ID of the job.
+            - not_before (float): Timestamp to wait until.
+            - error (string): Optional description of what went wrong on the
+                              last attempt.
+        '''
+        path = self.path('leased', '%s.json' % work_id)
+        record = self.read(path)
+
+        if not record:
+            return
+
+        record.update(state='queued', date_started=None, not_before=not_before, error=error)
+
+        try:
+            # Keep the lease while the record gets updated
+            self.write(path, record, mtime=os.stat(path).st_mtime)
+            os.rename(path, self.path('delayed', self.delayed_filename(record)))
+        except FileNotFoundError:
+            # The lease ran out, and the job went back on the queue
+            pass
+
+    def bury(self, work_id, error=None):
+        '''
+        Mark a claimed job as failed and move it from the queue to the dead
+        letters.
+
+        Args:
+            - work_id (string): ID of the job.
+            - error (string): Optional description of what went wrong.
+        '''
+        record = self.take(self.path('leased', '%s.json' % work_id))
+
+        if not record:
+            # The lease ran out, and the job went back on the queue
+            name = self.find(work_id)
+            record = self.take(self.path('queued', name)) if name else None
+
+        if record:
+            now = time.time()
+            self.write(self.path('dead', '%s.json' % work_id),
+                       dict(record, date_failed=now, error=error))
+            self.finish(record, 'failed', error, now=now)
+
+        self.remove(self.path('cancelled', work_id))
+        self.prune()
+
+    def dead_letters(self, limit=20):
+        '''
+        Return the jobs that failed for good (as dicts), most recent failure
+        first.
+        '''
+        dead = []
+
+        for name in os.listdir(os.path.join(self.directory, 'dead')):
+            record = self.read(self.path('dead', name))
+
+            if record:
+                dead.append({field: record.get(field) for field in self.dead_letter_fields})
+
+        dead.sort(key=lambda record: record['date_failed'], reverse=True)
+
+        return dead[:limit]
+
+    def revive(self, work_id):
+        '''
+        Put a dead letter back on the queue, under its old ID, for another
+        round of attempts. Returns False if there's no such dead letter.
+        '''
+        record = self.take(self.path('dead', '%s.json' % work_id))
+
+        if not record:
+            return False
+
+        record.update(state='queued', attempts=0, date_added=time.time(), date_started=None,
+                      date_finished=None, not_before=None, error=None)
+        del record['date_failed']
+
+        self.remove(self.path('done', '%s.json' % work_id))
+        self.touch_repo(record['repo'])
+        self.write(self.path('queued', self.filename(record)), record)
+
+        self.notifier.notify()
+
+        return True
+
+    def prune(self, force=False):
+        '''
+        Remove finished jobs and dead letters from more than `history_days`
+        ago. This runs at most once every `prune_interval` seconds, unless
+        forced.
+        '''
+        now = time.time()
+
+        if not force and now - self.last_pruned < self.prune_interval:
+            return
+
+        self.last_pruned = now
+        cutoff = now - self.history_days * 24 * 60 * 60
+
+        for state in ('done', 'dead'):
+            for name in os.listdir(os.path.join(self.directory, state)):
+                path = self.path(state, name)
+
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def depth(self):
+        '''
+        Count the jobs on the queue in each state, as a dict.
+        '''
+        depth = Counter()
+        depth['queued'] = len(os.listdir(os.path.join(self.directory, 'queued')))
+        depth['delayed'] = len(os.listdir(os.path.join(self.directory, 'delayed')))
+
+        cancelled = set(os.listdir(os.path.join(self.directory, 'cancelled')))
+
+        for name in os.listdir(os.path.join(self.directory, 'leased')):
+            depth['cancelled' if name[:-len('.json')] in cancelled else 'leased'] += 1
+
+        return {state: count for state, count in depth.items() if count}
+
+    def status(self, work_id):
+        '''
+        Return the history of a job as a dict, or None if there's no such job.
+        '''
+        for path in (self.path('done', '%s.json' % work_id),
+                     self.path('leased', '%s.json' % work_id)):
+            record = self.read(path)
+
+            if record:
+                return self.describe(record)
+
+        name = self.find(work_id)
+        record = self.read(self.path('queued', name)) if name else None
+
+        if not record:
+            for name in os.listdir(os.path.join(self.directory, 'delayed')):
+                if name[:-len('.json')].split('_', 1)[1] == work_id:
+                    record = self.read(self.path('delayed', name))
+
+        if not record:
+            return None
+
+        # Jobs that went back on the queue still say when they last started
+        record.update(state='queued', date_started=None)
+
+        return self.describe(record)
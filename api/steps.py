@@ -0,0 +1,218 @@
+# steps.py -- run deploy scripts as a graph of dependent steps
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from api.exceptions import ConfigException
+
+# Kinds of scripts, in the order they run. Every step in a phase waits for
+# the whole of the phase before it.
+PHASES = ['prebuild', 'build', 'deploy']
+
+# Keys that a step can be declared with in deploy.yml
+STEP_KEYS = {'script', 'name', 'depends_on', 'inputs', 'outputs', 'timeout'}
+
+
+class Step(object):
+    '''
+    A single script to run, along with the names of the steps it waits for.
+    Steps that declare their `inputs` and `outputs` can be skipped by the
+    build cache, and steps with a `timeout` get killed after that many seconds.
+    '''
+    def __init__(self, name, script, phase, depends_on, inputs=None, outputs=None,
+                 timeout=None):
+        self.name = name
+        self.script = script
+        self.phase = phase
+        self.depends_on = depends_on
+        self.inputs = inputs or []
+        self.outputs = outputs or []
+        self.timeout = timeout
+
+    def __repr__(self):
+        return '<Step %s>' % self.name
+
+
+def make_step(item, phase, previous, config_file):
+    '''
+    Build a Step from an entry in a script list. Entries are either the path
+    to a script, or a mapping with a `script` and optional `name`,
+    `depends_on`, `inputs`, `outputs` and `timeout`. Without `depends_on`, a
+    step waits for the entry before it.
+    '''
+    if isinstance(item, str):
+        item = {'script': item}
+
+    if not isinstance(item, dict) or not isinstance(item.get('script'), str):
+        raise ConfigException('Every step in `%s` in %s needs a `script`' % (phase, config_file))
+
+    unknown = set(item) - STEP_KEYS
+    if unknown:
+        raise ConfigException('Unknown keys for step %s in %s: %s' %
+                              (item['script'], config_file, ', '.join(sorted(unknown))))
+
+    depends_on = item.get('depends_on', previous)
+
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+
+    if not isinstance(depends_on, list) or not all(isinstance(d, str) for d in depends_on):
+        raise ConfigException('`depends_on` for step %s in %s should be a list of step names' %
+                              (item['script'], config_file))
+
+    name = item.get('name') or item['script']
+
+    paths = {}
+    for key in ('inputs', 'outputs'):
+        value = item.get(key) or []
+
+        if isinstance(value, str):
+            value = [value]
+
+        if not isinstance(value, list) or not all(isinstance(path, str) for path in value):
+            raise ConfigException('`%s` for step %s in %s should be a list of paths' %
+                                  (key, name, config_file))
+
+        if any(os.path.isabs(path) or '..' in path.split('/') for path in value):
+            raise ConfigException('`%s` for step %s in %s should be paths inside `home`' %
+                                  (key, name, config_file))
+
+        paths[key] = value
+
+    if bool(paths['inputs']) != bool(paths['outputs']):
+        raise ConfigException('Step %s in %s needs both `inputs` and `outputs` to be cached' %
+                              (name, config_file))
+
+    timeout = item.get('timeout')
+
+    if timeout is not None and (not isinstance(timeout, int) or isinstance(timeout, bool)
+                                or timeout < 1):
+        raise ConfigException('`timeout` for step %s in %s should be a number of seconds' %
+                              (name, config_file))
+
+    return Step(str(name), item['script'], phase, list(depends_on),
+                inputs=paths['inputs'], outputs=paths['outputs'], timeout=timeout)
+
+
+def plan(config, config_file='deploy.yml'):
+    '''
+    Turn the script lists in a deploy config into a graph of Steps. Returns a
+    list of (phase, steps) tuples, in the order the phases run.
+
+    Plain entries run one after another, like they always have. An entry can
+    also be a `parallel` group of entries that all start once the entry before
+    the group finishes, with the entry after the group waiting for all of
+    them. `depends_on` overrides the default and can name any step in the same
+    phase (or an earlier one, which is always finished already).
+    '''
+    phases = []
+    finished = set()
+
+    for phase in PHASES:
+        steps = []
+        previous = []
+
+        for item in config.get(phase) or []:
+            if isinstance(item, dict) and 'parallel' in item:
+                group = item['parallel']
+
+                if set(item) != {'parallel'} or not isinstance(group, list) or not group:
+                    raise ConfigException('A `parallel` group in `%s` in %s should be a list '
+                                          'of steps and nothing else' % (phase, config_file))
+
+                steps += [make_step(sub, phase, previous, config_file) for sub in group]
+                previous = [step.name for step in steps[-len(group):]]
+            else:
+                steps.append(make_step(item, phase, previous, config_file))
+                previous = [steps[-1].name]
+
+        names = [step.name for step in steps]
+
+        for name in set(names):
+            if names.count(name) > 1 or name in finished:
+                raise ConfigException('Step %s appears more than once in %s; give each one '
+                                      'a different `name`' % (name, config_file))
+
+        for step in steps:
+            for dependency in step.depends_on:
+                if dependency not in names and dependency not in finished:
+                    raise ConfigException('Step %s in %s depends on unknown step %s' %
+                                          (step.name, config_file, dependency))
+
+            # Steps from earlier phases are done by the time this one starts
+            step.depends_on = [d for d in step.depends_on if d in names]
+
+        check_cycles(steps, config_file)
+
+        phases.append((phase, steps))
+        finished.update(names)
+
+    return phases
+
+
+def check_cycles(steps, config_file):
+    '''
+    Raise an error if the steps in a phase can never all run because some of
+    them wait on each other.
+    '''
+    waiting = {step.name: set(step.depends_on) for step in steps}
+    done = set()
+
+    while waiting:
+        ready = [name for name, deps in waiting.items() if deps <= done]
+
+        if not ready:
+            raise ConfigException('Steps in %s depend on each other in a cycle: %s' %
+                                  (config_file, ', '.join(sorted(waiting))))
+
+        for name in ready:
+            del waiting[name]
+            done.add(name)
+
+
+def run_graph(steps, run, concurrency=1):
+    '''
+    Run a phase's steps, starting each one as soon as everything it depends
+    on has finished, with at most `concurrency` running at once.
+
+    If a step fails, no new steps are started; the ones that are already
+    running are left to finish, then the first failure is raised.
+
+    Args:
+        - steps (list): Steps in the phase.
+        - run (callable): Function that runs a Step.
+        - concurrency (int): Maximum number of steps to run at once.
+    '''
+    waiting = [(step, set(step.depends_on)) for step in steps]
+    done = set()
+    running = {}
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        while waiting or running:
+            if failure is None:
+                for step, deps in list(waiting):
+                    if len(running) >= concurrency:
+                        break
+
+                    if deps <= done:
+                        waiting.remove((step, deps))
+                        running[executor.submit(run, step)] = step
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                step = running.pop(future)
+                exc = future.exception()
+
+                if exc is None:
+                    done.add(step.name)
+                elif failure is None:
+                    logging.error('Step %s failed; waiting for running steps to stop' % step.name)
+                    failure = exc
+
+    if failure is not None:
+        raise failure
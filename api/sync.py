@@ -0,0 +1,198 @@
+# sync.py -- copy working copies into their deployment directories
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from api.exceptions import WorkerException
+
+
+class Sync(object):
+    '''
+    Copy a working copy into the directory it gets deployed to (its `home`).
+
+    The sha of the last commit deployed to each home is recorded once the
+    copy finishes. On the next deploy, only the files that changed between
+    the two commits get copied or removed. If there's no record, or the home
+    no longer matches it, the whole tree is synced with rsync instead.
+    '''
+    # Default directory to keep records of deployed commits in
+    root = os.path.join(tempfile.gettempdir(), 'bunny-hook', 'deployed')
+
+    def __init__(self, run_command, root=None):
+        '''
+        Initialize the sync.
+
+        Args:
+            - run_command (callable): Function for running commands, so that
+                                      failures are reported by the Worker.
+            - root (string): Optional directory to keep records in.
+        '''
+        self.run_command = run_command
+
+        if root:
+            self.root = root
+
+    def record_path(self, clone_path):
+        '''
+        Return the path of the file that records the last commit deployed to
+        a home directory.
+        '''
+        home = os.path.abspath(clone_path).encode('utf-8')
+        return os.path.join(self.root, hashlib.sha1(home).hexdigest())
+
+    def last_deployed(self, clone_path):
+        '''
+        Return the sha of the last commit deployed to a home directory, or
+        None if there's no record of one.
+        '''
+        try:
+            with open(self.record_path(clone_path)) as record:
+                return record.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def record(self, clone_path, sha):
+        '''
+        Record the commit that was deployed to a home directory. Passing None
+        clears the record.
+        '''
+        record_path = self.record_path(clone_path)
+
+        if not sha:
+            try:
+                os.remove(record_path)
+            except FileNotFoundError:
+                pass
+            return
+
+        os.makedirs(self.root, exist_ok=True)
+
+        # Write atomically, so a crash never leaves a half-written record
+        with open(record_path + '.tmp', 'w') as record:
+            record.write(sha)
+        os.replace(record_path + '.tmp', record_path)
+
+    def git(self, path, *args):
+        '''
+        Run a git command in a repo and return its output, or None if it
+        fails (or isn't captured).
+        '''
+        try:
+            result = self.run_command(['git', '-C', path] + list(args), capture=True)
+        except WorkerException:
+            return None
+
+        return result.stdout.strip() if result.stdout else None
+
+    def has_drifted(self, tmp_path, clone_path, old_sha):
+        '''
+        Check whether a home directory can't be trusted to match the commit
+        that was recorded for it.
+        '''
+        if not os.path.isdir(os.path.join(clone_path, '.git')):
+            return True
+
+        if self.git(clone_path, 'rev-parse', 'HEAD') != old_sha:
+            return True
+
+        # Files that were edited or left in the home by hand would survive a
+        # diff, where a full sync resets them. Ignored files (like build
+        # outputs) don't count
+        try:
+            status = self.run_command(['git', '-C', clone_path, 'status', '--porcelain'],
+                                      capture=True)
+        except WorkerException:
+            return True
+
+        if status.stdout:
+            return True
+
+        # The old commit has to exist in the working copy to diff against it
+        return self.git(tmp_path, 'rev-parse', '--verify', '--quiet',
+                        old_sha + '^{commit}') != old_sha
+
+    def run(self, tmp_path, clone_path):
+        '''
+        Bring a home directory up to date with a working copy.
+        '''
+        new_sha = self.git(tmp_path, 'rev-parse', 'HEAD')
+        old_sha = self.last_deployed(clone_path)
+
+        # Clear the record while the home is changing, so that an interrupted
+        # sync is followed by a full one
+        self.record(clone_path, None)
+
+        if new_sha and old_sha and not self.has_drifted(tmp_path, clone_path, old_sha):
+            logging.info('Syncing changes from {old} to {new} into {clone_path}...'.format(
+                old=old_sha[:8], new=new_sha[:8], clone_path=clone_path))
+            self.apply_diff(tmp_path, clone_path, old_sha, new_sha)
+        else:
+            logging.info('Moving repo from {tmp_path} to {clone_path}...'.format(
+                tmp_path=tmp_path, clone_path=clone_path))
+            self.full_sync(tmp_path, clone_path)
+
+        self.record(clone_path, new_sha)
+
+    def full_sync(self, tmp_path, clone_path):
+        '''
+        Mirror the whole working copy into the home directory. (Both sides
+        are local, so there's no point in compressing.)
+        '''
+        src = os.path.join(tmp_path, '')
+        dest = os.path.join(clone_path, '')
+        self.run_command(['rsync', '-a', '--delete', src, dest])
+
+    def apply_diff(self, tmp_path, clone_path, old_sha, new_sha):
+        '''
+        Copy only the files that changed between two commits, then bring the
+        home's git metadata along.
+        '''
+        diff = self.git(tmp_path, 'diff', '--name-status', '--no-renames', '-z',
+                        old_sha, new_sha) or ''
+
+        fields = diff.strip('\0').split('\0') if diff else []
+
+        for status, path in zip(fields[::2], fields[1::2]):
+            src = os.path.join(tmp_path, path)
+            dest = os.path.join(clone_path, path)
+
+            if status == 'D':
+                self.remove(dest, clone_path)
+            else:
+                self.copy(src, dest)
+
+        # Point the home's repo at the new commit without touching its files.
+        # git runs in the home, so a relative working copy path would be
+        # resolved against it
+        self.run_command(['git', '-C', clone_path, 'fetch', '--quiet',
+                          os.path.abspath(tmp_path), 'HEAD'])
+        self.run_command(['git', '-C', clone_path, 'reset', '--quiet', new_sha])
+
+    def copy(self, src, dest):
+        '''
+        Copy a single file (or symlink) into place.
+        '''
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+        if os.path.islink(dest) or os.path.isfile(dest):
+            os.remove(dest)
+
+        shutil.copy2(src, dest, follow_symlinks=False)
+
+    def remove(self, dest, clone_path):
+        '''
+        Remove a single file, along with any directories it leaves empty.
+        '''
+        try:
+            os.remove(dest)
+        except FileNotFoundError:
+            return
+
+        parent = os.path.dirname(dest)
+        home = os.path.abspath(clone_path)
+
+        while os.path.abspath(parent) != home and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
@@ -0,0 +1,74 @@
+# watchdog.py -- kill commands that run for too long
+import os
+import signal
+import threading
+
+
+class Watchdog(object):
+    '''
+    Kill a command's whole process group if it runs past its timeout.
+
+    Commands have to be started in a session of their own (with
+    `start_new_session=True`), so that everything they spawn (e.g. the
+    `node` processes under an `npm install`) goes down with them, and no
+    orphans are left holding their output pipes open. The group gets a
+    SIGTERM first, then a SIGKILL once `grace` seconds have passed.
+
+    Use as a context manager around waiting for the command:
+
+        with Watchdog(proc, timeout) as watchdog:
+            proc.communicate()
+
+        if watchdog.expired:
+            ...
+    '''
+    # Number of seconds between SIGTERM and SIGKILL
+    grace = 5
+
+    def __init__(self, proc, timeout):
+        '''
+        Set up a watchdog for a running command.
+
+        Args:
+            - proc (Popen): The command, started in a new session.
+            - timeout (float): Number of seconds to let it run, or None for
+                               no limit.
+        '''
+        self.proc = proc
+        self.timeout = timeout
+        self.expired = False
+        self.finished = threading.Event()
+        self.timer = None
+
+    def __enter__(self):
+        if self.timeout is not None:
+            self.timer = threading.Timer(self.timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.finished.set()
+
+        if self.timer:
+            self.timer.cancel()
+
+    def expire(self):
+        '''
+        Kill the command's process group, politely and then not.
+        '''
+        self.expired = True
+        self.kill(signal.SIGTERM)
+
+        # Stop waiting early if the command has gone away, but kill the
+        # group anyway, in case something in it ignored the SIGTERM
+        self.finished.wait(self.grace)
+        self.kill(signal.SIGKILL)
+
+    def kill(self, sig):
+        try:
+            os.killpg(self.proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            # The whole group has exited already
+            pass
@@ -4,43 +4,185 @@ import subprocess
 import logging
 import sys
 import shutil
+import fcntl
+import time
+import hashlib
+import tempfile
+from contextlib import contextmanager
 
-import yaml
-
-from api.exceptions import WorkerException
+from api.exceptions import WorkerException, CancelledException, TimeoutException
 from api.payload import Payload
+from api.mirrors import MirrorCache
+from api.sync import Sync
+from api.archive import Archive
+from api.releases import Releases
+from api.parse_configs import get_parser, CONFIG_NAMES
+from api.steps import plan, run_graph
+from api.cache import BuildCache
+from api.buildlogs import BuildLog, log_dir
+from api.metrics import get_registry, metrics_dir
+from api.watchdog import Watchdog
 
 # Log to stdout
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 
+@contextmanager
+def lock_home(clone_path):
+    '''
+    Hold an exclusive lock on a deployment directory. The lock is a file
+    lock, so it works across both threads and processes.
+    '''
+    home = os.path.abspath(clone_path).encode('utf-8')
+    lock_name = 'bunny-hook-%s.lock' % hashlib.sha1(home).hexdigest()
+    lock_path = os.path.join(tempfile.gettempdir(), lock_name)
+
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 class Worker(object):
     '''
     Perform a build based on a GitHub API payload.
     '''
-    def __init__(self, payload):
+    # Default maximum number of scripts to run at once, for deploy configs
+    # with parallel steps
+    concurrency = 4
+
+    # How each phase of scripts is described in the logs
+    script_kinds = {
+        'prebuild': 'prebuild',
+        'build': 'build',
+        'deploy': 'deployment',
+    }
+
+    # Default number of seconds that a whole deployment can run for, and
+    # that a single script can run for (None for no limit of its own)
+    job_timeout = 3600
+    script_timeout = None
+
+    # `ulimit` flags for the resource limits that scripts can be given
+    ulimit_flags = {
+        'cpu': '-t',
+        'memory': '-v',
+        'open_files': '-n',
+    }
+
+    def __init__(self, payload, cancelled=None, mirrors=None, parser=None, job_id=None):
         '''
         Initialize the Worker with attributes from the payload that are
         necessary for cloning the repo.
+
+        Args:
+            - payload (Payload): An event from the GitHub API, either parsed
+                                 or as a dict.
+            - cancelled (callable): Optional function that returns True if the
+                                    job has been cancelled, checked before
+                                    every command.
+            - mirrors (MirrorCache): Optional cache of mirrors to check out
+                                     the repo from.
+            - parser (Parse): Optional config loader, carrying the server
+                              config. Defaults to built-in server settings.
+            - job_id (string): Optional ID of the job on the queue. If given,
+                               the output of every command is kept in a log
+                               file for the job instead of going to stdout.
         '''
-        self.payload = Payload(payload)
+        if not isinstance(payload, Payload):
+            payload = Payload(payload)
+
+        self.payload = payload
+        self.cancelled = cancelled
+        self.job_id = job_id
+        self.log = None
+
+        # When the running deployment started, and how long it has
+        self.started = None
+        self.time_limit = None
+        self.parser = parser if parser else get_parser()
+
+        # Scratch space for working copies and deploy records
+        server = self.parser.server
+        self.tmp = os.path.join(server.get('tmp') or tempfile.gettempdir(), 'bunny-hook')
+
+        if mirrors:
+            self.mirrors = mirrors
+        else:
+            git_path = server.get('git_path')
+            root = os.path.join(git_path, 'bunny-hook', 'mirrors') if git_path else None
+            self.mirrors = MirrorCache(root=root, budget=server.get('mirror_budget'))
+
+        self.cache = BuildCache(root=os.path.join(self.tmp, 'cache'),
+                                budget=server.get('cache_budget'))
+
+        self.metrics = get_registry(metrics_dir(server.get('tmp')))
 
         self.repo_name = self.payload.get_name()
         self.origin = self.payload.get_origin()
         self.branch = self.payload.get_branch()
 
-    def run_command(self, cmd):
+    def run_command(self, cmd, capture=False, timeout=None):
         '''
-        Helper method that wraps `subprocess.run` to run commands and fail noisily.
+        Helper method that runs commands and fails noisily. If `capture` is
+        set, the command's output is kept in `stdout` on the result instead of
+        being printed.
+
+        Commands are killed, along with everything they started, if they run
+        for more than `timeout` seconds or past the deployment's time limit.
         '''
+        if self.cancelled and self.cancelled():
+            raise CancelledException('Deployment of %s was cancelled' % self.repo_name)
+
+        remaining = None
+        if self.started is not None and self.time_limit:
+            remaining = self.started + self.time_limit - time.monotonic()
+
+            if remaining <= 0:
+                raise TimeoutException('Deployment of %s went over its time limit of %d seconds'
+                                       % (self.repo_name, self.time_limit))
+
+        limits = [limit for limit in (timeout, remaining) if limit is not None]
+        limit = min(limits) if limits else None
+
+        stdout = subprocess.PIPE if capture else None
+
         try:
-            return subprocess.run(cmd, check=True, universal_newlines=True)
+            if self.log:
+                return self.log.run(cmd, capture=capture, timeout=limit)
+
+            # Start a new session, so the watchdog can kill the whole group
+            proc = subprocess.Popen(cmd, universal_newlines=True, stdout=stdout,
+                                    start_new_session=True)
+
+            with Watchdog(proc, limit) as watchdog:
+                out, _ = proc.communicate()
+
+            if watchdog.expired:
+                raise subprocess.TimeoutExpired(cmd, limit)
+
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+            return subprocess.CompletedProcess(cmd, proc.returncode, stdout=out)
         except subprocess.CalledProcessError as e:
             raise WorkerException(str(e))
+        except subprocess.TimeoutExpired:
+            if limit == remaining:
+                raise TimeoutException('Deployment of %s went over its time limit of %d '
+                                       'seconds' % (self.repo_name, self.time_limit))
+
+            raise TimeoutException('Command `%s` timed out after %d seconds' %
+                                   (' '.join(cmd), timeout))
 
-    def run_script(self, script_path):
+    def run_script(self, script_path, timeout=None, limits=None):
         '''
-        Run a shell script from a file.
+        Run a shell script from a file, killing it if it runs for more than
+        `timeout` seconds. `limits` optionally caps the resources that the
+        script can use, as a dict of `cpu` (seconds), `memory` (bytes) and
+        `open_files`.
 
         This should probably have some more sophisticated permissioning (e.g.
         chrooting) before going live.
@@ -49,85 +191,256 @@ class Worker(object):
         # https://docs.python.org/3/library/stat.html#stat.S_IXOTH
         os.chmod(script_path, 0o775)
 
-        return self.run_command(['bash', script_path])
+        cmd = ['bash', script_path]
+
+        if limits:
+            # Set the limits in the shell that runs the script, rather than in
+            # a preexec_fn, which isn't safe with parallel steps in threads
+            ulimits = ' '.join('%s %d' % (self.ulimit_flags[name],
+                                          value // 1024 if name == 'memory' else value)
+                               for name, value in sorted(limits.items()))
+            cmd = ['bash', '-c', 'ulimit %s && exec bash "$0"' % ulimits, script_path]
+
+        return self.run_command(cmd, timeout=timeout)
+
+    def timed(self, phase):
+        '''
+        Time a phase of the deployment (e.g. 'fetch' or 'sync').
+        '''
+        return self.metrics.timer('bunny_hook_deploy_phase_seconds', phase=phase)
+
+    def lock(self, clone_path):
+        '''
+        Hold an exclusive lock on a deployment directory, so that concurrent
+        workers never deploy into the same `home` at once.
+        '''
+        return lock_home(clone_path)
 
     def deploy(self, tmp_path=None):
         '''
-        Run build and deployment based on the config file.
+        Run build and deployment based on the config file, logging the output
+        of every command to the job's log if it has one.
         '''
-        logging.info('Deploying %s' % self.repo_name)
+        if self.job_id:
+            self.log = BuildLog(log_dir(self.parser.server.get('tmp')), self.job_id)
 
-        if not tmp_path:
-            # Default to /tmp/<repo-name>
-            tmp_path = os.path.abspath(os.path.join(os.sep, 'tmp', self.repo_name))
+        # The time limit covers checking out the repo, before there's a deploy
+        # config to read it from, so start with the server's
+        self.started = time.monotonic()
+        self.time_limit = self.parser.server.get('job_timeout') or self.job_timeout
+
+        state = 'failed'
+
+        try:
+            with self.metrics.timer('bunny_hook_deploy_seconds', repo=self.repo_name):
+                result = self.run_deploy(tmp_path)
+
+            state = 'succeeded'
+            return result
+        except CancelledException:
+            state = 'cancelled'
+            raise
+        finally:
+            self.started = None
 
-        # If the repo exists already in the tmp path, remove it
+            if self.log:
+                self.log.close(compress=self.parser.server.get('compress_logs'))
+                self.log = None
+
+            self.metrics.inc('bunny_hook_deploys_total', repo=self.repo_name, state=state)
+
+            # Deploys are rare enough to report right away
+            self.metrics.flush()
+
+    def resolve(self, mirror_path):
+        '''
+        Return the sha of the commit to deploy from a mirror: the one that was
+        pushed, so that a job that waited on the queue doesn't deploy a newer
+        push instead, or the tip of the branch if the payload doesn't say.
+        '''
+        rev = self.payload.sha or 'refs/heads/%s' % self.branch
+
+        result = self.run_command(['git', '-C', mirror_path, 'rev-parse', '--verify',
+                                   '%s^{commit}' % rev], capture=True)
+
+        return result.stdout.strip() if result.stdout else None
+
+    def read_config(self, mirror_path, sha):
+        '''
+        Load the deploy config of a commit straight out of a mirror, without
+        checking it out. Only the blob shas get looked up when the config has
+        been parsed before. Returns None if the commit has no config file, so
+        that the checkout can report it.
+        '''
+        result = self.run_command(['git', '-C', mirror_path, 'ls-tree', sha, '--'] +
+                                  CONFIG_NAMES, capture=True)
+
+        # Lines look like `<mode> blob <sha>\t<name>`
+        blobs = {}
+        for line in (result.stdout or '').splitlines():
+            info, name = line.split('\t', 1)
+            blobs[name] = info.split()[2]
+
+        if not blobs:
+            return None
+
+        name = self.parser.choose(sorted(blobs))
+        config_file = '%s:%s' % (sha[:8], name)
+
+        def read():
+            blob = self.run_command(['git', '-C', mirror_path, 'cat-file', 'blob', blobs[name]],
+                                    capture=True)
+            return blob.stdout.encode('utf-8')
+
+        return self.parser.parse_blob(config_file, blobs[name], read)
+
+    def checkout(self, mirror_path, tmp_path, sha=None):
+        '''
+        Check out a commit from a mirror in the working copy at `tmp_path`,
+        cloning it if it doesn't exist yet. The commit is `sha` if it's known
+        (see `resolve`), or the tip of the deployed branch if not.
+        '''
         if os.path.exists(tmp_path):
             logging.info('Updating work in %s...' % tmp_path)
-            self.run_command(['git', '-C', tmp_path, 'fetch', '--depth=1', 'origin', self.branch])
-            self.run_command(['git', '-C', tmp_path, 'checkout', self.branch])
-            self.run_command(['git', '-C', tmp_path, 'reset', '--hard', self.branch])
 
         else:
             logging.info('Cloning {origin} into {tmp_path}...'.format(origin=self.origin,
                                                                 tmp_path=tmp_path))
-            self.run_command(['git', 'clone', '--depth=1', '--branch', self.branch, self.origin, tmp_path])
-            self.run_command(['git', '-C', tmp_path, 'checkout', self.branch])
+            # Cloning from local disk hardlinks objects instead of copying them
+            self.run_command(['git', 'clone', '--branch', self.branch, mirror_path, tmp_path])
+            self.run_command(['git', '-C', tmp_path, 'remote', 'set-url', 'origin',
+                              self.origin])
 
-        # Check for a yaml file
-        yml_file = os.path.join(tmp_path, 'deploy.yml')
-        yaml_file = os.path.join(tmp_path, 'deploy.yaml')
+            if not sha:
+                return
 
-        if not (os.path.isfile(yml_file) or os.path.isfile(yaml_file)):
-            raise WorkerException('Could not locate a `deploy.yml` file in your repo.')
+        # Fetch the commit itself, since the branch may have moved on (or
+        # been force pushed) since it was pushed
+        self.run_command(['git', '-C', tmp_path, 'fetch', mirror_path, sha or self.branch])
+        self.run_command(['git', '-C', tmp_path, 'checkout', '-f', '-B', self.branch,
+                          'FETCH_HEAD'])
 
-        if os.path.isfile(yml_file) and os.path.isfile(yaml_file):
-            raise WorkerException('Found two config files in this repo! Delete one and try again.')
+    def run_deploy(self, tmp_path=None):
+        '''
+        Check out the repo, then run the scripts in its config file.
+        '''
+        logging.info('Deploying %s' % self.repo_name)
 
-        if os.path.isfile(yml_file):
-            config_file = yml_file
-        else:
-            config_file = yaml_file
+        if not tmp_path:
+            # Default to <tmp>/bunny-hook/work/<repo-name>-<hash of origin>, so
+            # that repos with the same name but different owners don't collide
+            digest = hashlib.sha1(self.origin.encode('utf-8')).hexdigest()[:8]
+            tmp_path = os.path.join(self.tmp, 'work', '%s-%s' % (self.repo_name, digest))
+
+        # Bring the local mirror up to date, so that only new objects come
+        # over the network
+        with self.timed('fetch'):
+            mirror_path = self.mirrors.update(self.origin, self.branch, self.run_command)
+
+        # Read the config out of the mirror first, since it says how to check
+        # the repo out
+        with self.mirrors.lock(mirror_path, shared=True):
+            with self.timed('config'):
+                sha = self.resolve(mirror_path)
+                config = self.read_config(mirror_path, sha) if sha else None
 
-        # Parse the config file
-        logging.info('Loading config file from %s...' % config_file)
-        with open(config_file) as cf:
-            config = yaml.load(cf)
+            # Archive checkouts and releases are extracted from the mirror
+            archive = bool(config) and (config.get('checkout') == 'archive' or
+                                        bool(config.get('releases')))
+
+            if not archive:
+                with self.timed('checkout'):
+                    self.checkout(mirror_path, tmp_path, sha)
 
         if not config:
-            raise WorkerException('Deployment file %s appears to be empty' % config_file)
-
-        clone_path = config.get('home')
-        prebuild_scripts = config.get('prebuild', [])
-        build_scripts = config.get('build', [])
-        deploy_scripts = config.get('deploy', [])
-
-        # Enforce required directives
-        if not clone_path:
-            raise WorkerException('Deployment file %s is missing `home` directive' % config_file)
-
-        # Move repo from tmp to the clone path
-        logging.info('Moving repo from {tmp_path} to {clone_path}...'.format(tmp_path=tmp_path,
-                                                                      clone_path=clone_path))
-        self.run_command(['rsync', '-avz', '--delete', tmp_path, clone_path])
-
-        # Run prebuild scripts, if they exist
-        for script in prebuild_scripts:
-            script_path = os.path.join(clone_path, script)
-            logging.info('Running prebuild script %s...' % script_path)
-            self.run_script(script_path)
-
-        # Run build scripts, if they exist
-        for script in build_scripts:
-            script_path = os.path.join(clone_path, script)
-            logging.info('Running build script %s...' % script_path)
-            self.run_script(script_path)
-
-        # Run deploy scripts, if they exist
-        for script in deploy_scripts:
-            script_path = os.path.join(clone_path, script)
-            logging.info('Running deployment script %s...' % script_path)
-            self.run_script(script_path)
+            # The commit has no config in the mirror, so look for it in the
+            # working copy, which reports what's missing
+            with self.timed('config'):
+                config = self.parser.parse(tmp_path)
+
+        clone_path = config['home']
+        concurrency = config.get('concurrency') or self.concurrency
+        script_timeout = config.get('script_timeout') or self.script_timeout
+        limits = config.get('limits')
+        phases = plan(config)
+
+        self.time_limit = config.get('job_timeout') or self.job_timeout
+
+        # Where the scripts run: the home directory, or the release being built
+        work_path = clone_path
+
+        def run_step(step):
+            script_path = os.path.join(work_path, step.script)
+
+            # Skip steps whose inputs haven't changed since they last ran
+            key = self.cache.key(work_path, step, home=clone_path) if step.inputs else None
+
+            if key and self.cache.restore(key, work_path, step.outputs):
+                logging.info('Restored outputs of %s script %s from the build cache' %
+                             (self.script_kinds[step.phase], script_path))
+                self.metrics.inc('bunny_hook_build_cache_total', result='hit')
+                return
+
+            if key:
+                self.metrics.inc('bunny_hook_build_cache_total', result='miss')
+
+            logging.info('Running %s script %s...' % (self.script_kinds[step.phase], script_path))
+
+            with self.metrics.timer('bunny_hook_script_seconds', repo=self.repo_name,
+                                    phase=step.phase, script=step.name):
+                self.run_script(script_path, timeout=step.timeout or script_timeout,
+                                limits=limits)
+
+            if key:
+                self.cache.save(key, work_path, step.outputs)
+
+        with self.lock(clone_path):
+            sync = Sync(self.run_command, root=os.path.join(self.tmp, 'deployed'))
+            releases = release = None
+
+            if archive:
+                # Extract the commit into a release of its own, reusing the
+                # files that haven't changed from the live release. Archive
+                # checkouts without `releases` only keep the live one. There's
+                # no git metadata, so later syncs have to be full ones.
+                sync.record(clone_path, None)
+                releases = Releases(clone_path, keep=config.get('releases') or 1)
+                release = releases.create(sha)
+
+                try:
+                    with self.mirrors.lock(mirror_path, shared=True), self.timed('checkout'):
+                        Archive(self.run_command).extract(mirror_path, sha, release.path,
+                                                          previous=releases.live())
+                except BaseException:
+                    releases.discard(release)
+                    raise
+
+                work_path = release.path
+
+            else:
+                # Move repo from tmp to the clone path, copying only what
+                # changed since the last deploy when possible
+                with self.timed('sync'):
+                    sync.run(tmp_path, clone_path)
+
+            # Run prebuild, build and deploy scripts, in that order. Within
+            # each phase, scripts that don't depend on each other run at once
+            for phase, steps in phases:
+                # A release goes live once it has been built, so that deploy
+                # scripts (e.g. restarting the app) see it
+                if release and phase == 'deploy':
+                    releases.activate(release)
+                    release = None
+
+                try:
+                    run_graph(steps, run_step, concurrency)
+                except BaseException:
+                    if release:
+                        releases.discard(release)
+                    raise
+
+            if releases:
+                releases.prune()
 
         logging.info('Finished deploying %s!' % self.repo_name)
         logging.info('---------------------')
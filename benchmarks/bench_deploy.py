@@ -0,0 +1,133 @@
+# bench_deploy.py -- measure how long deployments take from end to end
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import subprocess
+from uuid import uuid4
+
+# Append module root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.worker import Worker
+from api.parse_configs import Parse
+
+# Number of files in each size of repo
+SIZES = {
+    'small': 10,
+    'medium': 1000,
+    'large': 5000,
+}
+
+
+def git(path, *args):
+    '''
+    Run a git command in a repo.
+    '''
+    cmd = ['git', '-C', path, '-c', 'user.name=Bunny Hook', '-c', 'user.email=bunny@hook.test']
+    subprocess.check_call(cmd + list(args), stdout=subprocess.DEVNULL)
+
+
+def make_repo(path, files, home):
+    '''
+    Create a repo with `files` source files, spread over directories of a
+    hundred, and a config that deploys it to `home` with a trivial script.
+    '''
+    os.makedirs(os.path.join(path, 'scripts'))
+
+    for i in range(files):
+        directory = os.path.join(path, 'src', str(i // 100))
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, 'file-%d.txt' % i), 'w') as f:
+            f.write(('line %d\n' % i) * 100)
+
+    with open(os.path.join(path, 'scripts', 'build.sh'), 'w') as f:
+        f.write('true\n')
+
+    with open(os.path.join(path, 'deploy.yml'), 'w') as f:
+        f.write('home: "%s"\nbuild:\n  - scripts/build.sh\n' % home)
+
+    git(path, 'init', '-q')
+    git(path, 'checkout', '-q', '-b', 'master')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'Initial commit')
+
+
+def bench_deploy(files):
+    '''
+    Deploy a fresh repo with `files` files, then push a one-file change and
+    deploy it again. Returns the number of seconds each deploy took.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = os.path.join(tmp, 'repo')
+        make_repo(repo, files, os.path.join(tmp, 'home'))
+
+        server_config = os.path.join(tmp, 'config.yml')
+        with open(server_config, 'w') as f:
+            f.write('tmp: "%s"\ngit_path: "%s"\n' % (tmp, tmp))
+
+        payload = {
+            'ref': 'refs/heads/master',
+            'repository': {
+                'name': 'bench-%d' % files
+            },
+            'clone_url': 'file://' + repo,
+        }
+        # Give the worker a job, so that command output goes to its log the
+        # way it does on the queue
+        worker = Worker(payload, parser=Parse(server_config), job_id=str(uuid4()))
+
+        # Keep the worker's progress messages out of the results
+        logging.disable(logging.INFO)
+
+        try:
+            start = time.perf_counter()
+            worker.deploy()
+            cold = time.perf_counter() - start
+
+            with open(os.path.join(repo, 'src', '0', 'file-0.txt'), 'a') as f:
+                f.write('changed\n')
+            git(repo, 'commit', '-q', '-am', 'Change a file')
+
+            start = time.perf_counter()
+            worker.deploy()
+            warm = time.perf_counter() - start
+        finally:
+            logging.disable(logging.NOTSET)
+
+    return cold, warm
+
+
+def run(sizes=('small', 'medium', 'large')):
+    '''
+    Run the deploy benchmarks for each size of repo. Returns results keyed
+    by name.
+    '''
+    results = {}
+
+    for size in sizes:
+        cold, warm = bench_deploy(SIZES[size])
+        results['deploy.%s.cold' % size] = {'value': cold, 'unit': 'seconds'}
+        results['deploy.%s.warm' % size] = {'value': warm, 'unit': 'seconds'}
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark end-to-end deploys.')
+    parser.add_argument('sizes', nargs='*',
+                        help='Sizes of repo to benchmark: small, medium or large '
+                             '(default: all of them)')
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        if size not in SIZES:
+            parser.error('Unknown size "%s"' % size)
+
+    for size in args.sizes or ['small', 'medium', 'large']:
+        cold, warm = bench_deploy(SIZES[size])
+        print('{size:>8} ({files} files): {cold:>8.3f}s first deploy, {warm:>8.3f}s next '
+              'deploy'.format(size=size, files=SIZES[size], cold=cold, warm=warm))
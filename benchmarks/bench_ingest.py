@@ -0,0 +1,104 @@
+# bench_ingest.py -- measure how quickly the app can authenticate and queue webhooks
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+# Append module root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api import app
+from api.routes import get_hmac
+from api.queue import close_queue
+
+TOKEN = 'bench token'
+
+
+def make_payload(commits):
+    '''
+    Build a push payload with `commits` commits, to vary the size of the
+    body that gets signed and parsed.
+    '''
+    return {
+        'ref': 'refs/heads/master',
+        'after': 'a' * 40,
+        'repository': {
+            'name': 'bunny-hook',
+            'full_name': 'jeancochrane/bunny-hook',
+            'clone_url': 'https://github.com/jeancochrane/bunny-hook.git',
+        },
+        'commits': [{
+            'id': '%040x' % i,
+            'message': 'Commit number %d' % i,
+            'added': ['src/file-%d.py' % i],
+            'modified': ['README.md'],
+            'removed': [],
+        } for i in range(commits)],
+    }
+
+
+def bench_webhooks(count=500, commits=0):
+    '''
+    POST `count` signed webhooks to `receive_post` through the Flask test
+    client, queuing each one. Returns the number of requests per second.
+    '''
+    body = json.dumps(make_payload(commits)).encode('utf-8')
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Hub-Signature-256': get_hmac(TOKEN, body, 'sha256'),
+    }
+
+    saved = {key: app.config.get(key) for key in ('TOKENS', 'REPO_TOKENS', 'QUEUE_DB',
+                                                  'METRICS_DIR')}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.config.update({
+            'TOKENS': [TOKEN],
+            'REPO_TOKENS': {},
+            'QUEUE_DB': os.path.join(tmp, 'bench.db'),
+            'METRICS_DIR': os.path.join(tmp, 'metrics'),
+        })
+
+        try:
+            client = app.test_client()
+
+            # Set up the schema before timing anything
+            client.post('/hooks/github/master', data=body, headers=headers)
+
+            start = time.perf_counter()
+
+            for _ in range(count):
+                response = client.post('/hooks/github/master', data=body, headers=headers)
+                assert response.status_code == 202, response.data
+
+            elapsed = time.perf_counter() - start
+        finally:
+            close_queue(app.config['QUEUE_DB'])
+            app.config.update(saved)
+
+    return count / elapsed
+
+
+def run(count=500, sizes=(0, 200)):
+    '''
+    Run the ingestion benchmarks for payloads with each number of commits.
+    Returns results keyed by name.
+    '''
+    return {'ingest.commits.%d' % commits: {'value': bench_webhooks(count, commits),
+                                            'unit': 'ops/sec'}
+            for commits in sizes}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark webhook ingestion.')
+    parser.add_argument('commits', type=int, nargs='*', default=[0, 200],
+                        help='Numbers of commits in the payloads to benchmark')
+    parser.add_argument('-n', '--count', type=int, default=500,
+                        help='Number of webhooks to send for each payload size')
+    args = parser.parse_args()
+
+    for commits in args.commits:
+        print('{commits:>8} commits: {rate:>10.0f} requests/sec'.format(
+            commits=commits, rate=bench_webhooks(args.count, commits)))
@@ -0,0 +1,188 @@
+# bench_queue.py -- measure how quickly jobs can be added to and claimed from the queue
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+# Append module root directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.queue import Queue, open_queue
+from api.memqueue import drop_store
+from api.batch import get_committer
+
+
+PAYLOAD = {
+    'ref': 'refs/heads/master',
+    'repository': {
+        'name': 'bunny-hook'
+    },
+    'clone_url': 'https://github.com/jeancochrane/bunny-hook.git'
+}
+
+
+# Connection strings for each backend, given a scratch directory
+BACKENDS = {
+    'sqlite': lambda tmp: os.path.join(tmp, 'bench.db'),
+    'memory': lambda tmp: 'memory:bench',
+    'spool': lambda tmp: 'spool:' + os.path.join(tmp, 'spool'),
+}
+
+
+def make_queue(tmp, backend):
+    '''
+    Open a fresh queue with a backend, in a scratch directory.
+    '''
+    drop_store('bench')
+
+    return open_queue(BACKENDS[backend](tmp))
+
+
+def fill(queue, rows, repos=1):
+    '''
+    Load a queue with `rows` jobs, spread evenly over `repos` repos, skipping
+    fsyncs since the loading isn't what's being timed.
+    '''
+    if isinstance(queue, Queue):
+        queue.cursor.execute('PRAGMA synchronous=OFF')
+
+    payloads = [dict(PAYLOAD, repository={'name': 'repo-%d' % n}) for n in range(repos)]
+
+    for n in range(rows):
+        queue.add(payloads[n % repos])
+
+    if isinstance(queue, Queue):
+        queue.cursor.execute('PRAGMA synchronous=FULL')
+
+
+def bench_adds(rows, count=500, backend='sqlite'):
+    '''
+    Fill a fresh queue with `rows` jobs, then time adding `count` more, one
+    transaction each. Returns the number of adds per second.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = make_queue(tmp, backend)
+        fill(queue, rows)
+
+        start = time.perf_counter()
+
+        for _ in range(count):
+            queue.add(PAYLOAD)
+
+        elapsed = time.perf_counter() - start
+        queue.close()
+
+    return count / elapsed
+
+
+def bench_burst(threads=16, count=50, group_commit=False):
+    '''
+    Time a burst of adds from `threads` threads at once (like a flood of
+    webhooks), each adding `count` jobs through a queue of its own. With
+    `group_commit`, the threads share transactions through a GroupCommit;
+    without it, every add commits on its own. Returns the number of adds per
+    second.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        db_conn = os.path.join(tmp, 'bench.db')
+        Queue(db_conn).close()
+
+        committer = get_committer(db_conn) if group_commit else None
+        barrier = threading.Barrier(threads + 1)
+
+        def add():
+            queue = Queue(db_conn, create=False)
+            queue.committer = committer
+            barrier.wait()
+
+            for _ in range(count):
+                queue.add(PAYLOAD)
+
+            queue.close()
+
+        workers = [threading.Thread(target=add) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+
+        barrier.wait()
+        start = time.perf_counter()
+
+        for worker in workers:
+            worker.join()
+
+        elapsed = time.perf_counter() - start
+
+        if committer:
+            committer.close()
+
+    return threads * count / elapsed
+
+
+def bench_claims(rows, backend='sqlite', repos=1):
+    '''
+    Fill a fresh queue with `rows` jobs from `repos` repos, then time claiming
+    and acknowledging every one of them. Returns the number of claims per
+    second.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = make_queue(tmp, backend)
+
+        fill(queue, rows, repos)
+
+        start = time.perf_counter()
+
+        job = queue.claim()
+        while job:
+            queue.ack(job.id)
+            job = queue.claim()
+
+        elapsed = time.perf_counter() - start
+        queue.close()
+
+    return rows / elapsed
+
+
+def run(depths=(1000, 5000, 20000)):
+    '''
+    Run the queue benchmarks at each depth. Returns results keyed by name.
+    '''
+    results = {}
+
+    for rows in depths:
+        results['queue.add.%d' % rows] = {'value': bench_adds(rows), 'unit': 'ops/sec'}
+        results['queue.claim.%d' % rows] = {'value': bench_claims(rows), 'unit': 'ops/sec'}
+
+    # Claims that take turns between many repos
+    for repos in (100, 1000):
+        results['queue.claim.%drepos' % repos] = {'value': bench_claims(5000, repos=repos),
+                                                  'unit': 'ops/sec'}
+
+    # Bursts of concurrent adds, committed one at a time and in shared
+    # transactions
+    results['queue.burst.single'] = {'value': bench_burst(), 'unit': 'ops/sec'}
+    results['queue.burst.group'] = {'value': bench_burst(group_commit=True), 'unit': 'ops/sec'}
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark queue throughput.')
+    parser.add_argument('rows', type=int, nargs='*', default=[1000, 5000, 20000],
+                        help='Queue depths to benchmark')
+    parser.add_argument('-b', '--backend', choices=sorted(BACKENDS), default='sqlite',
+                        help='Queue backend to benchmark (default: sqlite)')
+    parser.add_argument('-r', '--repos', type=int, default=1,
+                        help='Number of repos to spread the jobs over (default: 1)')
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        print('{rows:>8} queued rows: {adds:>10.0f} adds/sec {claims:>10.0f} claims/sec'.format(
+            rows=rows, adds=bench_adds(rows, backend=args.backend),
+            claims=bench_claims(rows, backend=args.backend, repos=args.repos)))
+
+    if args.backend == 'sqlite':
+        print('{threads:>8} threads:     {single:>10.0f} adds/sec one commit each, '
+              '{group:>10.0f} adds/sec with group commit'.format(
+                  threads=16, single=bench_burst(), group=bench_burst(group_commit=True)))
@@ -0,0 +1,140 @@
+# run.py -- run the benchmark suite and compare the results against a baseline
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+import bench_ingest
+import bench_queue
+import bench_deploy
+
+SUITES = {
+    'ingest': bench_ingest.run,
+    'queue': bench_queue.run,
+    'deploy': bench_deploy.run,
+}
+
+# Units where a bigger number is better; for the rest (timings), smaller is
+UNITS_HIGHER_IS_BETTER = ('ops/sec',)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def better(result, other):
+    '''
+    Return whichever of two results for the same benchmark is better.
+    '''
+    if (result['value'] > other['value']) == (result['unit'] in UNITS_HIGHER_IS_BETTER):
+        return result
+
+    return other
+
+
+def compare(results, baseline, threshold):
+    '''
+    Compare results against a baseline. Returns a list of (name, change)
+    tuples for every benchmark that got worse by more than `threshold` (as a
+    fraction), where `change` is the fractional change in its value.
+    '''
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+
+        if not base or not base['value']:
+            continue
+
+        change = (result['value'] - base['value']) / base['value']
+
+        if result['unit'] not in UNITS_HIGHER_IS_BETTER:
+            change = -change
+
+        if change < -threshold:
+            regressions.append((name, change))
+
+    return regressions
+
+
+def report(results, baseline):
+    '''
+    Print results in a table, next to the baseline if there is one.
+    '''
+    for name, result in sorted(results.items()):
+        line = '{name:<24} {value:>12.3f} {unit:<8}'.format(name=name, **result)
+
+        base = baseline.get(name)
+        if base and base['value']:
+            change = (result['value'] - base['value']) / base['value']
+            line += ' (baseline {value:.3f}, {change:+.1%})'.format(value=base['value'],
+                                                                   change=change)
+
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+    parser.add_argument('suites', nargs='*',
+                        help='Benchmarks to run: ingest, queue or deploy '
+                             '(default: all of them)')
+    parser.add_argument('-o', '--output',
+                        help='Write the results to this file as JSON')
+    parser.add_argument('-b', '--baseline', default=BASELINE,
+                        help='Baseline to compare against (default: benchmarks/baseline.json)')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='Fraction that a benchmark can get worse by before it '
+                             'counts as a regression (default: 0.2)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Run each benchmark this many times and keep the best '
+                             'result, to smooth out noise (default: 3)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save the results as the new baseline')
+    args = parser.parse_args()
+
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error('Unknown benchmark "%s"' % suite)
+
+    results = {}
+    for suite in args.suites or sorted(SUITES):
+        for _ in range(args.repeat):
+            for name, result in SUITES[suite]().items():
+                results[name] = better(result, results[name]) if name in results else result
+
+    output = {
+        'date': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    except FileNotFoundError:
+        baseline = {}
+
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        # Keep the baseline for benchmarks that didn't run this time
+        baseline.update(results)
+        output['results'] = baseline
+
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+        sys.exit(0)
+
+    regressions = compare(results, baseline, args.threshold)
+
+    for name, change in regressions:
+        print('REGRESSION: {name} is {change:.1%} worse than the baseline'.format(
+            name=name, change=-change))
+
+    sys.exit(1 if regressions else 0)
@@ -1,11 +1,91 @@
-from api.queue import Queue
-import time
+import os
+import sys
+import json
+import logging
+import argparse
+
+from api.pool import Pool
+from api.queue import open_queue
+from api.parse_configs import get_parser
+from api.releases import Releases
+from api.worker import lock_home
+from api.exceptions import WorkerException
 
 
 if __name__ == '__main__':
-    queue = Queue()
+    parser = argparse.ArgumentParser(description='Run the build queue.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of deployments to run at once (default: 1)')
+    parser.add_argument('-m', '--mode', choices=sorted(Pool.executors.keys()),
+                        default='thread',
+                        help='Run deployments in threads or processes (default: thread)')
+    parser.add_argument('-p', '--poll', type=float, default=5.0,
+                        help='Seconds between fallback checks for work (default: 5)')
+    parser.add_argument('-c', '--config',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'config.yml'),
+                        help='Path to the server config file (default: config.yml)')
+    parser.add_argument('--dead-letters', action='store_true',
+                        help='List the jobs that failed for good, and exit')
+    parser.add_argument('--revive', nargs='+', metavar='JOB_ID',
+                        help='Put jobs that failed for good back on the queue, and exit')
+    parser.add_argument('--releases', metavar='HOME',
+                        help='List the releases deployed to a home directory, and exit')
+    parser.add_argument('--rollback', metavar='HOME',
+                        help='Point a home directory back at its previous release, and exit')
+    parser.add_argument('--to', metavar='RELEASE',
+                        help='Release (or commit sha) to roll back to, with --rollback')
+    args = parser.parse_args()
+
+    if args.releases:
+        releases = Releases(args.releases)
+        live = releases.live()
+
+        for release in reversed(releases.history()):
+            print(json.dumps({'name': release.name, 'sha': release.sha,
+                              'created': release.created,
+                              'live': bool(live) and release.name == live.name}))
+
+        sys.exit(0)
+
+    if args.rollback:
+        # Wait for any deployment into the home to finish first
+        with lock_home(args.rollback):
+            try:
+                release = Releases(args.rollback).rollback(args.to)
+            except WorkerException as e:
+                print(str(e), file=sys.stderr)
+                sys.exit(1)
+
+        print('Rolled %s back to release %s' % (args.rollback, release.name))
+        sys.exit(0)
+
+    if args.dead_letters or args.revive:
+        queue = open_queue(get_parser(args.config).server.get('queue'))
+
+        for job in queue.dead_letters(limit=100) if args.dead_letters else []:
+            print(json.dumps(job))
+
+        missing = [job_id for job_id in args.revive or [] if not queue.revive(job_id)]
+
+        for job_id in missing:
+            print('No dead letter found with ID %s' % job_id, file=sys.stderr)
+
+        queue.close()
+        sys.exit(1 if missing else 0)
+
+    pool = Pool(size=args.workers, mode=args.mode, server_config=args.config)
+
+    # Run the queue in an endless loop, sleeping until there's work to do
+    try:
+        while True:
+            try:
+                pool.run()
+            except Exception:
+                # Keep the queue going through errors that have nothing to do
+                # with any one job (e.g. the datastore being locked)
+                logging.exception('Error while running the queue')
 
-    # Run the queue in an endless loop
-    while True:
-        queue.run()
-        time.sleep(0.01)
+            pool.wait(args.poll)
+    finally:
+        pool.shutdown()
@@ -1,5 +1,73 @@
+import os
+import atexit
+import argparse
+
 from api import app
+from api.queue import get_queue
+from api.logs import log_requests
+from api.asgi import IngestApp
+from api.parse_configs import Parse
+from api.buildlogs import log_dir
+from api.metrics import metrics_dir
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description='Run the app server.')
+    parser.add_argument('--coalesce', action='store_true',
+                        help='Replace queued jobs when a newer push arrives for the same branch')
+    parser.add_argument('--cancel-running', action='store_true',
+                        help='When coalescing, also cancel running jobs for the same branch')
+    parser.add_argument('--group-commit', action='store_true',
+                        help='Commit jobs that arrive at the same time in shared transactions')
+    parser.add_argument('--store-payload', action='store_true',
+                        help='Keep a compressed copy of the full payload with each job')
+    parser.add_argument('--log-requests', action='store_true',
+                        help='Log every request and response as JSON lines on stdout')
+    parser.add_argument('--log-payload', choices=['full', 'truncate', 'off'],
+                        default='truncate',
+                        help='How much of each request payload to log (default: truncate)')
+    parser.add_argument('-c', '--config',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             'config.yml'),
+                        help='Path to the server config file (default: config.yml)')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='Port to listen on (default: 5000)')
+    parser.add_argument('--debug', action='store_true',
+                        help="Run Flask's debug server instead of the production server")
+    args = parser.parse_args()
+
+    app.config['COALESCE'] = args.coalesce
+    app.config['COALESCE_CANCEL_RUNNING'] = args.cancel_running
+    app.config['GROUP_COMMIT'] = args.group_commit
+    app.config['STORE_PAYLOAD'] = args.store_payload
+    app.config['LOG_PAYLOAD'] = args.log_payload
+
+    server = Parse(args.config).server
+
+    # Serve build logs and metrics from wherever the queue writes them
+    app.config['LOG_DIR'] = log_dir(server.get('tmp'))
+    app.config['METRICS_DIR'] = metrics_dir(server.get('tmp'))
+
+    app.config['PRIORITIES'] = server.get('priorities')
+    app.config['QUEUE_DB'] = server.get('queue')
+
+    if args.log_requests:
+        # Flush waiting log records on the way out
+        atexit.register(log_requests().stop)
+
+    if args.debug:
+        # Set up the queue schema at startup, so requests only pay for the INSERT
+        get_queue(app.config.get('QUEUE_DB'))
+
+        app.run(host=args.host, port=args.port, debug=True)
+
+    else:
+        import uvicorn
+        from uvicorn.middleware.wsgi import WSGIMiddleware
+
+        # Webhooks are ingested asynchronously; every other route is served
+        # by the Flask app
+        ingest_app = IngestApp(app.config, fallback=WSGIMiddleware(app))
+        uvicorn.run(ingest_app, host=args.host, port=args.port)
@@ -0,0 +1,44 @@
+import os
+import subprocess
+
+
+def git(path, *args):
+    '''
+    Run a git command in a repo and return its output.
+    '''
+    cmd = ['git', '-C', path, '-c', 'user.name=Bunny Hook', '-c', 'user.email=bunny@hook.test']
+    return subprocess.check_output(cmd + list(args), universal_newlines=True,
+                                   stderr=subprocess.DEVNULL).strip()
+
+
+def commit(path, files, message='Update files'):
+    '''
+    Write files into a repo and commit them. Files mapped to None get
+    deleted. Returns the sha of the new commit.
+    '''
+    for name, contents in files.items():
+        file_path = os.path.join(path, name)
+
+        if contents is None:
+            git(path, 'rm', '-q', name)
+            continue
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as f:
+            f.write(contents)
+
+        git(path, 'add', name)
+
+    git(path, 'commit', '-q', '-m', message)
+    return git(path, 'rev-parse', 'HEAD')
+
+
+def make_repo(path, files, branch='master'):
+    '''
+    Create a repo with an initial commit, to deploy from during tests.
+    Returns the sha of the commit.
+    '''
+    os.makedirs(path, exist_ok=True)
+    git(path, 'init', '-q')
+    git(path, 'checkout', '-q', '-b', branch)
+    return commit(path, files, 'Initial commit')
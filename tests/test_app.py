@@ -1,6 +1,9 @@
 from unittest import TestCase
 from contextlib import contextmanager
+import os
 import json
+import shutil
+import tempfile
 
 from flask import appcontext_pushed, g
 from werkzeug.datastructures import Headers
@@ -8,6 +11,8 @@ from werkzeug.datastructures import Headers
 import env
 import api
 from api.routes import get_hmac
+from api.buildlogs import BuildLog
+from api.queue import get_queue, close_queue
 from test_secrets import TOKENS
 
 
@@ -22,9 +27,11 @@ class TestAPI(TestCase):
         cls.app = api.app.test_client()
         cls.tokens = TOKENS
 
-        # Good and bad authentication credentials
-        cls.good_sig = get_hmac(cls.tokens[0])
-        cls.bad_sig = get_hmac('bogus token')
+    def sign(self, post_data, token=None, digestmod='sha1'):
+        '''
+        Sign a request body the way GitHub does.
+        '''
+        return get_hmac(token or self.tokens[0], post_data.encode('utf-8'), digestmod)
 
     @contextmanager
     def authenticate(self):
@@ -33,6 +40,7 @@ class TestAPI(TestCase):
         '''
         def handler(sender, **kwargs):
             g.tokens = self.tokens
+            g.repo_tokens = getattr(self, 'repo_tokens', {})
 
         with appcontext_pushed.connected_to(handler, api.app):
             yield
@@ -49,7 +57,7 @@ class TestAPI(TestCase):
             })
 
         headers = Headers()
-        headers.add('X-Hub-Signature', self.good_sig)
+        headers.add('X-Hub-Signature', self.sign(post_data))
 
         with self.authenticate():
             post_request = self.app.post('/hooks/github/master',
@@ -75,7 +83,7 @@ class TestAPI(TestCase):
             })
 
         headers = Headers()
-        headers.add('X-Hub-Signature', self.bad_sig)
+        headers.add('X-Hub-Signature', self.sign(post_data, 'bogus token'))
 
         with self.authenticate():
             post_request = self.app.post('/hooks/github/master',
@@ -97,7 +105,7 @@ class TestAPI(TestCase):
         post_data = json.dumps({'ref': 'refs/heads/master'})
 
         headers = Headers()
-        headers.add('X-Hub-Signature', self.good_sig)
+        headers.add('X-Hub-Signature', self.sign(post_data))
 
         with self.authenticate():
             post_request = self.app.post('/hooks/github/deploy',
@@ -118,7 +126,7 @@ class TestAPI(TestCase):
         post_data = json.dumps({'test': 'test'})
 
         headers = Headers()
-        headers.add('X-Hub-Signature', self.good_sig)
+        headers.add('X-Hub-Signature', self.sign(post_data))
 
         with self.authenticate():
             post_request = self.app.post('/hooks/github/deploy',
@@ -131,3 +139,219 @@ class TestAPI(TestCase):
         response = json.loads(post_request.data.decode('utf-8'))
         expected = "Malformed request payload: {'test': 'test'}"
         self.assertEqual(response.get('status'), expected)
+
+    def post(self, post_data, headers):
+        with self.authenticate():
+            return self.app.post('/hooks/github/master',
+                                 content_type='application/json',
+                                 data=post_data,
+                                 headers=headers)
+
+    def test_sha256_signature(self):
+        post_data = json.dumps({
+                'ref': 'refs/head/master',
+                'repository': {
+                    'name': 'test-repo'
+                }
+            })
+
+        headers = Headers()
+        headers.add('X-Hub-Signature-256', self.sign(post_data, digestmod='sha256'))
+
+        self.assertEqual(self.post(post_data, headers).status_code, 202)
+
+    def test_sha256_signature_preferred(self):
+        post_data = json.dumps({
+                'ref': 'refs/head/master',
+                'repository': {
+                    'name': 'test-repo'
+                }
+            })
+
+        headers = Headers()
+        headers.add('X-Hub-Signature', self.sign(post_data))
+        headers.add('X-Hub-Signature-256', self.sign(post_data, 'bogus token', 'sha256'))
+
+        self.assertEqual(self.post(post_data, headers).status_code, 401)
+
+    def test_signature_covers_body(self):
+        post_data = json.dumps({
+                'ref': 'refs/head/master',
+                'repository': {
+                    'name': 'test-repo'
+                }
+            })
+
+        headers = Headers()
+        headers.add('X-Hub-Signature', self.sign(post_data))
+
+        tampered = post_data.replace('test-repo', 'evil-repo')
+        self.assertEqual(self.post(tampered, headers).status_code, 401)
+
+    def test_missing_signature(self):
+        post_data = json.dumps({'ref': 'refs/head/master'})
+
+        self.assertEqual(self.post(post_data, Headers()).status_code, 400)
+
+    def test_repo_tokens(self):
+        post_data = json.dumps({
+                'ref': 'refs/head/master',
+                'repository': {
+                    'name': 'test-repo',
+                    'full_name': 'jeancochrane/test-repo'
+                }
+            })
+
+        self.repo_tokens = {'jeancochrane/test-repo': 'repo token'}
+
+        # Only the repo's own token is accepted
+        headers = Headers()
+        headers.add('X-Hub-Signature', self.sign(post_data))
+        self.assertEqual(self.post(post_data, headers).status_code, 401)
+
+        headers = Headers()
+        headers.add('X-Hub-Signature', self.sign(post_data, 'repo token'))
+        self.assertEqual(self.post(post_data, headers).status_code, 202)
+
+    def test_job_log(self):
+        log_dir = tempfile.mkdtemp()
+        api.app.config['LOG_DIR'] = log_dir
+
+        try:
+            log = BuildLog(log_dir, 'a0a0a0a0-0000-4000-8000-000000000000')
+            log.write(b'Building...\n')
+            log.close()
+
+            response = self.app.get('/jobs/a0a0a0a0-0000-4000-8000-000000000000/log?follow=1')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'Building...\n')
+
+            response = self.app.get('/jobs/c0c0c0c0-0000-4000-8000-000000000000/log')
+            self.assertEqual(response.status_code, 404)
+        finally:
+            del api.app.config['LOG_DIR']
+            shutil.rmtree(log_dir)
+
+    @contextmanager
+    def queue_db(self):
+        '''
+        Point the app at a throwaway queue.
+        '''
+        tmp = tempfile.mkdtemp()
+        api.app.config['QUEUE_DB'] = os.path.join(tmp, 'test_app.db')
+
+        try:
+            yield get_queue(api.app.config['QUEUE_DB'])
+        finally:
+            close_queue(api.app.config.pop('QUEUE_DB'))
+            shutil.rmtree(tmp)
+
+    def test_successful_request_returns_job(self):
+        post_data = json.dumps({'ref': 'refs/head/master', 'repository': {'name': 'test-repo'}})
+
+        headers = Headers()
+        headers.add('X-Hub-Signature', self.sign(post_data))
+
+        with self.queue_db():
+            response = self.post(post_data, headers)
+            self.assertEqual(response.status_code, 202)
+
+            job_id = json.loads(response.data.decode('utf-8'))['id']
+
+            response = self.app.get('/jobs/%s' % job_id)
+            self.assertEqual(response.status_code, 200)
+
+            job = json.loads(response.data.decode('utf-8'))
+            self.assertEqual(job['state'], 'queued')
+            self.assertEqual(job['repo'], 'test-repo')
+
+    def test_priorities(self):
+        api.app.config['PRIORITIES'] = [
+            {'repo': 'jeancochrane/test-repo', 'branch': 'hotfix-*', 'priority': 10},
+            {'branch': 'staging', 'priority': -5},
+            {'branch': 'release/*', 'priority': 5},
+        ]
+
+        def post(ref):
+            post_data = json.dumps({'ref': ref, 'repository': {
+                'name': 'test-repo',
+                'full_name': 'jeancochrane/test-repo',
+            }})
+            headers = Headers()
+            headers.add('X-Hub-Signature', self.sign(post_data))
+
+            with self.authenticate():
+                response = self.app.post('/hooks/github/%s' % ref.split('/')[-1],
+                                         content_type='application/json',
+                                         data=post_data, headers=headers)
+            return json.loads(response.data.decode('utf-8'))['id']
+
+        try:
+            with self.queue_db() as queue:
+                ids = [post(ref) for ref in ('refs/heads/staging', 'refs/heads/master',
+                                             'refs/heads/hotfix-login',
+                                             'refs/heads/release/v2')]
+
+                priorities = [queue.cursor.execute('SELECT priority FROM queue WHERE id = ?',
+                                                   (work_id,)).fetchone()[0] for work_id in ids]
+                self.assertEqual(priorities, [-5, 0, 10, 5])
+        finally:
+            del api.app.config['PRIORITIES']
+
+    def test_unknown_job(self):
+        with self.queue_db():
+            self.assertEqual(self.app.get('/jobs/nope').status_code, 404)
+
+    def test_job_history(self):
+        with self.queue_db() as queue:
+            for name in ('test-repo', 'other-repo', 'test-repo'):
+                queue.add({'ref': 'refs/head/master', 'repository': {'name': name}})
+
+            response = self.app.get('/jobs?repo=test-repo&limit=1')
+            page = json.loads(response.data.decode('utf-8'))
+            self.assertEqual(len(page['jobs']), 1)
+            self.assertIsNotNone(page['next'])
+
+            response = self.app.get('/jobs?repo=test-repo&limit=1&before=%s' % page['next'])
+            page = json.loads(response.data.decode('utf-8'))
+            self.assertEqual(len(page['jobs']), 1)
+            self.assertIsNone(page['next'])
+
+            self.assertEqual(self.app.get('/jobs?limit=nope').status_code, 400)
+
+    def test_job_history_unsupported(self):
+        tmp = tempfile.mkdtemp()
+        api.app.config['QUEUE_DB'] = 'spool:' + os.path.join(tmp, 'spool')
+
+        try:
+            self.assertEqual(self.app.get('/jobs').status_code, 501)
+        finally:
+            close_queue(api.app.config.pop('QUEUE_DB'))
+            shutil.rmtree(tmp)
+
+    def test_metrics(self):
+        post_data = json.dumps({'ref': 'refs/head/master', 'repository': {'name': 'test-repo'}})
+
+        headers = Headers()
+        headers.add('X-Hub-Signature', self.sign(post_data))
+
+        metrics_dir = tempfile.mkdtemp()
+        api.app.config['METRICS_DIR'] = metrics_dir
+
+        try:
+            with self.queue_db():
+                self.post(post_data, headers)
+                self.post(post_data, Headers())
+
+                response = self.app.get('/metrics')
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.content_type.startswith('text/plain'))
+
+                text = response.data.decode('utf-8')
+                self.assertIn('bunny_hook_webhook_requests_total{status="202"} 1', text)
+                self.assertIn('bunny_hook_webhook_requests_total{status="400"} 1', text)
+                self.assertIn('bunny_hook_webhook_seconds_count 2', text)
+                self.assertIn('bunny_hook_queue_depth{state="queued"} 1', text)
+        finally:
+            del api.app.config['METRICS_DIR']
+            shutil.rmtree(metrics_dir)
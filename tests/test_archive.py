@@ -0,0 +1,199 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+
+import env
+from api.archive import Archive
+from api.worker import Worker
+from api.mirrors import MirrorCache
+from api.parse_configs import Parse
+from api.sync import Sync
+from api.exceptions import WorkerException
+from repos import git, commit, make_repo
+
+
+def run_command(cmd, capture=False):
+    stdout = subprocess.PIPE if capture else subprocess.DEVNULL
+
+    try:
+        return subprocess.run(cmd, check=True, universal_newlines=True,
+                              stdout=stdout, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as e:
+        raise WorkerException(str(e))
+
+
+class TestArchive(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp, 'origin')
+        self.release = os.path.join(self.tmp, 'srv', 'release')
+
+        self.first = make_repo(self.origin, {
+            'README.md': 'Hello',
+            'app/main.py': 'print("hello")',
+        })
+
+        self.archive = Archive(run_command)
+
+        # Suppress stdout logging
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def read(self, *path):
+        with open(os.path.join(self.release, *path)) as f:
+            return f.read()
+
+    def test_extracts_commit(self):
+        self.archive.extract(self.origin, self.first, self.release)
+
+        self.assertEqual(self.read('app', 'main.py'), 'print("hello")')
+        self.assertFalse(os.path.exists(os.path.join(self.release, '.git')))
+
+    def test_replaces_interrupted_extract(self):
+        os.makedirs(os.path.join(self.release, 'stale'))
+
+        self.archive.extract(self.origin, self.first, self.release)
+
+        self.assertFalse(os.path.exists(os.path.join(self.release, 'stale')))
+        self.assertEqual(self.read('README.md'), 'Hello')
+
+    def test_failed_extract(self):
+        with self.assertRaises(WorkerException):
+            self.archive.extract(self.origin, '0' * 40, self.release)
+
+
+class TestArchiveDeploy(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp, 'origin')
+        self.home = os.path.join(self.tmp, 'home')
+
+        make_repo(self.origin, {
+            'deploy.yml': 'home: %s\ncheckout: archive\nbuild:\n    - build.sh\n' % self.home,
+            'build.sh': 'echo built > "$(dirname "$0")/built.txt"\n',
+        })
+
+        server_config = os.path.join(self.tmp, 'config.yml')
+        with open(server_config, 'w') as f:
+            f.write('tmp: %s\n' % self.tmp)
+
+        payload = {
+            'ref': 'refs/heads/master',
+            'repository': {
+                'name': 'origin'
+            },
+            'clone_url': self.origin
+        }
+
+        self.worker = Worker(payload, parser=Parse(server_config),
+                             mirrors=MirrorCache(root=os.path.join(self.tmp, 'mirrors')))
+
+        # Suppress stdout logging
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def current(self, *path):
+        return os.path.join(self.home, 'current', *path)
+
+    def test_deploys_without_working_copy(self):
+        self.assertTrue(self.worker.deploy())
+
+        with open(self.current('built.txt')) as f:
+            self.assertEqual(f.read(), 'built\n')
+
+        self.assertTrue(os.path.islink(self.current()))
+        self.assertFalse(os.path.exists(self.current('.git')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'bunny-hook', 'work')))
+
+    def test_deploys_new_commits(self):
+        self.worker.deploy()
+
+        second = commit(self.origin, {'README.md': 'Hello'})
+        self.worker.deploy()
+
+        self.assertTrue(os.path.exists(self.current('README.md')))
+        self.assertTrue(os.path.exists(self.current('built.txt')))
+
+        # Only the live release is kept
+        self.assertEqual(os.listdir(os.path.join(self.home, 'releases')), [second])
+
+    def test_failed_build_keeps_live_release(self):
+        self.worker.deploy()
+        live = os.readlink(self.current())
+
+        commit(self.origin, {'build.sh': 'touch "$(dirname "$0")/broken.txt"\nexit 1\n'})
+
+        with self.assertRaises(WorkerException):
+            self.worker.deploy()
+
+        self.assertEqual(os.readlink(self.current()), live)
+        self.assertFalse(os.path.exists(self.current('broken.txt')))
+        self.assertEqual(len(os.listdir(os.path.join(self.home, 'releases'))), 1)
+
+    def test_keeps_existing_home(self):
+        os.makedirs(self.home)
+        with open(os.path.join(self.home, '.env'), 'w') as f:
+            f.write('SECRET=1')
+
+        self.worker.deploy()
+
+        with open(os.path.join(self.home, '.env')) as f:
+            self.assertEqual(f.read(), 'SECRET=1')
+
+        self.assertTrue(os.path.exists(self.current('built.txt')))
+
+    def test_deploys_pushed_commit(self):
+        pushed = git(self.origin, 'rev-parse', 'HEAD')
+        commit(self.origin, {'README.md': 'Pushed later'})
+
+        self.worker.payload.sha = pushed
+        self.worker.deploy()
+
+        self.assertFalse(os.path.exists(self.current('README.md')))
+        self.assertTrue(os.path.exists(self.current('built.txt')))
+
+    def test_clone_checkout_deploys_pushed_commit(self):
+        pushed = commit(self.origin, {'deploy.yml': 'home: %s\n' % self.home})
+        commit(self.origin, {'deploy.yml': 'home: %s-later\n' % self.home,
+                             'README.md': 'Pushed later'})
+
+        self.worker.payload.sha = pushed
+        work = os.path.join(self.tmp, 'work')
+
+        # Once to clone the working copy, and once to update it
+        for _ in range(2):
+            with patch.object(Sync, 'run') as sync:
+                self.worker.deploy(work)
+
+            # Deployed with the config of the pushed commit
+            sync.assert_called_once_with(work, self.home)
+            self.assertEqual(git(work, 'rev-parse', 'HEAD'), pushed)
+            self.assertFalse(os.path.exists(os.path.join(work, 'README.md')))
+
+    def test_reads_config_from_mirror(self):
+        mirror_path = self.worker.mirrors.update(self.origin, 'master', run_command)
+        sha = self.worker.resolve(mirror_path)
+
+        self.assertEqual(sha, git(self.origin, 'rev-parse', 'HEAD'))
+
+        config = self.worker.read_config(mirror_path, sha)
+        self.assertEqual(config['checkout'], 'archive')
+        self.assertEqual(config['home'], self.home)
+
+    def test_no_config_in_mirror(self):
+        sha = commit(self.origin, {'deploy.yml': None})
+        mirror_path = self.worker.mirrors.update(self.origin, 'master', run_command)
+
+        self.assertIsNone(self.worker.read_config(mirror_path, sha))
@@ -0,0 +1,152 @@
+import os
+import json
+import shutil
+import asyncio
+import threading
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import env
+from api.asgi import IngestApp
+from api.queue import Queue
+from api.signatures import get_signer
+from test_secrets import TOKENS
+
+
+class TestIngestApp(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_conn = os.path.join(self.tmp, 'test_asgi.db')
+        self.config = {
+            'TOKENS': TOKENS,
+            'QUEUE_DB': self.db_conn,
+            'MAX_CONTENT_LENGTH': 1024,
+        }
+        self.app = IngestApp(self.config)
+        self.loop = asyncio.new_event_loop()
+
+        self.post_data = json.dumps({
+            'ref': 'refs/head/master',
+            'repository': {
+                'name': 'test-repo'
+            }
+        }).encode('utf-8')
+
+    def tearDown(self):
+        self.loop.close()
+
+        self.app.executor.shutdown(wait=True)
+        shutil.rmtree(self.tmp)
+
+    def call(self, path, body=b'', headers=None, method='POST', chunk_size=None):
+        '''
+        Send a request through the app and return the status code and
+        decoded response.
+        '''
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                        for key, value in (headers or {}).items()],
+        }
+
+        chunk_size = chunk_size or max(len(body), 1)
+        chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b'']
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                    for i, chunk in enumerate(chunks)]
+
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.app(scope, receive, send))
+
+        body = b''.join(message.get('body', b'') for message in sent[1:])
+        return sent[0]['status'], json.loads(body.decode('utf-8'))
+
+    def sign(self, body, token=None):
+        return {'X-Hub-Signature-256': get_signer(token or TOKENS[0]).sign(body)}
+
+    def count(self):
+        queue = Queue(self.db_conn)
+        count = queue.cursor.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+        queue.close()
+        return count
+
+    def test_successful_request(self):
+        status, resp = self.call('/hooks/github/master', self.post_data,
+                                 self.sign(self.post_data), chunk_size=16)
+
+        self.assertEqual(status, 202)
+        self.assertEqual(resp['status'], 'Build started for ref refs/head/master of repo test-repo')
+        self.assertEqual(self.count(), 1)
+        self.assertIn('id', resp)
+
+    def test_checks_run_off_the_loop(self):
+        threads = []
+
+        def verify(*args):
+            threads.append(threading.current_thread())
+            return True
+
+        with patch('api.asgi.verify', verify):
+            status, resp = self.call('/hooks/github/master', self.post_data,
+                                     self.sign(self.post_data))
+
+        self.assertEqual(status, 202)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_authentication_failed(self):
+        status, resp = self.call('/hooks/github/master', self.post_data,
+                                 self.sign(self.post_data, 'bogus token'))
+
+        self.assertEqual(status, 401)
+
+    def test_missing_signature(self):
+        status, resp = self.call('/hooks/github/master', self.post_data)
+        self.assertEqual(status, 400)
+
+    def test_payload_too_large(self):
+        body = json.dumps({'padding': 'x' * 2048}).encode('utf-8')
+
+        status, resp = self.call('/hooks/github/master', body, self.sign(body), chunk_size=256)
+
+        self.assertEqual(status, 413)
+        self.assertEqual(self.count(), 0)
+
+    def test_backpressure(self):
+        self.app.pending = self.app.max_pending
+
+        status, resp = self.call('/hooks/github/master', self.post_data,
+                                 self.sign(self.post_data))
+
+        self.assertEqual(status, 503)
+
+    def test_unavailable_queue(self):
+        spool = os.path.join(self.tmp, 'spool')
+        self.config['QUEUE_DB'] = 'spool:' + spool
+
+        # The spool's directory has been replaced by something it can't use
+        open(spool, 'w').close()
+
+        status, resp = self.call('/hooks/github/master', self.post_data,
+                                 self.sign(self.post_data))
+
+        self.assertEqual(status, 503)
+        self.assertIn('Could not queue build', resp['status'])
+
+    def test_unknown_route(self):
+        status, resp = self.call('/foo', method='GET')
+        self.assertEqual(status, 404)
+
+    def test_wrong_method(self):
+        status, resp = self.call('/hooks/github/master', method='GET')
+        self.assertEqual(status, 405)
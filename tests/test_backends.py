@@ -0,0 +1,431 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from concurrent.futures.process import BrokenProcessPool
+
+import env
+from api.queue import Queue, open_queue, split_conn
+from api.memqueue import MemoryQueue, drop_store
+from api.spool import SpoolQueue
+from api.backends import is_transient
+from api.exceptions import QueueException, WorkerException, TimeoutException, \
+    ConfigException
+
+
+class BackendTests(object):
+    '''
+    Tests that every queue backend has to pass. Subclasses set up `self.queue`
+    and `self.db_conn`.
+    '''
+    def payload(self, repo='bunny-hook', branch='master'):
+        return {
+            'ref': 'refs/heads/%s' % branch,
+            'after': 'abc123',
+            'repository': {
+                'name': repo,
+                'owner': {'name': 'jeancochrane'},
+            },
+            'clone_url': 'https://github.com/jeancochrane/%s.git' % repo,
+        }
+
+    def test_add_claim_ack(self):
+        work_id = self.queue.add(self.payload())
+
+        job = self.queue.claim()
+        self.assertEqual(job.id, work_id)
+        self.assertEqual(job.repo, 'bunny-hook')
+        self.assertEqual(job.payload.get_branch(), 'master')
+        self.assertEqual(job.payload.get_origin(),
+                         'https://github.com/jeancochrane/bunny-hook.git')
+        self.assertTrue(job.date_added)
+
+        # Leased jobs can't be claimed twice
+        self.assertIsNone(self.queue.claim())
+        self.assertEqual(self.queue.status(work_id)['state'], 'running')
+
+        self.queue.ack(work_id, 'failed', 'Boom')
+        self.assertEqual(self.queue.depth(), {})
+
+        status = self.queue.status(work_id)
+        self.assertEqual(status['state'], 'failed')
+        self.assertEqual(status['error'], 'Boom')
+        self.assertEqual(status['sha'], 'abc123')
+        self.assertTrue(status['date_finished'])
+
+    def test_payload_without_ref(self):
+        payload = self.payload()
+        del payload['ref']
+
+        work_id = self.queue.add(payload)
+
+        self.assertEqual(self.queue.status(work_id)['branch'], '')
+        self.assertEqual(self.queue.claim().id, work_id)
+
+    def test_unknown_state(self):
+        work_id = self.queue.add(self.payload())
+
+        with self.assertRaises(QueueException):
+            self.queue.ack(work_id, 'exploded')
+
+    def test_status_missing(self):
+        self.assertIsNone(self.queue.status('no-such-job'))
+
+    def test_pop(self):
+        self.queue.add(self.payload())
+
+        self.assertEqual(self.queue.pop().get_name(), 'bunny-hook')
+        self.assertIsNone(self.queue.pop())
+
+    def test_nack(self):
+        work_id = self.queue.add(self.payload())
+        self.queue.claim()
+
+        self.queue.nack(work_id)
+        self.assertEqual(self.queue.depth(), {'queued': 1})
+        self.assertEqual(self.queue.status(work_id)['state'], 'queued')
+
+        self.assertEqual(self.queue.claim().id, work_id)
+
+    def test_depth(self):
+        self.queue.add(self.payload('one'))
+        self.queue.add(self.payload('two'))
+        self.queue.claim()
+
+        self.assertEqual(self.queue.depth(), {'queued': 1, 'leased': 1})
+
+    def test_priority_and_turns(self):
+        low = self.queue.add(self.payload('one'), priority=-1)
+        first = self.queue.add(self.payload('two'))
+        second = self.queue.add(self.payload('two'))
+        other = self.queue.add(self.payload('three'))
+        urgent = self.queue.add(self.payload('one'), priority=5)
+
+        claimed = []
+        while True:
+            job = self.queue.claim()
+            if not job:
+                break
+            claimed.append(job.id)
+
+        # Repos at the same priority take turns, oldest job first
+        self.assertEqual(claimed, [urgent, first, other, second, low])
+
+    def test_extreme_priorities(self):
+        lowest = self.queue.add(self.payload('one'), priority=-(2 ** 63 - 1))
+        low = self.queue.add(self.payload('two'), priority=-10 ** 10)
+        high = self.queue.add(self.payload('three'), priority=10 ** 10)
+        highest = self.queue.add(self.payload('four'), priority=2 ** 63 - 1)
+
+        claimed = [self.queue.claim().id for _ in range(4)]
+        self.assertEqual(claimed, [highest, high, low, lowest])
+
+        with self.assertRaises(QueueException):
+            self.queue.add(self.payload('one'), priority=2 ** 63)
+
+    def test_exclude(self):
+        self.queue.add(self.payload('one'))
+        work_id = self.queue.add(self.payload('two'))
+
+        self.assertEqual(self.queue.claim(exclude=['one']).id, work_id)
+        self.assertIsNone(self.queue.claim(exclude=['one']))
+
+    def test_lease_expires(self):
+        work_id = self.queue.add(self.payload())
+        self.queue.claim(lease_timeout=0.01)
+
+        time.sleep(0.05)
+
+        self.assertEqual(self.queue.claim().id, work_id)
+
+    def test_renew(self):
+        work_id = self.queue.add(self.payload())
+        self.queue.claim(lease_timeout=0.01)
+        self.queue.renew([work_id], lease_timeout=60)
+
+        time.sleep(0.05)
+
+        self.assertIsNone(self.queue.claim())
+
+    def test_renew_cancelled(self):
+        work_id = self.queue.add(self.payload())
+        self.queue.claim(lease_timeout=0.1)
+        self.queue.add(self.payload(), coalesce=True, cancel_running=True)
+
+        # The worker keeps renewing while it runs, past the first lease
+        time.sleep(0.06)
+        self.queue.renew([work_id], lease_timeout=0.5)
+        time.sleep(0.06)
+        self.queue.claim(lease_timeout=60)
+
+        self.assertTrue(self.queue.is_cancelled(work_id))
+
+    def test_coalesce(self):
+        running = self.queue.add(self.payload())
+        self.queue.claim()
+
+        dropped = self.queue.add(self.payload())
+        kept = self.queue.add(self.payload(branch='staging'))
+        latest = self.queue.add(self.payload(), coalesce=True, cancel_running=True)
+
+        self.assertEqual(self.queue.status(dropped)['state'], 'cancelled')
+        self.assertTrue(self.queue.is_cancelled(running))
+        self.assertFalse(self.queue.is_cancelled(kept))
+        self.assertEqual(self.queue.depth(), {'queued': 2, 'cancelled': 1})
+
+        self.queue.ack(running, 'cancelled')
+        self.assertEqual(self.queue.status(running)['state'], 'cancelled')
+        self.assertEqual(sorted([self.queue.claim().id, self.queue.claim().id]),
+                         sorted([kept, latest]))
+
+    def test_store_payload(self):
+        self.queue.add(self.payload(), store_payload=True)
+
+        job = self.queue.claim()
+        self.assertEqual(job.payload.raw['after'], 'abc123')
+
+    def test_retry(self):
+        self.queue.max_attempts = 3
+        self.queue.retry_delay = 0.05
+
+        work_id = self.queue.add(self.payload())
+        self.queue.claim()
+        self.assertEqual(self.queue.attempts(work_id), 1)
+
+        delay = self.queue.fail(work_id, 'Could not fetch')
+        self.assertGreaterEqual(delay, 0.025)
+
+        status = self.queue.status(work_id)
+        self.assertEqual(status['state'], 'queued')
+        self.assertEqual(status['error'], 'Could not fetch')
+        self.assertEqual(self.queue.depth(), {'delayed': 1})
+
+        # Delayed jobs wait out their backoff
+        self.assertIsNone(self.queue.claim())
+        time.sleep(0.1)
+
+        self.assertEqual(self.queue.claim().id, work_id)
+        self.assertEqual(self.queue.attempts(work_id), 2)
+        self.assertEqual(self.queue.status(work_id)['attempts'], 2)
+
+    def test_dead_letters(self):
+        self.queue.max_attempts = 2
+        self.queue.retry_delay = 0.01
+
+        work_id = self.queue.add(self.payload())
+        self.queue.claim()
+        self.queue.fail(work_id, 'Could not fetch')
+
+        time.sleep(0.05)
+        self.queue.claim()
+
+        # Out of attempts
+        self.assertIsNone(self.queue.fail(work_id, 'Still could not fetch'))
+        self.assertEqual(self.queue.depth(), {})
+        self.assertEqual(self.queue.status(work_id)['state'], 'failed')
+
+        dead, = self.queue.dead_letters()
+        self.assertEqual(dead['id'], work_id)
+        self.assertEqual(dead['attempts'], 2)
+        self.assertEqual(dead['error'], 'Still could not fetch')
+
+        self.assertTrue(self.queue.revive(work_id))
+        self.assertFalse(self.queue.revive(work_id))
+        self.assertEqual(self.queue.dead_letters(), [])
+        self.assertEqual(self.queue.status(work_id)['state'], 'queued')
+
+        job = self.queue.claim()
+        self.assertEqual(job.id, work_id)
+        self.assertEqual(job.payload.get_branch(), 'master')
+        self.assertEqual(self.queue.attempts(work_id), 1)
+
+    def test_permanent_failure(self):
+        self.queue.max_attempts = 3
+
+        work_id = self.queue.add(self.payload())
+        self.queue.claim()
+
+        self.assertIsNone(self.queue.fail(work_id, 'Bad config', retry=False))
+        self.assertEqual([job['id'] for job in self.queue.dead_letters()], [work_id])
+
+    def test_backoff(self):
+        self.queue.retry_delay = 10
+        self.queue.max_retry_delay = 25
+
+        for _ in range(20):
+            self.assertTrue(5 <= self.queue.backoff(1) <= 10)
+            self.assertTrue(10 <= self.queue.backoff(2) <= 20)
+            self.assertTrue(12.5 <= self.queue.backoff(5) <= 25)
+
+    def test_coalesce_delayed(self):
+        self.queue.max_attempts = 2
+        self.queue.retry_delay = 60
+
+        work_id = self.queue.add(self.payload())
+        self.queue.claim()
+        self.queue.fail(work_id, 'Could not fetch')
+
+        self.queue.add(self.payload(), coalesce=True)
+
+        self.assertEqual(self.queue.status(work_id)['state'], 'cancelled')
+        self.assertEqual(self.queue.depth(), {'queued': 1})
+
+    def test_open_queue(self):
+        queue = open_queue(self.db_conn)
+
+        try:
+            self.assertIsInstance(queue, type(self.queue))
+
+            # Queues with the same connection string share their jobs
+            work_id = self.queue.add(self.payload())
+            self.assertEqual(queue.claim().id, work_id)
+        finally:
+            queue.close()
+
+
+class HistoryTests(object):
+    '''
+    Tests for backends that keep a history of jobs.
+    '''
+    def test_history(self):
+        ids = [self.queue.add(self.payload(repo)) for repo in ('one', 'two', 'one')]
+
+        jobs, cursor = self.queue.history(limit=2)
+        self.assertEqual([job['id'] for job in jobs], ids[::-1][:2])
+
+        jobs, cursor = self.queue.history(before=cursor, limit=2)
+        self.assertEqual([job['id'] for job in jobs], ids[:1])
+        self.assertIsNone(cursor)
+
+        jobs, cursor = self.queue.history(repo='two')
+        self.assertEqual([job['id'] for job in jobs], ids[1:2])
+
+
+class TestSQLiteQueue(BackendTests, HistoryTests, TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_conn = os.path.join(self.tmp, 'test.db')
+        self.queue = Queue(self.db_conn)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp)
+
+    def test_prefix(self):
+        queue = open_queue('sqlite:' + self.db_conn)
+
+        try:
+            self.assertIsInstance(queue, Queue)
+            self.assertEqual(queue.path, self.db_conn)
+        finally:
+            queue.close()
+
+
+class TestMemoryQueue(BackendTests, HistoryTests, TestCase):
+
+    def setUp(self):
+        self.db_conn = 'memory:test'
+        self.queue = MemoryQueue(self.db_conn)
+
+    def tearDown(self):
+        self.queue.close()
+        drop_store('test')
+
+    def test_prune(self):
+        work_id = self.queue.add(self.payload('one'))
+        self.queue.claim()
+        self.queue.bury(work_id)
+
+        other = self.queue.add(self.payload('two'))
+        self.queue.claim()
+        self.queue.ack(other)
+
+        queued = self.queue.add(self.payload('three'))
+
+        # Pretend the finished jobs are old
+        for job_id in (work_id, other):
+            self.queue.store.jobs[job_id]['date_added'] = 0
+        self.queue.store.dead[work_id]['date_failed'] = 0
+
+        self.queue.prune(force=True)
+
+        self.assertIsNone(self.queue.status(work_id))
+        self.assertIsNone(self.queue.status(other))
+        self.assertEqual(self.queue.dead_letters(), [])
+        self.assertEqual(self.queue.status(queued)['state'], 'queued')
+        self.assertEqual(list(self.queue.store.repos), ['three'])
+
+
+class TestSpoolQueue(BackendTests, TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_conn = 'spool:' + os.path.join(self.tmp, 'spool')
+        self.queue = SpoolQueue(self.db_conn)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp)
+
+    def test_no_history(self):
+        with self.assertRaises(QueueException):
+            self.queue.history()
+
+    def test_prune(self):
+        work_id = self.queue.add(self.payload())
+        self.queue.claim()
+        self.queue.ack(work_id)
+
+        done = os.path.join(self.queue.directory, 'done', '%s.json' % work_id)
+        os.utime(done, (0, 0))
+
+        self.queue.prune(force=True)
+        self.assertFalse(os.path.exists(done))
+        self.assertIsNone(self.queue.status(work_id))
+
+    def test_shared_spool(self):
+        # Consumers with their own handles on the spool (as if on different
+        # hosts) never claim the same job twice
+        ids = set(self.queue.add(self.payload('repo-%d' % i)) for i in range(50))
+        claimed = []
+
+        def consume():
+            queue = SpoolQueue(self.db_conn, create=False)
+
+            while True:
+                job = queue.claim()
+                if not job:
+                    break
+                claimed.append(job.id)
+
+        threads = [threading.Thread(target=consume) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(claimed), sorted(ids))
+        self.assertEqual(self.queue.depth(), {'leased': 50})
+
+
+class TestSplitConn(TestCase):
+
+    def test_split_conn(self):
+        self.assertEqual(split_conn('hook.db'), ('sqlite', 'hook.db'))
+        self.assertEqual(split_conn('sqlite:hook.db'), ('sqlite', 'hook.db'))
+        self.assertEqual(split_conn('memory:test'), ('memory', 'test'))
+        self.assertEqual(split_conn('spool:/mnt/spool'), ('spool', '/mnt/spool'))
+        self.assertEqual(split_conn(':memory:'), ('sqlite', ':memory:'))
+
+
+class TestIsTransient(TestCase):
+
+    def test_is_transient(self):
+        self.assertTrue(is_transient(WorkerException('Could not fetch')))
+        self.assertTrue(is_transient(TimeoutException('Too slow')))
+        self.assertTrue(is_transient(BrokenProcessPool('Worker died')))
+        self.assertFalse(is_transient(ConfigException('Bad config')))
+        self.assertFalse(is_transient(KeyError('bug')))
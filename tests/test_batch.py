@@ -0,0 +1,81 @@
+import os
+import sqlite3
+import threading
+from unittest import TestCase
+
+import env
+from api.batch import GroupCommit
+from api.queue import Queue
+
+
+class TestGroupCommit(TestCase):
+
+    def setUp(self):
+        self.db_conn = 'test_batch.db'
+        self.queue = Queue(self.db_conn)
+        self.committer = GroupCommit(self.db_conn, window=0.05)
+
+        self.payload = {
+            'ref': 'refs/head/master',
+            'repository': {
+                'name': 'bunny-hook'
+            },
+            'clone_url': 'https://github.com/jeancochrane/bunny-hook.git'
+        }
+
+    def tearDown(self):
+        self.committer.close()
+        self.queue.close()
+        os.remove(self.db_conn)
+
+    def count(self):
+        return self.queue.cursor.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+
+    def test_concurrent_adds_share_transactions(self):
+        self.queue.committer = self.committer
+
+        def add():
+            # Every thread needs its own connection
+            queue = Queue(self.db_conn, create=False)
+            queue.committer = self.committer
+            queue.add(self.payload)
+            queue.close()
+
+        threads = [threading.Thread(target=add) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.count(), 20)
+        self.assertLess(self.committer.batches, 20)
+
+    def test_add_is_durable_when_it_returns(self):
+        self.queue.committer = self.committer
+        work_id = self.queue.add(self.payload)
+
+        self.assertEqual(self.queue.claim().id, work_id)
+
+    def test_failed_write_does_not_roll_back_others(self):
+        def bad_write(cursor):
+            cursor.execute("INSERT INTO queue (id) VALUES ('bad')")
+            cursor.execute('SELECT * FROM no_such_table')
+
+        errors = []
+
+        def submit_bad():
+            try:
+                self.committer.submit(bad_write)
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=submit_bad)
+        thread.start()
+
+        self.committer.submit(lambda cursor: cursor.execute("INSERT INTO queue (id) VALUES ('good')"))
+        thread.join()
+
+        self.assertEqual(len(errors), 1)
+
+        ids = [row[0] for row in self.queue.cursor.execute('SELECT id FROM queue')]
+        self.assertEqual(ids, ['good'])
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import threading
+import subprocess
+from unittest import TestCase
+
+import env
+from api.buildlogs import BuildLog, read_log, log_paths
+
+
+class TestBuildLog(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.job_id = 'b7b7b7b7-0000-4000-8000-000000000000'
+        self.log = BuildLog(self.tmp, self.job_id)
+
+    def tearDown(self):
+        if not self.log.log_file.closed:
+            self.log.close()
+
+        shutil.rmtree(self.tmp)
+
+    def read(self, follow=False, **kwargs):
+        return b''.join(read_log(self.tmp, self.job_id, follow=follow, **kwargs))
+
+    def test_streams_stdout_and_stderr(self):
+        self.log.run(['bash', '-c', 'echo out; echo err >&2'])
+        self.log.close()
+
+        self.assertEqual(self.read(), b'$ bash -c echo out; echo err >&2\nout\nerr\n')
+
+    def test_capture_returns_stdout(self):
+        result = self.log.run(['bash', '-c', 'echo sha; echo warning >&2'], capture=True)
+        self.log.close()
+
+        self.assertEqual(result.stdout, 'sha\n')
+        self.assertIn(b'warning', self.read())
+        self.assertNotIn(b'sha\n', self.read())
+
+    def test_failure_raises(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.log.run(['bash', '-c', 'echo oops; exit 3'])
+
+        self.log.close()
+        self.assertIn(b'oops', self.read())
+
+    def test_timeout_kills_process_group(self):
+        # The background sleep would hold the pipe open if it outlived bash
+        with self.assertRaises(subprocess.TimeoutExpired):
+            self.log.run(['bash', '-c', 'echo started; sleep 30 & sleep 30'], timeout=0.2)
+
+        self.log.close()
+
+        logged = self.read()
+        self.assertIn(b'started\n', logged)
+        self.assertIn(b'Timed out after 0 seconds', logged)
+
+    def test_large_output(self):
+        # Several times the chunk size, to exercise the streaming
+        self.log.run(['bash', '-c', 'head -c 1000000 /dev/zero'])
+        self.log.close()
+
+        self.assertEqual(self.read().count(b'\0'), 1000000)
+
+    def test_compress(self):
+        self.log.run(['echo', 'hello'])
+        self.log.close(compress=True)
+
+        running_path, path, gz_path = log_paths(self.tmp, self.job_id)
+        self.assertTrue(os.path.exists(gz_path))
+        self.assertFalse(os.path.exists(running_path))
+        self.assertFalse(os.path.exists(path))
+
+        self.assertEqual(self.read(), b'$ echo hello\nhello\n')
+
+    def test_unknown_job(self):
+        self.assertIsNone(read_log(self.tmp, 'c0c0c0c0-0000-4000-8000-000000000000'))
+
+    def test_job_id_is_not_a_path(self):
+        self.assertIsNone(read_log(self.tmp, '../etc/passwd'))
+
+    def test_follow_until_finished(self):
+        self.log.write(b'first\n')
+
+        chunks = read_log(self.tmp, self.job_id, follow=True, poll=0.01)
+        self.assertEqual(next(chunks), b'first\n')
+
+        def finish():
+            self.log.write(b'second\n')
+            self.log.close()
+
+        threading.Timer(0.05, finish).start()
+
+        self.assertEqual(b''.join(chunks), b'second\n')
+
+    def test_follow_times_out(self):
+        self.log.write(b'first\n')
+
+        self.assertEqual(self.read(follow=True, poll=0.01, timeout=0.05), b'first\n')
+        self.log.close()
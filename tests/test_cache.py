@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import logging
+from unittest import TestCase
+
+import env
+from api.cache import BuildCache
+from api.steps import Step
+from api.exceptions import ConfigException
+
+
+class TestBuildCache(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.home = os.path.join(self.tmp, 'home')
+
+        self.write('scripts/build.sh', 'mkdir -p dist && cat src/*.js > dist/app.js')
+        self.write('src/app.js', 'console.log("hello")')
+        self.write('docs/README.md', 'Docs')
+
+        self.cache = BuildCache(root=os.path.join(self.tmp, 'cache'))
+        self.step = Step('build', 'scripts/build.sh', 'build', [],
+                         inputs=['src/**/*.js'], outputs=['dist'])
+
+        # Suppress stdout logging
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def write(self, path, contents):
+        path = os.path.join(self.home, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def read(self, path):
+        with open(os.path.join(self.home, path)) as f:
+            return f.read()
+
+    def build(self):
+        '''
+        Stand in for running the build script.
+        '''
+        self.write('dist/app.js', self.read('src/app.js'))
+        self.write('dist/maps/app.js.map', '{}')
+        os.chmod(os.path.join(self.home, 'dist', 'app.js'), 0o640)
+
+    def test_key_follows_inputs(self):
+        key = self.cache.key(self.home, self.step)
+
+        # Files outside the inputs don't matter
+        self.write('docs/README.md', 'More docs')
+        self.assertEqual(self.cache.key(self.home, self.step), key)
+
+        self.write('src/app.js', 'console.log("goodbye")')
+        self.assertNotEqual(self.cache.key(self.home, self.step), key)
+
+    def test_key_follows_script(self):
+        key = self.cache.key(self.home, self.step)
+
+        self.write('scripts/build.sh', 'echo "a different build"')
+        self.assertNotEqual(self.cache.key(self.home, self.step), key)
+
+    def test_miss(self):
+        key = self.cache.key(self.home, self.step)
+        self.assertFalse(self.cache.restore(key, self.home, self.step.outputs))
+
+    def test_save_and_restore(self):
+        key = self.cache.key(self.home, self.step)
+        self.build()
+        self.cache.save(key, self.home, self.step.outputs)
+
+        # Outputs are replaced wholesale, including stray files
+        shutil.rmtree(os.path.join(self.home, 'dist'))
+        self.write('dist/stale.js', 'stale')
+
+        self.assertTrue(self.cache.restore(key, self.home, self.step.outputs))
+
+        self.assertEqual(self.read('dist/app.js'), 'console.log("hello")')
+        self.assertEqual(self.read('dist/maps/app.js.map'), '{}')
+        self.assertFalse(os.path.exists(os.path.join(self.home, 'dist', 'stale.js')))
+
+        mode = os.stat(os.path.join(self.home, 'dist', 'app.js')).st_mode & 0o777
+        self.assertEqual(mode, 0o640)
+
+    def test_identical_outputs_are_stored_once(self):
+        self.build()
+        self.cache.save('a', self.home, ['dist'])
+        self.cache.save('b', self.home, ['dist'])
+
+        objects = [name for _, _, names in os.walk(self.cache.objects) for name in names]
+        self.assertEqual(len(objects), 2)
+
+    def test_missing_outputs_are_not_cached(self):
+        key = self.cache.key(self.home, self.step)
+        self.cache.save(key, self.home, self.step.outputs)
+
+        self.assertFalse(self.cache.restore(key, self.home, self.step.outputs))
+
+    def test_evicts_least_recently_used(self):
+        self.build()
+        self.cache.save('old', self.home, ['dist'])
+        os.utime(self.cache.entry_path('old'), (0, 0))
+
+        # Shrink the budget so that only one entry's objects fit
+        self.write('dist/app.js', 'x' * 100)
+        self.cache.budget = 110
+        self.cache.save('new', self.home, ['dist/app.js'])
+
+        self.assertFalse(os.path.exists(self.cache.entry_path('old')))
+        self.assertTrue(self.cache.restore('new', self.home, ['dist/app.js']))
+
+        objects = [name for _, _, names in os.walk(self.cache.objects) for name in names]
+        self.assertEqual(len(objects), 1)
+
+    def test_paths_outside_home_fail(self):
+        step = Step('build', 'scripts/build.sh', 'build', [],
+                    inputs=['../*'], outputs=['dist'])
+
+        with self.assertRaises(ConfigException):
+            self.cache.key(self.home, step)
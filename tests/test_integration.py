@@ -4,9 +4,11 @@ import io
 import os
 import sys
 import shutil
+import tempfile
 
 import env
 from api.worker import Worker
+from api.mirrors import MirrorCache
 from decorators import mock_scripts
 
 
@@ -37,7 +39,14 @@ class TestIntegration(TestCase):
             'clone_url': 'https://github.com/jeancochrane/bunny-hook-test.git'
         }
 
-        self.worker = Worker(payload)
+        # Keep mirrors in a fresh cache, so that every test clones from scratch
+        self.mirror_root = tempfile.mkdtemp()
+        self.mirrors = MirrorCache(root=self.mirror_root)
+
+        self.worker = Worker(payload, mirrors=self.mirrors)
+
+    def tearDown(self):
+        shutil.rmtree(self.mirror_root)
 
     @mock_scripts
     def test_deploy(self):
@@ -51,8 +60,11 @@ class TestIntegration(TestCase):
         with patch('logging.info', new_callable=MockLogger) as output:
             self.worker.deploy(tmp_path='./bunny-hook-test')
 
+        mirror_path = self.mirrors.path('https://github.com/jeancochrane/bunny-hook-test.git')
+
         expected = [
             'Deploying bunny-hook-test',
+            'Mirroring https://github.com/jeancochrane/bunny-hook-test.git into %s...' % mirror_path,
             'Cloning https://github.com/jeancochrane/bunny-hook-test.git into ./bunny-hook-test...',
             'Loading config file from ./bunny-hook-test/deploy.yml...',
             'Moving repo from ./bunny-hook-test to ./bunny-hook-test/...',
@@ -0,0 +1,75 @@
+import io
+import json
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import appcontext_pushed, g
+from werkzeug.datastructures import Headers
+
+import env
+import api
+from api.logs import logger, log_requests
+from api.routes import get_hmac
+from test_secrets import TOKENS
+
+
+class TestRequestLogging(TestCase):
+
+    def setUp(self):
+        api.app.testing = True
+        self.app = api.app.test_client()
+
+        self.post_data = json.dumps({'ref': 'refs/head/master', 'padding': 'x' * 2000})
+
+    def tearDown(self):
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+
+    def post(self):
+        headers = Headers()
+        headers.add('X-Hub-Signature', get_hmac(TOKENS[0], self.post_data.encode('utf-8')))
+
+        def handler(sender, **kwargs):
+            g.tokens = TOKENS
+
+        with appcontext_pushed.connected_to(handler, api.app):
+            return self.app.post('/hooks/github/deploy',
+                                 content_type='application/json',
+                                 data=self.post_data,
+                                 headers=headers)
+
+    @patch('api.routes.describe_request')
+    def test_no_work_when_disabled(self, describe):
+        self.post()
+        self.assertFalse(describe.called)
+
+    def log(self):
+        stream = io.StringIO()
+        listener = log_requests(stream)
+
+        response = self.post()
+        listener.stop()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        return response, json.loads(lines[0])
+
+    def test_logs_json_lines(self):
+        response, entry = self.log()
+
+        self.assertEqual(entry['status_code'], response.status_code)
+        self.assertEqual(entry['path'], '/hooks/github/deploy')
+        self.assertTrue(entry['payload_truncated'])
+        self.assertEqual(len(entry['payload']), 1024)
+
+    def test_payload_logging_off(self):
+        api.app.config['LOG_PAYLOAD'] = 'off'
+
+        try:
+            response, entry = self.log()
+        finally:
+            del api.app.config['LOG_PAYLOAD']
+
+        self.assertNotIn('payload', entry)
@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import subprocess
+from unittest import TestCase
+
+import env
+from api.metrics import Registry, collect, render
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_counters_and_histograms(self):
+        registry = Registry(self.tmp)
+        registry.inc('deploys_total', repo='app', state='succeeded')
+        registry.inc('deploys_total', repo='app', state='succeeded')
+        registry.observe('deploy_seconds', 0.3)
+        registry.observe('deploy_seconds', 1000)
+        registry.flush()
+
+        counters, histograms = collect(self.tmp)
+
+        self.assertEqual(counters[('deploys_total', (('repo', 'app'), ('state', 'succeeded')))], 2)
+
+        buckets, total, count = histograms[('deploy_seconds', ())]
+        self.assertEqual(count, 2)
+        self.assertEqual(total, 1000.3)
+        self.assertEqual(buckets[-1], 1)
+
+    def test_processes_add_up(self):
+        for _ in range(2):
+            registry = Registry(self.tmp)
+            registry.inc('requests_total', status=202)
+            registry.observe('request_seconds', 0.01)
+            registry.flush()
+
+        counters, histograms = collect(self.tmp)
+
+        self.assertEqual(counters[('requests_total', (('status', 202),))], 2)
+        self.assertEqual(histograms[('request_seconds', ())][2], 2)
+
+    def test_exited_processes_are_retired(self):
+        for _ in range(2):
+            proc = subprocess.Popen(['true'])
+            proc.wait()
+
+            # Write metrics as a process that has since exited
+            registry = Registry(self.tmp)
+            registry.path = os.path.join(self.tmp, '%d-exited.json' % proc.pid)
+            registry.inc('requests_total')
+            registry.flush()
+
+            counters, _ = collect(self.tmp)
+
+        live = Registry(self.tmp)
+        live.inc('requests_total')
+        live.flush()
+
+        counters, _ = collect(self.tmp)
+
+        # Their totals live on, but their files don't
+        self.assertEqual(counters[('requests_total', ())], 3)
+        self.assertEqual(sorted(name for name in os.listdir(self.tmp) if name.endswith('.json')),
+                         sorted(['retired.json', os.path.basename(live.path)]))
+
+    def test_only_flushes_on_interval(self):
+        registry = Registry(self.tmp)
+        registry.flush_interval = 3600
+        registry.inc('requests_total')
+
+        self.assertEqual(collect(self.tmp), ({}, {}))
+
+        registry.flush_interval = 0
+        registry.inc('requests_total')
+
+        self.assertEqual(collect(self.tmp)[0][('requests_total', ())], 2)
+
+    def test_forked_process_starts_over(self):
+        registry = Registry(self.tmp)
+        registry.inc('requests_total')
+        path = registry.path
+
+        # Pretend to be a child process
+        registry.pid = -1
+        registry.inc('requests_total')
+
+        self.assertNotEqual(registry.path, path)
+        self.assertEqual(registry.counters, {('requests_total', ()): 1})
+
+    def test_timer_records_failures(self):
+        registry = Registry(self.tmp)
+
+        with self.assertRaises(ValueError):
+            with registry.timer('step_seconds'):
+                raise ValueError()
+
+        self.assertEqual(registry.histograms[('step_seconds', ())][2], 1)
+
+    def test_render(self):
+        registry = Registry(self.tmp)
+        registry.inc('requests_total', status=202)
+        registry.observe('request_seconds', 0.02, path='/hooks/"x"')
+        registry.flush()
+
+        counters, histograms = collect(self.tmp)
+        text = render(counters, histograms, {('queue_depth', (('state', 'queued'),)): 3})
+
+        self.assertIn('# TYPE requests_total counter\nrequests_total{status="202"} 1\n', text)
+        self.assertIn('# TYPE queue_depth gauge\nqueue_depth{state="queued"} 3\n', text)
+        self.assertIn('# TYPE request_seconds histogram\n', text)
+        self.assertIn('request_seconds_bucket{path="/hooks/\\"x\\"",le="0.01"} 0\n', text)
+        self.assertIn('request_seconds_bucket{path="/hooks/\\"x\\"",le="0.025"} 1\n', text)
+        self.assertIn('request_seconds_bucket{path="/hooks/\\"x\\"",le="+Inf"} 1\n', text)
+        self.assertIn('request_seconds_count{path="/hooks/\\"x\\""} 1\n', text)
+
+    def test_flush_skips_unchanged(self):
+        registry = Registry(self.tmp)
+        registry.inc('requests_total')
+        registry.flush()
+
+        os.remove(registry.path)
+        registry.flush()
+
+        self.assertFalse(os.path.exists(registry.path))
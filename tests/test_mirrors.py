@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import logging
+from unittest import TestCase
+
+import env
+from api.mirrors import MirrorCache
+from repos import git, commit, make_repo
+
+
+def run_command(cmd):
+    return subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL)
+
+
+class TestMirrorCache(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp, 'origin')
+        make_repo(self.origin, {'README.md': 'Hello'})
+
+        self.cache = MirrorCache(root=os.path.join(self.tmp, 'mirrors'))
+
+        # Suppress stdout logging
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def test_mirror_path_keyed_by_origin(self):
+        self.assertNotEqual(self.cache.path('https://github.com/a/repo.git'),
+                            self.cache.path('https://github.com/b/repo.git'))
+
+    def test_update_creates_bare_mirror(self):
+        mirror_path = self.cache.update(self.origin, 'master', run_command)
+
+        self.assertEqual(git(mirror_path, 'rev-parse', '--is-bare-repository'), 'true')
+        self.assertEqual(git(mirror_path, 'rev-parse', 'master'),
+                         git(self.origin, 'rev-parse', 'master'))
+
+    def test_update_fetches_new_commits(self):
+        mirror_path = self.cache.update(self.origin, 'master', run_command)
+
+        sha = commit(self.origin, {'README.md': 'Hello again'})
+        self.cache.update(self.origin, 'master', run_command)
+
+        self.assertEqual(git(mirror_path, 'rev-parse', 'master'), sha)
+
+    def test_evicts_least_recently_used(self):
+        other = os.path.join(self.tmp, 'other')
+        make_repo(other, {'README.md': 'Other'})
+
+        first = self.cache.update(self.origin, 'master', run_command)
+
+        # Shrink the budget so that only one mirror fits
+        self.cache.budget = 1
+        second = self.cache.update(other, 'master', run_command)
+
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
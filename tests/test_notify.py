@@ -0,0 +1,58 @@
+import os
+import time
+from unittest import TestCase
+
+import env
+from api.notify import Notifier
+
+
+class TestNotifier(TestCase):
+
+    def setUp(self):
+        self.consumer = Notifier('test_notify.db')
+        self.producer = Notifier('test_notify.db')
+        self.consumer.listen()
+
+    def tearDown(self):
+        self.consumer.close()
+
+    def test_notifier_shares_channel(self):
+        self.assertEqual(self.consumer.directory, self.producer.directory)
+        self.assertNotEqual(self.consumer.directory, Notifier('other.db').directory)
+
+    def test_notify_wakes_consumer(self):
+        self.producer.notify()
+
+        start = time.time()
+        self.assertTrue(self.consumer.wait(5))
+        self.assertLess(time.time() - start, 1)
+
+    def test_wait_times_out(self):
+        self.assertFalse(self.consumer.wait(0.01))
+
+    def test_notifications_are_drained(self):
+        for _ in range(5):
+            self.producer.notify()
+
+        self.assertTrue(self.consumer.wait(1))
+        self.assertFalse(self.consumer.wait(0.01))
+
+    def test_wake_only_wakes_self(self):
+        other = Notifier('test_notify.db')
+        other.listen()
+
+        self.consumer.wake()
+
+        self.assertTrue(self.consumer.wait(1))
+        self.assertFalse(other.wait(0.01))
+        other.close()
+
+    def test_notify_removes_stale_sockets(self):
+        stale = Notifier('test_notify.db')
+        stale.listen()
+
+        # Simulate a consumer that died without cleaning up
+        stale.sock.close()
+
+        self.producer.notify()
+        self.assertFalse(os.path.exists(stale.path))
@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+
+import env
+from api import parse_configs
+from api.parse_configs import Parse, get_parser, blob_sha
+from api.exceptions import ConfigException, WorkerException
+
+
+class TestParse(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+        self.server_config = os.path.join(self.tmp, 'config.yml')
+        self.write(self.server_config, 'tmp: /srv/tmp/\ngit_path: /srv/git/\n')
+
+        self.repo = os.path.join(self.tmp, 'repo')
+        os.makedirs(self.repo)
+        self.write(os.path.join(self.repo, 'deploy.yml'),
+                   'home: /srv/app\nbuild:\n    - scripts/build.sh\n')
+
+        # Suppress stdout logging
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def write(self, path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def test_merges_server_and_deploy_configs(self):
+        config = Parse(self.server_config).parse(self.repo)
+
+        self.assertEqual(config, {
+            'tmp': '/srv/tmp/',
+            'git_path': '/srv/git/',
+            'home': '/srv/app',
+            'build': ['scripts/build.sh'],
+        })
+
+    def test_no_server_config(self):
+        config = Parse().parse(self.repo)
+        self.assertEqual(config, {'home': '/srv/app', 'build': ['scripts/build.sh']})
+
+    def test_cached_by_blob_sha(self):
+        parser = Parse()
+
+        with patch.object(Parse, 'parse_deploy', wraps=parser.parse_deploy) as parse_deploy:
+            parser.parse(self.repo)
+            parser.parse(self.repo)
+            self.assertEqual(parse_deploy.call_count, 1)
+
+            # Changing the file changes its sha, so it gets parsed again
+            self.write(os.path.join(self.repo, 'deploy.yml'), 'home: /srv/other\n')
+            self.assertEqual(parser.parse(self.repo)['home'], '/srv/other')
+            self.assertEqual(parse_deploy.call_count, 2)
+
+    def test_cached_config_is_not_shared(self):
+        parser = Parse()
+
+        parser.parse(self.repo)['build'].append('scripts/evil.sh')
+        self.assertEqual(parser.parse(self.repo)['build'], ['scripts/build.sh'])
+
+    def test_blob_sha_matches_git(self):
+        path = os.path.join(self.repo, 'deploy.yml')
+        expected = subprocess.check_output(['git', 'hash-object', path],
+                                           universal_newlines=True).strip()
+
+        with open(path, 'rb') as f:
+            self.assertEqual(blob_sha(f.read()), expected)
+
+    def test_wrong_type_fails(self):
+        self.write(os.path.join(self.repo, 'deploy.yml'), 'home: /srv/app\nbuild: scripts/build.sh\n')
+
+        with self.assertRaises(ConfigException) as e:
+            Parse().parse(self.repo)
+
+        self.assertIn('Directive `build`', str(e.exception))
+
+    def test_not_a_mapping_fails(self):
+        self.write(os.path.join(self.repo, 'deploy.yml'), '- home: /srv/app\n')
+
+        with self.assertRaises(ConfigException) as e:
+            Parse().parse(self.repo)
+
+        self.assertIn('should be a mapping', str(e.exception))
+
+    def test_limits_merge_with_server_defaults(self):
+        self.write(self.server_config, 'limits:\n    cpu: 600\n    open_files: 1024\n')
+        self.write(os.path.join(self.repo, 'deploy.yml'),
+                   'home: /srv/app\njob_timeout: 60\nlimits:\n    cpu: 30\n')
+
+        config = Parse(self.server_config).parse(self.repo)
+
+        self.assertEqual(config['job_timeout'], 60)
+        self.assertEqual(config['limits'], {'cpu': 30, 'open_files': 1024})
+
+    def test_bad_limits_fail(self):
+        for contents in ('job_timeout: 0\n', 'limits:\n    disk: 10\n',
+                         'limits:\n    memory: lots\n'):
+            self.write(os.path.join(self.repo, 'deploy.yml'), 'home: /srv/app\n' + contents)
+
+            with self.assertRaises(ConfigException):
+                Parse().parse(self.repo)
+
+    def test_bad_checkout_fails(self):
+        self.write(os.path.join(self.repo, 'deploy.yml'), 'home: /srv/app\ncheckout: tarball\n')
+
+        with self.assertRaises(ConfigException) as e:
+            Parse().parse(self.repo)
+
+        self.assertIn('Directive `checkout`', str(e.exception))
+
+    def test_bad_priorities_fail(self):
+        for contents in ('priorities:\n    - branch: hotfix\n',
+                         'priorities:\n    - priority: 10\n      colour: blue\n',
+                         'priorities:\n    - production\n',
+                         'priorities:\n    - priority: %d\n' % 2 ** 63):
+            self.write(self.server_config, contents)
+
+            with self.assertRaises(ConfigException):
+                Parse(self.server_config)
+
+    def test_unknown_directives_are_dropped(self):
+        self.write(os.path.join(self.repo, 'deploy.yml'), 'home: /srv/app\ncolour: blue\n')
+        self.assertEqual(Parse().parse(self.repo), {'home': '/srv/app'})
+
+    def test_unsafe_yaml_is_rejected(self):
+        self.write(os.path.join(self.repo, 'deploy.yml'),
+                   'home: !!python/object/apply:os.getcwd []\n')
+
+        with self.assertRaises(ConfigException):
+            Parse().parse(self.repo)
+
+    def test_config_errors_are_worker_errors(self):
+        os.remove(os.path.join(self.repo, 'deploy.yml'))
+
+        with self.assertRaises(WorkerException):
+            Parse().parse(self.repo)
+
+    def test_get_parser_is_shared(self):
+        self.assertIs(get_parser(self.server_config), get_parser(self.server_config))
+        self.assertIsNot(get_parser(self.server_config), get_parser())
+
+    def test_repo_config_file(self):
+        with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               'config.yml')) as f:
+            config = parse_configs.validate(parse_configs.load(f.name), parse_configs.SERVER_SCHEMA,
+                                            f.name)
+
+        self.assertIn('tmp', config)
+        self.assertIn('git_path', config)
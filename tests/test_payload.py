@@ -39,3 +39,30 @@ class TestPayload(TestCase):
     def test_payload_get_name(self):
         self.assertEqual(self.payload.get_name(), 'bunny-hook')
 
+
+    def test_payload_is_slim(self):
+        with self.assertRaises(AttributeError):
+            self.payload.foo = 'bar'
+
+    def test_payload_owner_and_sha(self):
+        payload = Payload({
+            'ref': 'refs/heads/master',
+            'after': 'abc123',
+            'repository': {
+                'name': 'bunny-hook',
+                'owner': {'login': 'jeancochrane'},
+                'clone_url': 'https://github.com/jeancochrane/bunny-hook.git'
+            }
+        })
+
+        self.assertEqual(payload.owner, 'jeancochrane')
+        self.assertEqual(payload.sha, 'abc123')
+        self.assertEqual(payload.get_origin(),
+                         'https://github.com/jeancochrane/bunny-hook.git')
+
+    def test_payload_from_record(self):
+        payload = Payload.from_record('refs/heads/master', 'bunny-hook', origin='origin.git')
+
+        self.assertTrue(payload.validate('master'))
+        self.assertEqual(payload.get_origin(), 'origin.git')
+        self.assertIsNone(payload.get('ref'))
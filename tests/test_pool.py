@@ -0,0 +1,223 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+import env
+from api.pool import Pool
+from api.queue import Queue
+from api.memqueue import MemoryQueue
+from api.exceptions import QueueException, WorkerException
+from repos import make_repo
+
+
+def make_payload(name):
+    return {
+        'ref': 'refs/head/master',
+        'repository': {
+            'name': name
+        },
+        'clone_url': 'https://github.com/jeancochrane/%s.git' % name
+    }
+
+
+def crash(work_id, payload, db_conn, server_config=None):
+    # Die the way a worker process does when it gets killed
+    os._exit(1)
+
+
+def succeed(work_id, payload, db_conn, server_config=None):
+    pass
+
+
+class TestPool(TestCase):
+
+    def setUp(self):
+        self.db_conn = 'test_pool.db'
+        self.queue = Queue(self.db_conn)
+
+        # Record which repos are deploying at any given time
+        self.lock = threading.Lock()
+        self.active = []
+        self.overlaps = []
+
+    def tearDown(self):
+        self.queue.close()
+        os.remove(self.db_conn)
+
+    def fake_deploy(self, work_id, payload, db_conn, server_config=None):
+        name = payload.name
+
+        with self.lock:
+            if name in self.active:
+                self.overlaps.append(name)
+            self.active.append(name)
+
+        time.sleep(0.05)
+
+        with self.lock:
+            self.active.remove(name)
+
+    def drain(self, pool):
+        with patch('api.pool.deploy', new=self.fake_deploy):
+            for _ in range(200):
+                pool.run()
+                queued = self.queue.cursor.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+                if not (pool.running or queued):
+                    break
+                time.sleep(0.01)
+            pool.shutdown()
+
+    def test_pool_bad_mode(self):
+        with self.assertRaises(QueueException):
+            Pool(mode='fork', queue=self.queue)
+
+    def test_pool_memory_queue_needs_threads(self):
+        queue = MemoryQueue('memory:test_pool')
+
+        try:
+            with self.assertRaises(QueueException):
+                Pool(mode='process', queue=queue)
+        finally:
+            queue.close()
+
+    def test_pool_runs_repos_in_parallel(self):
+        pool = Pool(size=2, queue=self.queue)
+
+        with patch('api.pool.deploy', new=self.fake_deploy):
+            self.queue.add(make_payload('frontend'))
+            self.queue.add(make_payload('backend'))
+            pool.run()
+
+            self.assertEqual(set(pool.running.keys()), {'frontend', 'backend'})
+            pool.shutdown()
+
+    def test_pool_serializes_same_repo(self):
+        pool = Pool(size=4, queue=self.queue)
+
+        for _ in range(3):
+            self.queue.add(make_payload('frontend'))
+        self.queue.add(make_payload('backend'))
+
+        self.drain(pool)
+
+        self.assertFalse(self.active)
+        self.assertEqual(self.overlaps, [])
+
+    def test_pool_leaves_busy_repo_jobs_queued(self):
+        pool = Pool(size=4, queue=self.queue)
+
+        with patch('api.pool.deploy', new=self.fake_deploy):
+            self.queue.add(make_payload('frontend'))
+            self.queue.add(make_payload('frontend'))
+            pool.run()
+
+            self.assertEqual(list(pool.running.keys()), ['frontend'])
+
+            queued = self.queue.cursor.execute('''
+                SELECT COUNT(*) FROM queue WHERE state = 'queued'
+            ''').fetchone()[0]
+            self.assertEqual(queued, 1)
+
+            pool.shutdown()
+
+    def test_pool_retries_failures(self):
+        pool = Pool(size=1, queue=self.queue)
+        self.queue.max_attempts = 2
+        self.queue.retry_delay = 60
+
+        def fail(*args):
+            raise WorkerException('Could not fetch')
+
+        work_id = self.queue.add(make_payload('frontend'))
+
+        with patch('api.pool.deploy', new=fail):
+            pool.run()
+            pool.shutdown()
+
+        job = self.queue.status(work_id)
+        self.assertEqual(job['state'], 'queued')
+        self.assertEqual(job['error'], 'Could not fetch')
+        self.assertEqual(self.queue.depth(), {'delayed': 1})
+
+    def test_pool_survives_crashes(self):
+        pool = Pool(size=1, queue=self.queue)
+
+        def fail(*args):
+            raise KeyError('bug')
+
+        broken = self.queue.add(make_payload('frontend'))
+
+        with patch('api.pool.deploy', new=fail):
+            pool.run()
+            while pool.running:
+                time.sleep(0.01)
+                pool.reap()
+
+        self.assertEqual(self.queue.status(broken)['state'], 'failed')
+        self.assertEqual([job['id'] for job in self.queue.dead_letters()], [broken])
+
+        # The pool keeps deploying other jobs
+        work_id = self.queue.add(make_payload('backend'))
+        self.drain(pool)
+        self.assertEqual(self.queue.status(work_id)['state'], 'succeeded')
+
+    def test_pool_replaces_dead_workers(self):
+        pool = Pool(size=1, mode='process', queue=self.queue)
+        self.queue.max_attempts = 2
+        self.queue.retry_delay = 60
+
+        crashed = self.queue.add(make_payload('frontend'))
+
+        with patch('api.pool.deploy', new=crash):
+            pool.run()
+            while pool.running:
+                time.sleep(0.01)
+                pool.reap()
+
+        # The job gets retried, since it wasn't its own fault
+        self.assertEqual(self.queue.status(crashed)['state'], 'queued')
+
+        work_id = self.queue.add(make_payload('backend'))
+
+        with patch('api.pool.deploy', new=succeed):
+            pool.run()
+            pool.shutdown()
+
+        self.assertEqual(self.queue.status(work_id)['state'], 'succeeded')
+
+    def test_pool_runs_scripts(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+
+        home = os.path.join(tmp, 'home')
+        origin = os.path.join(tmp, 'origin')
+
+        # Parallel steps run in threads of their own, which check whether
+        # the job has been cancelled before every command
+        make_repo(origin, {
+            'deploy.yml': ('home: %s\ncheckout: archive\nbuild:\n    - parallel:\n'
+                           '        - one.sh\n        - two.sh\n' % home),
+            'one.sh': 'touch "$(dirname "$0")/one.txt"\n',
+            'two.sh': 'touch "$(dirname "$0")/two.txt"\n',
+        })
+
+        server_config = os.path.join(tmp, 'config.yml')
+        with open(server_config, 'w') as f:
+            f.write('tmp: %s\ngit_path: %s\n' % (tmp, tmp))
+
+        payload = make_payload('origin')
+        payload.update(ref='refs/heads/master', clone_url=origin)
+        work_id = self.queue.add(payload)
+
+        pool = Pool(size=1, queue=self.queue, server_config=server_config)
+        pool.run()
+        pool.shutdown()
+        pool.reap()
+
+        self.assertEqual(self.queue.status(work_id)['state'], 'succeeded')
+        self.assertTrue(os.path.exists(os.path.join(home, 'current', 'one.txt')))
+        self.assertTrue(os.path.exists(os.path.join(home, 'current', 'two.txt')))
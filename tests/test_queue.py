@@ -1,10 +1,13 @@
 import os
+import json
 import sqlite3
+import threading
 from unittest import TestCase
 from unittest.mock import patch
 
 import env
-from api.queue import Queue
+from api.queue import Queue, get_queue, close_queue
+from api.exceptions import QueueException, WorkerException
 
 
 class TestQueue(TestCase):
@@ -24,10 +27,21 @@ class TestQueue(TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        cls.queue.close()
         os.remove('test.db')
 
     def tearDown(self):
         self.queue.cursor.execute('DELETE FROM queue')
+        self.queue.cursor.execute('DELETE FROM jobs')
+        self.queue.cursor.execute('DELETE FROM repos')
+
+    def assertPayload(self, work):
+        '''
+        Check that a payload from the queue matches the one that was added.
+        '''
+        self.assertEqual(work.get_name(), 'bunny-hook')
+        self.assertEqual(work.get_branch(), 'master')
+        self.assertEqual(work.get_origin(), self.payload['clone_url'])
 
     def test_queue_created(self):
         create_table = '''
@@ -53,7 +67,7 @@ class TestQueue(TestCase):
         self.queue.add(self.payload)
 
         work = self.queue.pop()
-        self.assertTrue(work == self.payload)
+        self.assertPayload(work)
 
     def test_queue_pop_no_work(self):
         self.assertIsNone(self.queue.pop())
@@ -68,9 +82,11 @@ class TestQueue(TestCase):
         work = second_queue.pop()
 
         self.assertIsNotNone(work)
-        self.assertEqual(work, self.payload)
+        self.assertPayload(work)
 
-    @patch('api.queue.Worker.deploy')
+        second_queue.close()
+
+    @patch('api.backends.Worker.deploy')
     def test_queue_run(self, mock_deploy):
         self.queue.add(self.payload)
 
@@ -85,3 +101,399 @@ class TestQueue(TestCase):
         self.assertTrue(mock_deploy.called)
         self.assertIsNone(self.queue.pop())
 
+    def test_queue_add_wakes_consumers(self):
+        second_queue = Queue(self.db_conn)
+        second_queue.notifier.listen()
+
+        self.queue.add(self.payload)
+
+        self.assertTrue(second_queue.wait(1))
+        second_queue.close()
+
+    def test_queue_uses_wal(self):
+        mode = self.queue.cursor.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_queue_claim_uses_index(self):
+        plan = self.queue.cursor.execute('''
+            EXPLAIN QUERY PLAN
+            SELECT id, payload FROM queue
+             WHERE state = 'queued'
+             ORDER BY date_added
+             LIMIT 1
+        ''').fetchall()
+
+        self.assertIn('queue_state_date_added', ' '.join(str(row) for row in plan))
+
+    def test_queue_claim_leases_job(self):
+        work_id = self.queue.add(self.payload)
+
+        job = self.queue.claim()
+        self.assertEqual(job.id, work_id)
+        self.assertPayload(job.payload)
+
+        # Leased jobs can't be claimed again, but stay on the queue
+        self.assertIsNone(self.queue.claim())
+
+        state = self.queue.cursor.execute('SELECT state FROM queue WHERE id = ?',
+                                          (work_id,)).fetchone()[0]
+        self.assertEqual(state, 'leased')
+
+    def test_queue_ack(self):
+        self.queue.add(self.payload)
+
+        job = self.queue.claim()
+        self.queue.ack(job.id)
+
+        count = self.queue.cursor.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_queue_nack(self):
+        work_id = self.queue.add(self.payload)
+
+        job = self.queue.claim()
+        self.queue.nack(job.id)
+
+        self.assertEqual(self.queue.claim().id, work_id)
+
+    def test_queue_expired_lease_is_requeued(self):
+        work_id = self.queue.add(self.payload)
+
+        self.queue.claim(lease_timeout=-1)
+
+        self.assertEqual(self.queue.claim().id, work_id)
+
+    def test_queue_renew(self):
+        self.queue.add(self.payload)
+
+        job = self.queue.claim(lease_timeout=-1)
+        self.queue.renew([job.id])
+
+        self.assertIsNone(self.queue.claim())
+
+    def test_queue_upgrades_old_table(self):
+        db_conn = 'test_upgrade.db'
+        conn = sqlite3.connect(db_conn)
+        conn.execute('CREATE TABLE queue (id TEXT, payload TEXT, date_added NUMERIC)')
+        conn.execute("INSERT INTO queue VALUES ('old', ?, 0)", (json.dumps(self.payload),))
+        conn.commit()
+        conn.close()
+
+        queue = Queue(db_conn)
+        job = queue.claim(exclude=['other'])
+        self.assertEqual(job.id, 'old')
+        self.assertEqual(job.repo, 'bunny-hook')
+        self.assertPayload(job.payload)
+        self.assertEqual(job.payload.as_dict, self.payload)
+
+        # Jobs from before the history existed are entered into it
+        self.assertEqual(queue.status('old')['state'], 'running')
+
+        queue.close()
+        os.remove(db_conn)
+
+    def test_queue_upgrades_old_history(self):
+        db_conn = 'test_upgrade.db'
+        conn = sqlite3.connect(db_conn)
+        conn.execute('CREATE TABLE queue (id TEXT PRIMARY KEY, payload TEXT, date_added NUMERIC)')
+        conn.execute('''
+            CREATE TABLE jobs (seq INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, repo TEXT,
+                               owner TEXT, branch TEXT, sha TEXT, state TEXT, date_added NUMERIC,
+                               date_started NUMERIC, date_finished NUMERIC, error TEXT)
+        ''')
+        conn.execute("INSERT INTO queue VALUES ('old', ?, 0)", (json.dumps(self.payload),))
+        conn.execute("INSERT INTO jobs (id, state, date_added) VALUES ('old', 'queued', 0)")
+        conn.commit()
+        conn.close()
+
+        queue = Queue(db_conn)
+        queue.claim()
+
+        # Attempts are counted from the upgrade on
+        self.assertEqual(queue.status('old')['attempts'], 1)
+
+        queue.close()
+        os.remove(db_conn)
+
+    def test_queue_upgrades_old_repos(self):
+        self.queue.add(self.payload)
+
+        # A repos table from before top priorities were recorded
+        self.queue.cursor.execute('DROP TABLE repos')
+        self.queue.cursor.execute('''
+            CREATE TABLE repos
+                (repo TEXT NOT NULL PRIMARY KEY, last_claimed NUMERIC NOT NULL DEFAULT 0)
+        ''')
+
+        queue = Queue(self.db_conn)
+
+        try:
+            self.assertEqual(queue.claim().repo, 'bunny-hook')
+        finally:
+            queue.close()
+
+    def test_get_queue_is_per_thread(self):
+        queue = get_queue(self.db_conn)
+        self.assertIs(get_queue(self.db_conn), queue)
+
+        other = []
+
+        def connect():
+            other.append(get_queue(self.db_conn))
+            close_queue(self.db_conn)
+
+        thread = threading.Thread(target=connect)
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(other[0], queue)
+
+        # Connections from any thread see the same datastore
+        work_id = queue.add(self.payload)
+        self.assertEqual(self.queue.claim().id, work_id)
+
+        close_queue(self.db_conn)
+        self.assertIsNot(get_queue(self.db_conn), queue)
+        close_queue(self.db_conn)
+
+    def count(self, state):
+        return self.queue.cursor.execute('SELECT COUNT(*) FROM queue WHERE state = ?',
+                                         (state,)).fetchone()[0]
+
+    def test_queue_add_without_coalescing(self):
+        self.queue.add(self.payload)
+        self.queue.add(self.payload)
+
+        self.assertEqual(self.count('queued'), 2)
+
+    def test_queue_add_coalesces_queued_jobs(self):
+        self.queue.add(self.payload)
+        work_id = self.queue.add(self.payload, coalesce=True)
+
+        self.assertEqual(self.count('queued'), 1)
+        self.assertEqual(self.queue.claim().id, work_id)
+
+    def test_queue_coalesce_keeps_other_branches(self):
+        other_branch = dict(self.payload, ref='refs/heads/staging')
+
+        self.queue.add(other_branch)
+        self.queue.add(self.payload, coalesce=True)
+
+        self.assertEqual(self.count('queued'), 2)
+
+    def test_queue_coalesce_cancels_running_jobs(self):
+        self.queue.add(self.payload)
+        running = self.queue.claim()
+
+        self.queue.add(self.payload, coalesce=True)
+        self.assertFalse(self.queue.is_cancelled(running.id))
+
+        self.queue.add(self.payload, coalesce=True, cancel_running=True)
+        self.assertTrue(self.queue.is_cancelled(running.id))
+        self.assertEqual(self.count('queued'), 1)
+
+    def test_queue_claim_excludes_repos(self):
+        other_repo = dict(self.payload, repository={'name': 'other'})
+
+        self.queue.add(self.payload)
+        work_id = self.queue.add(other_repo)
+
+        job = self.queue.claim(exclude=['bunny-hook'])
+        self.assertEqual(job.id, work_id)
+        self.assertEqual(job.repo, 'other')
+
+    def test_queue_claims_higher_priority_first(self):
+        staging = self.queue.add(dict(self.payload, ref='refs/heads/staging'))
+        other = self.queue.add(dict(self.payload, repository={'name': 'other'}))
+        hotfix = self.queue.add(dict(self.payload, ref='refs/heads/hotfix'), priority=10)
+
+        # The hotfix jumps the line, then its repo waits its turn
+        self.assertEqual([self.queue.claim().id for _ in range(3)], [hotfix, other, staging])
+
+    def test_queue_takes_turns_between_repos(self):
+        busy = [self.queue.add(self.payload) for _ in range(3)]
+        quiet = self.queue.add(dict(self.payload, repository={'name': 'quiet'}))
+
+        claimed = []
+        for _ in range(4):
+            job = self.queue.claim()
+            claimed.append(job.id)
+            self.queue.ack(job.id)
+
+        # The quiet repo doesn't wait behind every job from the busy one
+        self.assertEqual(claimed, [busy[0], quiet, busy[1], busy[2]])
+
+    def test_queue_claim_plan_uses_indexes(self):
+        for name in ('a', 'b', 'c'):
+            self.queue.add(dict(self.payload, repository={'name': name}))
+
+        self.queue.cursor.execute('ANALYZE')
+
+        statements = []
+        self.queue.conn.set_trace_callback(statements.append)
+
+        try:
+            self.queue.claim(exclude=['a'])
+        finally:
+            self.queue.conn.set_trace_callback(None)
+
+        def plan(table):
+            sql, = [sql for sql in statements
+                    if sql.strip().startswith('SELECT') and 'ORDER BY' in sql and table in sql]
+
+            return ' '.join(str(row) for row in self.queue.cursor.execute(
+                'EXPLAIN QUERY PLAN ' + sql).fetchall())
+
+        # Picking the repo, then its job, are both one seek
+        self.assertIn('repos_turn', plan('FROM repos'))
+        self.assertNotIn('TEMP B-TREE', plan('FROM repos'))
+        self.assertIn('queue_repo_priority', plan('FROM queue'))
+        self.assertNotIn('SCAN queue', plan('FROM queue'))
+
+        self.queue.cursor.execute('DROP TABLE sqlite_stat1')
+
+    def test_queue_stores_slim_records(self):
+        payload = dict(self.payload, after='abc123', commits=[{'id': 'x' * 40}] * 100)
+
+        work_id = self.queue.add(payload)
+
+        stored = self.queue.cursor.execute('''
+            SELECT payload, payload_blob, sha FROM queue WHERE id = ?
+        ''', (work_id,)).fetchone()
+        self.assertEqual(stored, (None, None, 'abc123'))
+
+        job = self.queue.claim()
+        self.assertPayload(job.payload)
+        self.assertEqual(job.payload.sha, 'abc123')
+        self.assertIsNone(job.payload.as_dict)
+
+    def test_queue_stores_compressed_payload(self):
+        payload = dict(self.payload, commits=[{'id': 'x' * 40}] * 100)
+
+        self.queue.add(payload, store_payload=True)
+
+        blob = self.queue.cursor.execute('SELECT payload_blob FROM queue').fetchone()[0]
+        self.assertLess(len(blob), len(json.dumps(payload)))
+
+        self.assertEqual(self.queue.claim().payload.as_dict, payload)
+
+    def test_job_history_states(self):
+        work_id = self.queue.add(self.payload)
+
+        job = self.queue.status(work_id)
+        self.assertEqual(job['state'], 'queued')
+        self.assertEqual(job['repo'], 'bunny-hook')
+        self.assertIsNone(job['date_started'])
+
+        self.queue.claim()
+        job = self.queue.status(work_id)
+        self.assertEqual(job['state'], 'running')
+        self.assertIsNotNone(job['date_started'])
+
+        self.queue.ack(work_id)
+        job = self.queue.status(work_id)
+        self.assertEqual(job['state'], 'succeeded')
+        self.assertIsNotNone(job['date_finished'])
+
+    def test_job_history_failure(self):
+        work_id = self.queue.add(self.payload)
+
+        self.queue.claim()
+        self.queue.ack(work_id, 'failed', 'Build script exited with 1')
+
+        job = self.queue.status(work_id)
+        self.assertEqual(job['state'], 'failed')
+        self.assertEqual(job['error'], 'Build script exited with 1')
+
+    def test_job_history_requeued(self):
+        work_id = self.queue.add(self.payload)
+
+        self.queue.claim()
+        self.queue.nack(work_id)
+        self.assertEqual(self.queue.status(work_id)['state'], 'queued')
+
+        # Expired leases go back to the queue too
+        self.queue.claim(lease_timeout=-1)
+        self.assertEqual(self.queue.claim().id, work_id)
+        self.assertEqual(self.queue.status(work_id)['state'], 'running')
+
+    def test_job_history_coalesced(self):
+        first = self.queue.add(self.payload)
+        self.queue.add(self.payload, coalesce=True)
+
+        self.assertEqual(self.queue.status(first)['state'], 'cancelled')
+
+    def test_job_history_unknown_state(self):
+        work_id = self.queue.add(self.payload)
+
+        with self.assertRaises(QueueException):
+            self.queue.ack(work_id, 'exploded')
+
+    @patch('api.backends.Worker.deploy', side_effect=WorkerException('Boom'))
+    def test_queue_run_records_failure(self, mock_deploy):
+        work_id = self.queue.add(self.payload)
+
+        with self.assertRaises(WorkerException):
+            self.queue.run()
+
+        job = self.queue.status(work_id)
+        self.assertEqual(job['state'], 'failed')
+        self.assertEqual(job['error'], 'Boom')
+
+    def test_job_history_unknown_job(self):
+        self.assertIsNone(self.queue.status('nope'))
+
+    def test_job_history_pages(self):
+        other = dict(self.payload, repository={'name': 'other'})
+
+        ids = []
+        for _ in range(5):
+            ids.append(self.queue.add(self.payload))
+            self.queue.add(other)
+
+        jobs, cursor = self.queue.history(repo='bunny-hook', limit=2)
+        self.assertEqual([job['id'] for job in jobs], ids[::-1][:2])
+
+        seen = [job['id'] for job in jobs]
+        while cursor:
+            jobs, cursor = self.queue.history(repo='bunny-hook', before=cursor, limit=2)
+            seen += [job['id'] for job in jobs]
+
+        self.assertEqual(seen, ids[::-1])
+
+        jobs, cursor = self.queue.history(limit=20)
+        self.assertEqual(len(jobs), 10)
+        self.assertIsNone(cursor)
+
+    def test_job_history_uses_indexes(self):
+        plan = self.queue.cursor.execute('''
+            EXPLAIN QUERY PLAN
+            SELECT id FROM jobs
+             WHERE repo = ? AND seq < ?
+             ORDER BY seq DESC
+             LIMIT 20
+        ''', ('bunny-hook', 100)).fetchall()
+
+        plan = ' '.join(str(row) for row in plan)
+        self.assertIn('jobs_repo_seq', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_job_history_pruned(self):
+        old = self.queue.add(self.payload)
+        running = self.queue.add(self.payload)
+        recent = self.queue.add(self.payload)
+
+        self.queue.claim()
+        self.queue.ack(old)
+        self.queue.claim()
+
+        # Backdate the first two jobs past the history window
+        self.queue.cursor.execute('''
+            UPDATE jobs SET date_added = 0 WHERE id IN (?, ?)
+        ''', (old, running))
+
+        self.queue.prune(force=True)
+
+        self.assertIsNone(self.queue.status(old))
+        self.assertEqual(self.queue.status(running)['state'], 'running')
+        self.assertEqual(self.queue.status(recent)['state'], 'queued')
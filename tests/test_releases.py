@@ -0,0 +1,258 @@
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import logging
+from unittest import TestCase
+
+import env
+from api.archive import Archive
+from api.releases import Releases
+from api.worker import Worker
+from api.mirrors import MirrorCache
+from api.parse_configs import Parse
+from api.exceptions import WorkerException
+from repos import git, commit, make_repo
+
+
+def run_command(cmd, capture=False):
+    stdout = subprocess.PIPE if capture else subprocess.DEVNULL
+
+    try:
+        return subprocess.run(cmd, check=True, universal_newlines=True,
+                              stdout=stdout, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as e:
+        raise WorkerException(str(e))
+
+
+class TestReleases(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp, 'origin')
+        self.home = os.path.join(self.tmp, 'home')
+
+        self.first = make_repo(self.origin, {
+            'README.md': 'Hello',
+            'app/main.py': 'print("hello")',
+        })
+
+        self.releases = Releases(self.home, keep=2)
+        self.archive = Archive(run_command)
+
+        # Suppress stdout logging
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def deploy(self, sha):
+        release = self.releases.create(sha)
+        self.archive.extract(self.origin, sha, release.path, previous=self.releases.live())
+        self.releases.activate(release)
+        return release
+
+    def current(self, *path):
+        with open(os.path.join(self.home, 'current', *path)) as f:
+            return f.read()
+
+    def test_activate_points_current_at_release(self):
+        release = self.deploy(self.first)
+
+        self.assertEqual(release.path, os.path.join(self.home, 'releases', self.first))
+        self.assertEqual(os.readlink(os.path.join(self.home, 'current')),
+                         os.path.join('releases', self.first))
+        self.assertEqual(self.current('README.md'), 'Hello')
+        self.assertEqual(self.releases.live().sha, self.first)
+
+    def test_unchanged_files_are_copied(self):
+        first = self.deploy(self.first)
+
+        # Mark the file, to tell a copy from a fresh extract
+        os.utime(os.path.join(first.path, 'app', 'main.py'), (1000, 1000))
+
+        second = self.deploy(commit(self.origin, {'README.md': 'Hello again'}))
+
+        def stat(release, path):
+            return os.stat(os.path.join(release.path, path))
+
+        self.assertEqual(stat(second, 'app/main.py').st_mtime, 1000)
+        self.assertNotEqual(stat(first, 'app/main.py').st_ino, stat(second, 'app/main.py').st_ino)
+        self.assertEqual(self.current('README.md'), 'Hello again')
+
+        # A build that edits a copy in place leaves the earlier release alone
+        with open(os.path.join(second.path, 'app', 'main.py'), 'w') as f:
+            f.write('print("built")')
+
+        with open(os.path.join(first.path, 'app', 'main.py')) as f:
+            self.assertEqual(f.read(), 'print("hello")')
+
+    def test_modified_files_are_not_copied(self):
+        first = self.deploy(self.first)
+
+        # A build script changed a committed file after it was extracted
+        time.sleep(0.01)
+        with open(os.path.join(first.path, 'app', 'main.py'), 'w') as f:
+            f.write('print("built")')
+
+        second = self.deploy(commit(self.origin, {'README.md': 'Hello again'}))
+
+        with open(os.path.join(second.path, 'app', 'main.py')) as f:
+            self.assertEqual(f.read(), 'print("hello")')
+
+    def test_deleted_files_are_left_out(self):
+        self.deploy(self.first)
+        self.deploy(commit(self.origin, {'app/main.py': None}))
+
+        self.assertFalse(os.path.exists(os.path.join(self.home, 'current', 'app')))
+
+    def test_redeploying_live_commit(self):
+        first = self.deploy(self.first)
+        again = self.deploy(self.first)
+
+        self.assertNotEqual(again.path, first.path)
+        self.assertEqual(self.releases.live().name, again.name)
+        self.assertTrue(os.path.isdir(first.path))
+
+    def test_rollback(self):
+        self.deploy(self.first)
+        second = self.deploy(commit(self.origin, {'README.md': 'Hello again'}))
+
+        self.assertEqual(self.releases.rollback().sha, self.first)
+        self.assertEqual(self.current('README.md'), 'Hello')
+
+        # Rolling forward again, by sha
+        self.assertEqual(self.releases.rollback(second.sha[:8]).name, second.name)
+        self.assertEqual(self.current('README.md'), 'Hello again')
+
+    def test_rollback_without_earlier_release(self):
+        self.deploy(self.first)
+
+        with self.assertRaises(WorkerException):
+            self.releases.rollback()
+
+        with self.assertRaises(WorkerException):
+            self.releases.rollback('deadbeef')
+
+    def test_prune_keeps_newest_and_live(self):
+        shas = [self.first] + [commit(self.origin, {'README.md': str(n)}) for n in range(3)]
+
+        for sha in shas:
+            self.deploy(sha)
+            self.releases.prune()
+
+        self.assertEqual(sorted(os.listdir(self.releases.root)), sorted(shas[-2:]))
+
+        # The live release survives pruning even when it's old
+        self.releases.rollback()
+        self.deploy(commit(self.origin, {'README.md': 'Newest'}))
+        self.releases.rollback(shas[-2])
+        self.releases.prune()
+
+        self.assertIn(shas[-2], os.listdir(self.releases.root))
+        self.assertEqual(self.releases.live().sha, shas[-2])
+
+    def test_discard_removes_release(self):
+        self.deploy(self.first)
+        release = self.releases.create(commit(self.origin, {'README.md': 'Broken'}))
+        self.archive.extract(self.origin, release.sha, release.path)
+
+        self.releases.discard(release)
+
+        self.assertFalse(os.path.exists(release.path))
+        self.assertEqual([old.sha for old in self.releases.history()], [self.first])
+
+
+class TestReleaseDeploy(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tmp, 'origin')
+        self.home = os.path.join(self.tmp, 'home')
+
+        self.config = 'home: %s\nreleases: 2\nbuild:\n    - build.sh\n' % self.home
+        self.first = make_repo(self.origin, {
+            'deploy.yml': self.config,
+            'build.sh': 'echo built > "$(dirname "$0")/built.txt"\n',
+        })
+
+        server_config = os.path.join(self.tmp, 'config.yml')
+        with open(server_config, 'w') as f:
+            f.write('tmp: %s\n' % self.tmp)
+
+        payload = {
+            'ref': 'refs/heads/master',
+            'repository': {
+                'name': 'origin'
+            },
+            'clone_url': self.origin
+        }
+
+        self.worker = Worker(payload, parser=Parse(server_config),
+                             mirrors=MirrorCache(root=os.path.join(self.tmp, 'mirrors')))
+
+        # Suppress stdout logging
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def test_deploys_into_release(self):
+        self.assertTrue(self.worker.deploy())
+
+        current = os.path.join(self.home, 'current')
+        self.assertEqual(os.readlink(current), os.path.join('releases', self.first))
+        self.assertTrue(os.path.exists(os.path.join(current, 'built.txt')))
+
+    def test_failed_build_keeps_live_release(self):
+        self.worker.deploy()
+
+        broken = commit(self.origin, {'build.sh': 'exit 1\n'})
+
+        with self.assertRaises(WorkerException):
+            self.worker.deploy()
+
+        self.assertEqual(Releases(self.home).live().sha, self.first)
+        self.assertFalse(os.path.exists(os.path.join(self.home, 'releases', broken)))
+
+    def test_deploy_scripts_run_after_swap(self):
+        commit(self.origin, {
+            'deploy.yml': self.config + 'deploy:\n    - deploy.sh\n',
+            'deploy.sh': 'readlink "$(dirname "$0")/../../current" > "$(dirname "$0")/live.txt"\n',
+        })
+
+        self.worker.deploy()
+
+        with open(os.path.join(self.home, 'current', 'live.txt')) as f:
+            self.assertEqual(f.read().strip(),
+                             os.path.join('releases', git(self.origin, 'rev-parse', 'HEAD')))
+
+    def test_build_cache_hits_across_releases(self):
+        runs = os.path.join(self.tmp, 'runs')
+        commit(self.origin, {
+            'deploy.yml': ('home: %s\nreleases: 2\nbuild:\n    - script: build.sh\n'
+                           '      inputs: [src.txt]\n      outputs: [dist]\n' % self.home),
+            'build.sh': ('echo run >> %s\nmkdir -p "$(dirname "$0")/dist"\n'
+                         'cp "$(dirname "$0")/src.txt" "$(dirname "$0")/dist/out.txt"\n' % runs),
+            'src.txt': 'source',
+        })
+        self.worker.deploy()
+
+        commit(self.origin, {'README.md': 'Unrelated change'})
+        self.worker.deploy()
+
+        with open(runs) as f:
+            self.assertEqual(f.read(), 'run\n')
+
+        with open(os.path.join(self.home, 'current', 'dist', 'out.txt')) as f:
+            self.assertEqual(f.read(), 'source')
+
+    def test_old_releases_are_pruned(self):
+        for n in range(3):
+            commit(self.origin, {'README.md': str(n)})
+            self.worker.deploy()
+
+        self.assertEqual(len(os.listdir(os.path.join(self.home, 'releases'))), 2)
@@ -0,0 +1,168 @@
+import time
+import threading
+import logging
+from unittest import TestCase
+
+import env
+from api.steps import plan, run_graph
+from api.exceptions import ConfigException, WorkerException
+
+
+def graph(phases):
+    '''
+    Reduce a plan to {phase: {step name: [dependencies]}}, for comparing.
+    '''
+    return {phase: {step.name: step.depends_on for step in steps}
+            for phase, steps in phases}
+
+
+class TestPlan(TestCase):
+
+    def test_plain_lists_run_in_order(self):
+        phases = plan({'build': ['a.sh', 'b.sh', 'c.sh'], 'deploy': ['d.sh']})
+
+        self.assertEqual([phase for phase, _ in phases], ['prebuild', 'build', 'deploy'])
+        self.assertEqual(graph(phases)['build'], {'a.sh': [], 'b.sh': ['a.sh'], 'c.sh': ['b.sh']})
+        self.assertEqual(graph(phases)['deploy'], {'d.sh': []})
+
+    def test_parallel_group(self):
+        phases = plan({'build': [
+            'deps.sh',
+            {'parallel': ['frontend.sh', 'backend.sh']},
+            'bundle.sh',
+        ]})
+
+        self.assertEqual(graph(phases)['build'], {
+            'deps.sh': [],
+            'frontend.sh': ['deps.sh'],
+            'backend.sh': ['deps.sh'],
+            'bundle.sh': ['frontend.sh', 'backend.sh'],
+        })
+
+    def test_depends_on(self):
+        phases = plan({'build': [
+            {'script': 'scripts/frontend.sh', 'name': 'frontend', 'depends_on': []},
+            {'script': 'scripts/backend.sh', 'name': 'backend', 'depends_on': []},
+            {'script': 'scripts/check.sh', 'depends_on': 'backend'},
+        ]})
+
+        self.assertEqual(graph(phases)['build'], {
+            'frontend': [],
+            'backend': [],
+            'scripts/check.sh': ['backend'],
+        })
+
+    def test_depends_on_earlier_phase(self):
+        phases = plan({'prebuild': ['setup.sh'],
+                       'build': [{'script': 'a.sh', 'depends_on': ['setup.sh']}]})
+
+        # Earlier phases are always finished, so the edge is dropped
+        self.assertEqual(graph(phases)['build'], {'a.sh': []})
+
+    def test_unknown_dependency_fails(self):
+        with self.assertRaises(ConfigException) as e:
+            plan({'build': [{'script': 'a.sh', 'depends_on': ['nope']}]})
+
+        self.assertIn('unknown step nope', str(e.exception))
+
+    def test_later_phase_dependency_fails(self):
+        with self.assertRaises(ConfigException):
+            plan({'build': [{'script': 'a.sh', 'depends_on': ['d.sh']}], 'deploy': ['d.sh']})
+
+    def test_cycle_fails(self):
+        with self.assertRaises(ConfigException) as e:
+            plan({'build': [{'script': 'a.sh', 'depends_on': ['b.sh']},
+                            {'script': 'b.sh', 'depends_on': ['a.sh']}]})
+
+        self.assertIn('cycle', str(e.exception))
+
+    def test_duplicate_names_fail(self):
+        with self.assertRaises(ConfigException):
+            plan({'build': ['a.sh', 'a.sh']})
+
+    def test_cached_steps(self):
+        phases = plan({'build': [{'script': 'build.sh', 'inputs': 'src/**', 'outputs': ['dist']}]})
+        step = phases[1][1][0]
+
+        self.assertEqual(step.inputs, ['src/**'])
+        self.assertEqual(step.outputs, ['dist'])
+
+    def test_cached_steps_need_inputs_and_outputs(self):
+        for item in ({'script': 'a.sh', 'inputs': ['src/**']},
+                     {'script': 'a.sh', 'inputs': ['src/**'], 'outputs': ['/etc']},
+                     {'script': 'a.sh', 'inputs': ['../src'], 'outputs': ['dist']}):
+            with self.assertRaises(ConfigException):
+                plan({'build': [item]})
+
+    def test_step_timeout(self):
+        phases = plan({'build': [{'script': 'install.sh', 'timeout': 300}, 'build.sh']})
+
+        self.assertEqual([step.timeout for step in phases[1][1]], [300, None])
+
+    def test_malformed_steps_fail(self):
+        for item in ({'name': 'a'}, {'script': 'a.sh', 'colour': 'blue'},
+                     {'parallel': 'a.sh'}, {'parallel': []},
+                     {'script': 'a.sh', 'timeout': 0}, {'script': 'a.sh', 'timeout': '1h'}):
+            with self.assertRaises(ConfigException):
+                plan({'build': [item]})
+
+
+class TestRunGraph(TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+
+        # Suppress error logging from failed steps
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def run_step(self, step):
+        with self.lock:
+            self.started.append(step.name)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+        time.sleep(0.05)
+
+        with self.lock:
+            self.running -= 1
+
+        if step.script.startswith('fail'):
+            raise WorkerException('%s failed' % step.name)
+
+    def steps(self, items):
+        return plan({'build': items})[1][1]
+
+    def test_independent_steps_run_at_once(self):
+        steps = self.steps(['deps.sh', {'parallel': ['a.sh', 'b.sh', 'c.sh']}, 'bundle.sh'])
+
+        run_graph(steps, self.run_step, concurrency=4)
+
+        self.assertEqual(self.max_running, 3)
+        self.assertEqual(self.started[0], 'deps.sh')
+        self.assertEqual(self.started[-1], 'bundle.sh')
+
+    def test_concurrency_limit(self):
+        steps = self.steps([{'parallel': ['a.sh', 'b.sh', 'c.sh', 'd.sh']}])
+
+        run_graph(steps, self.run_step, concurrency=2)
+
+        self.assertEqual(self.max_running, 2)
+        self.assertEqual(len(self.started), 4)
+
+    def test_failure_stops_graph(self):
+        steps = self.steps([{'parallel': ['fail.sh', 'slow.sh']}, 'after.sh'])
+
+        with self.assertRaises(WorkerException) as e:
+            run_graph(steps, self.run_step, concurrency=2)
+
+        self.assertEqual(str(e.exception), 'fail.sh failed')
+
+        # The step that was already running finished, but nothing new started
+        self.assertEqual(self.running, 0)
+        self.assertNotIn('after.sh', self.started)
@@ -0,0 +1,190 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import logging
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+import env
+from api.sync import Sync
+from api.exceptions import WorkerException
+from repos import git, commit, make_repo
+
+
+def run_command(cmd, capture=False):
+    stdout = subprocess.PIPE if capture else subprocess.DEVNULL
+
+    try:
+        return subprocess.run(cmd, check=True, universal_newlines=True,
+                              stdout=stdout, stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as e:
+        raise WorkerException(str(e))
+
+
+class TestSync(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.work = os.path.join(self.tmp, 'work')
+        self.home = os.path.join(self.tmp, 'home')
+
+        self.first = make_repo(self.work, {
+            'README.md': 'Hello',
+            'app/main.py': 'print("hello")',
+            'app/old.py': 'print("old")',
+        })
+
+        self.sync = Sync(run_command, root=os.path.join(self.tmp, 'deployed'))
+
+        # Suppress stdout logging
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        logging.disable(logging.NOTSET)
+
+    def deploy_first(self):
+        '''
+        Stand in for a full sync of the first commit, since rsync may not be
+        installed where tests run.
+        '''
+        shutil.copytree(self.work, self.home, symlinks=True)
+        self.sync.record(self.home, self.first)
+
+    def test_no_record_does_full_sync(self):
+        with patch.object(Sync, 'full_sync') as full_sync:
+            self.sync.run(self.work, self.home)
+
+        full_sync.assert_called_once_with(self.work, self.home)
+        self.assertEqual(self.sync.last_deployed(self.home), self.first)
+
+    def test_applies_only_changed_files(self):
+        self.deploy_first()
+
+        # Backdate an unchanged file, to check that it doesn't get copied again
+        readme = os.path.join(self.home, 'README.md')
+        os.utime(readme, (0, 0))
+
+        second = commit(self.work, {
+            'app/main.py': 'print("goodbye")',
+            'app/old.py': None,
+            'lib/util.py': 'pass',
+        })
+
+        with patch.object(Sync, 'full_sync') as full_sync:
+            self.sync.run(self.work, self.home)
+
+        full_sync.assert_not_called()
+
+        with open(os.path.join(self.home, 'app', 'main.py')) as f:
+            self.assertEqual(f.read(), 'print("goodbye")')
+
+        self.assertTrue(os.path.isfile(os.path.join(self.home, 'lib', 'util.py')))
+        self.assertFalse(os.path.exists(os.path.join(self.home, 'app', 'old.py')))
+        self.assertEqual(os.path.getmtime(readme), 0)
+
+        # The home's repo follows along, with a clean working tree
+        self.assertEqual(git(self.home, 'rev-parse', 'HEAD'), second)
+        self.assertEqual(git(self.home, 'status', '--porcelain'), '')
+        self.assertEqual(self.sync.last_deployed(self.home), second)
+
+    def test_relative_working_copy(self):
+        self.deploy_first()
+        second = commit(self.work, {'README.md': 'Hello again'})
+
+        cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, cwd)
+
+        with patch.object(Sync, 'full_sync') as full_sync:
+            self.sync.run('work', self.home)
+
+        full_sync.assert_not_called()
+        self.assertEqual(git(self.home, 'rev-parse', 'HEAD'), second)
+
+    def test_removes_emptied_directories(self):
+        self.deploy_first()
+
+        commit(self.work, {'app/main.py': None, 'app/old.py': None})
+
+        self.sync.run(self.work, self.home)
+
+        self.assertFalse(os.path.exists(os.path.join(self.home, 'app')))
+        self.assertTrue(os.path.isdir(self.home))
+
+    def test_drifted_home_does_full_sync(self):
+        self.deploy_first()
+
+        # Someone committed directly in the home directory
+        commit(self.home, {'README.md': 'Edited by hand'})
+        commit(self.work, {'README.md': 'Hello again'})
+
+        with patch.object(Sync, 'full_sync') as full_sync:
+            self.sync.run(self.work, self.home)
+
+        full_sync.assert_called_once_with(self.work, self.home)
+
+    def assert_full_sync_after(self, files):
+        self.deploy_first()
+        commit(self.work, {'README.md': 'Hello again'})
+
+        for name, contents in files.items():
+            with open(os.path.join(self.home, name), 'w') as f:
+                f.write(contents)
+
+        with patch.object(Sync, 'full_sync') as full_sync:
+            self.sync.run(self.work, self.home)
+
+        full_sync.assert_called_once_with(self.work, self.home)
+
+    def test_edited_home_does_full_sync(self):
+        self.assert_full_sync_after({'README.md': 'Edited by hand'})
+
+    def test_stray_files_do_full_sync(self):
+        self.assert_full_sync_after({'stray.txt': 'Left behind'})
+
+    def test_ignored_files_do_not_count_as_drift(self):
+        self.deploy_first()
+        commit(self.work, {'.gitignore': 'dist/\n'})
+        self.sync.run(self.work, self.home)
+
+        os.makedirs(os.path.join(self.home, 'dist'))
+        with open(os.path.join(self.home, 'dist', 'app.js'), 'w') as f:
+            f.write('built')
+
+        commit(self.work, {'README.md': 'Hello again'})
+
+        with patch.object(Sync, 'full_sync') as full_sync:
+            self.sync.run(self.work, self.home)
+
+        full_sync.assert_not_called()
+        self.assertTrue(os.path.isfile(os.path.join(self.home, 'dist', 'app.js')))
+
+    def test_missing_home_does_full_sync(self):
+        self.sync.record(self.home, self.first)
+
+        with patch.object(Sync, 'full_sync') as full_sync:
+            self.sync.run(self.work, self.home)
+
+        full_sync.assert_called_once_with(self.work, self.home)
+
+    def test_failed_sync_clears_record(self):
+        self.deploy_first()
+        commit(self.work, {'README.md': 'Hello again'})
+
+        with patch.object(Sync, 'apply_diff', side_effect=WorkerException('Boom')):
+            with self.assertRaises(WorkerException):
+                self.sync.run(self.work, self.home)
+
+        self.assertIsNone(self.sync.last_deployed(self.home))
+
+    @skipUnless(shutil.which('rsync'), 'rsync is not installed')
+    def test_full_sync_mirrors_tree(self):
+        os.makedirs(os.path.join(self.home, 'stale'))
+
+        self.sync.run(self.work, self.home)
+
+        self.assertTrue(os.path.isfile(os.path.join(self.home, 'app', 'main.py')))
+        self.assertFalse(os.path.exists(os.path.join(self.home, 'stale')))
+        self.assertFalse(os.path.exists(os.path.join(self.home, 'work')))
@@ -1,10 +1,14 @@
 import os
+import time
+import shutil
+import tempfile
 from unittest import TestCase, main
 import logging
 
 import env
 from api.worker import Worker
-from api.exceptions import WorkerException
+from api.exceptions import WorkerException, CancelledException, TimeoutException
+from api.buildlogs import BuildLog, read_log
 from decorators import mock_subprocess
 
 
@@ -120,3 +124,60 @@ class TestWorker(TestCase):
 
         expected_msg = 'is missing `home` directive'
         self.assertIn(expected_msg, str(e.exception))
+
+    def test_run_command_logs_to_job_log(self):
+        log_dir = tempfile.mkdtemp()
+
+        try:
+            self.worker.log = BuildLog(log_dir, 'a0a0a0a0-0000-4000-8000-000000000000')
+            self.worker.run_command(['echo', 'hello'])
+
+            with self.assertRaises(WorkerException):
+                self.worker.run_command(['bash', '-c', 'exit 1'])
+
+            self.worker.log.close()
+
+            logged = b''.join(read_log(log_dir, 'a0a0a0a0-0000-4000-8000-000000000000'))
+            self.assertIn(b'hello\n', logged)
+        finally:
+            shutil.rmtree(log_dir)
+
+    def test_cancelled_worker_stops(self):
+        self.worker.cancelled = lambda: True
+
+        with self.assertRaises(CancelledException):
+            self.worker.run_command(['echo'])
+
+    def test_command_timeout(self):
+        with self.assertRaises(TimeoutException) as e:
+            self.worker.run_command(['bash', '-c', 'sleep 30 & sleep 30'], timeout=0.2)
+
+        self.assertIn('timed out after', str(e.exception))
+
+    def test_job_time_limit(self):
+        self.worker.started = time.monotonic()
+        self.worker.time_limit = 0.2
+
+        with self.assertRaises(TimeoutException) as e:
+            self.worker.run_command(['sleep', '30'], timeout=60)
+
+        self.assertIn('went over its time limit', str(e.exception))
+
+        # Once the time is up, nothing else gets started
+        with self.assertRaises(TimeoutException):
+            self.worker.run_command(['echo'])
+
+    def test_script_limits(self):
+        tmp = tempfile.mkdtemp()
+
+        try:
+            script = os.path.join(tmp, 'limits.sh')
+            with open(script, 'w') as f:
+                f.write('test "$(ulimit -n)" = 64 && test "$(ulimit -t)" = 10\n')
+
+            self.worker.run_script(script, limits={'open_files': 64, 'cpu': 10})
+
+            with self.assertRaises(WorkerException):
+                self.worker.run_script(script, limits={'open_files': 65})
+        finally:
+            shutil.rmtree(tmp)